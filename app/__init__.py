@@ -19,13 +19,19 @@ from os import getenv
 from json import dumps
 from functools import partial
 
-from flask import Flask, send_from_directory, render_template
+from flask import Flask, send_from_directory, render_template, request
 from flask_caching import Cache
 from flask_compress import Compress
 from flask_cors import CORS
 from flask_sslify import SSLify
 
+from app.api import ClientRegistry
+from app.categories import CategoryIndexes
+from app.entities import item_cache
 from app.frs import Swaggerify
+from app.metrics import metrics
+from app.profiling import profiler
+from app.upstream import flights, scheduler, resilience, timeouts
 from app.helper import gen_tables
 
 from builtins import *  # noqa  # pylint: disable=unused-import
@@ -40,9 +46,22 @@ __email__ = 'reubano@gmail.com'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2017 Reuben Cummings'
 
+
+class TimedCompress(Compress):
+    """Flask-Compress, with the compression time recorded"""
+
+    def after_request(self, response):
+        endpoint = (request.endpoint or '').rpartition('.')[2]
+
+        with metrics.timer('compress_seconds', endpoint=endpoint):
+            return super(TimedCompress, self).after_request(response)
+
+
 cache = Cache()
-compress = Compress()
+compress = TimedCompress()
 swag = Swaggerify()
+clients = ClientRegistry()
+category_indexes = CategoryIndexes()
 
 API_RESPONSE = [{'name': 'objects', 'desc': 'message', 'type': 'str'}]
 SEARCH_RESULT = [
@@ -52,7 +71,9 @@ SEARCH_RESULT = [
         'desc': 'Buy It Now plus shipping cost', 'type': 'float'},
     {'name': 'condition', 'desc': 'Item condition', 'type': 'str'},
     {'name': 'end_date', 'desc': 'End date', 'type': 'date'},
-    {'name': 'end_date_time', 'desc': 'End datetime in seconds', 'type': 'int'},
+    {
+        'name': 'end_date_time', 'desc': 'End datetime in seconds since epoch',
+        'type': 'int'},
     {'name': 'end_time', 'desc': 'End time', 'type': 'time'},
     {'name': 'id', 'desc': 'Item ID', 'type': 'int'},
     {'name': 'item_type', 'desc': 'Item type', 'type': 'str'},
@@ -75,6 +96,11 @@ SHIP_RESULT = [
     {'name': 'actual_shipping_type', 'desc': 'Shipping type', 'type': 'str'},
     {'name': 'item_id', 'desc': 'Item ID', 'type': 'int'}]
 
+SHIP_BATCH_RESULT = SHIP_RESULT + [
+    {'name': 'cached', 'desc': 'Served from cache', 'type': 'bool'},
+    {'name': 'message', 'desc': 'Error message', 'type': 'str'},
+    {'name': 'status', 'desc': "Item status ('ok' or 'error')", 'type': 'str'}]
+
 CAT_RESULT = [
     {'name': 'category', 'type': 'str'},
     {'name': 'country', 'type': 'str'},
@@ -132,13 +158,62 @@ ITEM_RESULT = [
     {'name': 'eBayPlusEligible', 'type': 'bool'}]
 
 
+ITEM_BATCH_RESULT = [
+    {'name': 'BidCount', 'type': 'int'},
+    {'name': 'ConditionDisplayName', 'type': 'str'},
+    {'name': 'ConvertedCurrentPrice', 'type': 'object'},
+    {'name': 'Country', 'type': 'str'},
+    {'name': 'CurrentPrice', 'type': 'object'},
+    {'name': 'EndTime', 'type': 'datetime'},
+    {'name': 'GalleryURL', 'type': 'str'},
+    {'name': 'ItemID', 'type': 'int'},
+    {'name': 'ListingStatus', 'type': 'str'},
+    {'name': 'ListingType', 'type': 'str'},
+    {'name': 'Location', 'type': 'str'},
+    {'name': 'PictureURL', 'type': 'str'},
+    {'name': 'PrimaryCategoryID', 'type': 'int'},
+    {'name': 'PrimaryCategoryName', 'type': 'str'},
+    {'name': 'Quantity', 'type': 'int'},
+    {'name': 'QuantitySold', 'type': 'int'},
+    {'name': 'ShipToLocations', 'type': 'str'},
+    {'name': 'TimeLeft', 'type': 'str'},
+    {'name': 'Title', 'type': 'str'},
+    {'name': 'ViewItemURLForNaturalSearch', 'type': 'str'}]
+
+
+def get_cache_config(config):
+    cache_config = {}
+
+    if config['HEROKU']:
+        cache_config['CACHE_REMOTE_TYPE'] = 'saslmemcached'
+        cache_config['CACHE_MEMCACHED_SERVERS'] = [getenv('MEMCACHIER_SERVERS')]
+        cache_config['CACHE_MEMCACHED_USERNAME'] = getenv('MEMCACHIER_USERNAME')
+        cache_config['CACHE_MEMCACHED_PASSWORD'] = getenv('MEMCACHIER_PASSWORD')
+    elif config['DEBUG_MEMCACHE']:
+        cache_config['CACHE_REMOTE_TYPE'] = 'memcached'
+        cache_config['CACHE_MEMCACHED_SERVERS'] = [getenv('MEMCACHE_SERVERS')]
+
+    # a bounded LRU cache in each worker, in front of memcached (if enabled)
+    if cache_config.get('CACHE_REMOTE_TYPE'):
+        cache_config['CACHE_TYPE'] = 'app.caches.tiered'
+    else:
+        cache_config['CACHE_TYPE'] = 'app.caches.lru'
+
+    local_keys = [
+        'CACHE_LOCAL_MAX_ENTRIES', 'CACHE_LOCAL_TIMEOUT', 'CACHE_SYNC_INTERVAL']
+
+    for key in local_keys:
+        cache_config[key] = config[key]
+
+    return cache_config
+
+
 def create_app(config_mode=None, config_file=None):
     # Create webapp instance
     app = Flask(__name__)
     app.register_blueprint(blueprint)
     CORS(app)
     compress.init_app(app)
-    cache_config = {}
 
     if config_mode:
         app.config.from_object(getattr(config, config_mode))
@@ -150,18 +225,16 @@ def create_app(config_mode=None, config_file=None):
     if app.config.get('SERVER_NAME'):
         SSLify(app)
 
-    if app.config['HEROKU']:
-        cache_config['CACHE_TYPE'] = 'saslmemcached'
-        cache_config['CACHE_MEMCACHED_SERVERS'] = [getenv('MEMCACHIER_SERVERS')]
-        cache_config['CACHE_MEMCACHED_USERNAME'] = getenv('MEMCACHIER_USERNAME')
-        cache_config['CACHE_MEMCACHED_PASSWORD'] = getenv('MEMCACHIER_PASSWORD')
-    elif app.config['DEBUG_MEMCACHE']:
-        cache_config['CACHE_TYPE'] = 'memcached'
-        cache_config['CACHE_MEMCACHED_SERVERS'] = [getenv('MEMCACHE_SERVERS')]
-    else:
-        cache_config['CACHE_TYPE'] = 'simple'
-
-    cache.init_app(app, config=cache_config)
+    cache.init_app(app, config=get_cache_config(app.config))
+    clients.init_app(app)
+    category_indexes.init_app(app, clients)
+    flights.init_app(app, cache)
+    scheduler.init_app(app, cache)
+    resilience.init_app(app)
+    timeouts.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    item_cache.init_app(app, cache)
 
     skwargs = {
         'name': app.config['APP_NAME'], 'version': __version__,
@@ -195,7 +268,9 @@ def create_app(config_mode=None, config_file=None):
 
     create_defs({'columns': SEARCH_RESULT, 'name': 'search_result'})
     create_defs({'columns': SHIP_RESULT, 'name': 'ship_result'})
+    create_defs({'columns': SHIP_BATCH_RESULT, 'name': 'ship_batch_result'})
     create_defs({'columns': ITEM_RESULT, 'name': 'item_result'})
+    create_defs({'columns': ITEM_BATCH_RESULT, 'name': 'item_batch_result'})
     create_defs({'columns': CAT_RESULT, 'name': 'category_result'})
     create_defs({'columns': CAT_RESULT, 'name': 'sub_category_result'})
 
@@ -5,11 +5,24 @@ from __future__ import (
     absolute_import, division, print_function, unicode_literals)
 
 from os import getenv, path as p
+from calendar import timegm
+from collections import OrderedDict
+from datetime import date
+from threading import Lock
+from contextlib import contextmanager
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
 
 import yaml
 import pygogo as gogo
 
 from dateutil.parser import parse as du_parse
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError
 from ebaysdk.finding import Connection as finding
 from ebaysdk.trading import Connection as trading
 from ebaysdk.shopping import Connection as shopping
@@ -22,10 +35,35 @@ except NameError:
 else:
     from ebaysdk.exception import ConnectionError as eBayConnectionError
 
+from app.metrics import metrics
+from app.stream import parse_stream, compile_element_fields
+from app.upstream import (
+    flights, scheduler, resilience, timeouts, make_call_key, bind_context,
+    gen_outcomes, is_transient, QuotaExceeded, Unavailable, THROTTLE_ERRORS,
+    TRANSIENT_STATUSES)
+from app.entities import (
+    item_cache, get_shipping_section, SUMMARY, DETAILS)
+
 from builtins import *  # noqa  # pylint: disable=unused-import
 
 logger = gogo.Gogo(__name__, monolog=True).logger
 
+# ordinal of 1970-01-01
+EPOCH_ORDINAL = 719163
+SECONDS_PER_DAY = 86400
+
+# GetMultipleItems accepts at most 20 item IDs per call
+MAX_ITEMS_PER_CALL = 20
+
+# Ebay kwargs that change how a client talks to eBay (and so can't be
+# shared). The host (`domain` and `https`) is set by the registry only, since
+# these kwargs may come from a request's query parameters.
+CLIENT_KWARGS = {
+    'appid', 'devid', 'certid', 'token', 'config_file', 'verbose', 'errors'}
+
+# client kwargs that must never be shown (e.g., in `ClientRegistry.stats`)
+CREDENTIAL_KWARGS = {'appid', 'devid', 'certid', 'token'}
+
 
 def getenv_from_file(env, yml_file):
     parent = p.dirname(p.dirname(__file__))
@@ -34,6 +72,177 @@ def getenv_from_file(env, yml_file):
     return result[env]
 
 
+def parse_end_time(timestamp):
+    """Parse an eBay timestamp into its date, time, and epoch.
+
+    eBay timestamps are always UTC and formatted like
+    '2017-03-10T22:04:31.000Z', so the fields are sliced out directly.
+    Anything else is handed off to dateutil.
+
+    Parameters
+    ----------
+    timestamp : str or datetime
+        an eBay timestamp, e.g., `listingInfo.endTime`
+
+    Returns
+    -------
+    (date, time, seconds since epoch) : tuple
+
+    Examples
+    --------
+    >>> parse_end_time('2017-03-10T22:04:31.000Z')
+    ('2017-03-10', '22:04', 1489183471)
+    >>> parse_end_time('2017-03-10T16:04:31-06:00')
+    ('2017-03-10', '22:04', 1489183471)
+    """
+    try:
+        is_ebay = timestamp[10] == 'T' and timestamp[-1] == 'Z'
+    except (IndexError, TypeError):
+        is_ebay = False
+
+    if is_ebay:
+        try:
+            year = int(timestamp[:4])
+            month = int(timestamp[5:7])
+            day = int(timestamp[8:10])
+            hour = int(timestamp[11:13])
+            minute = int(timestamp[14:16])
+            second = int(timestamp[17:19])
+            days = date(year, month, day).toordinal() - EPOCH_ORDINAL
+        except ValueError:
+            is_ebay = False
+        else:
+            seconds = days * SECONDS_PER_DAY + hour * 3600 + minute * 60
+            end_date, end_time = timestamp[:10], timestamp[11:16]
+            return end_date, end_time, seconds + second
+
+    date_time = timestamp if hasattr(timestamp, 'year') else du_parse(timestamp)
+    utc = date_time.utctimetuple()
+    end_date = '{0:04d}-{1:02d}-{2:02d}'.format(*utc)
+    end_time = '{0:02d}:{1:02d}'.format(*utc[3:])
+    return end_date, end_time, timegm(utc)
+
+
+def compile_path(path, default=None, convert=None):
+    """Compile a dotted path into a null soaking getter.
+
+    The getter behaves like `Andand(record).a.b.c(default)` but doesn't
+    create any wrapper objects.
+
+    Parameters
+    ----------
+    path : str
+        dotted path, e.g., 'sellingStatus.currentPrice.value'
+
+    default : value to return if the path is missing or empty
+    convert : function applied to found values, e.g., `float`
+
+    Returns
+    -------
+    getter : function
+
+    Examples
+    --------
+    >>> price = compile_path('sellingStatus.currentPrice.value', 0.0, float)
+    >>> price({'sellingStatus': {'currentPrice': {'value': '2.5'}}})
+    2.5
+    >>> price({'sellingStatus': None})
+    0.0
+    """
+    keys = tuple(path.split('.'))
+
+    def getter(record):
+        for key in keys:
+            try:
+                record = record[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+
+        if not record:
+            return default
+
+        return convert(record) if convert else record
+
+    return getter
+
+
+def compile_fields(fields):
+    """Compile field specs into a record extractor.
+
+    Parameters
+    ----------
+    fields : list of tuples
+        (name, path[, default[, convert]]) specs (see `compile_path`)
+
+    Returns
+    -------
+    extractor : function
+
+    Examples
+    --------
+    >>> extract = compile_fields([
+    ...     ('title', 'title'),
+    ...     ('price', 'sellingStatus.currentPrice.value', 0.0, float)])
+    >>> extract({'title': 'Lego'}) == {'title': 'Lego', 'price': 0.0}
+    True
+    """
+    getters = tuple((field[0], compile_path(*field[1:])) for field in fields)
+
+    def extract(record):
+        return {name: getter(record) for name, getter in getters}
+
+    return extract
+
+
+get_search_items = compile_path('searchResult.item', [])
+get_total_pages = compile_path('paginationOutput.totalPages', 0)
+
+ITEM_FIELDS = [
+    ('id', 'itemId', None, str),
+    ('url', 'viewItemURL'),
+    ('title', 'title'),
+    ('condition', 'condition.conditionDisplayName'),
+    ('item_type', 'listingInfo.listingType'),
+    ('price', 'sellingStatus.currentPrice.value', 0.0, float),
+    ('buy_now_price', 'listingInfo.buyItNowPrice.value', 0.0, float),
+    ('shipping', 'shippingInfo.shippingServiceCost.value', 0.0, float),
+    ('timestamp', 'listingInfo.endTime')]
+
+# the `ITEM_FIELDS` of a GetItem item (shipping is in a list, see
+# `Trading.summarize`)
+DETAIL_FIELDS = [
+    ('id', 'ItemID', None, str),
+    ('url', 'ListingDetails.ViewItemURL'),
+    ('title', 'Title'),
+    ('condition', 'ConditionDisplayName'),
+    ('item_type', 'ListingType'),
+    ('price', 'SellingStatus.CurrentPrice.value', 0.0, float),
+    ('buy_now_price', 'BuyItNowPrice.value', 0.0, float),
+    ('timestamp', 'ListingDetails.EndTime')]
+
+SHIPPING_FIELDS = [
+    ('actual_shipping', 'ShippingServiceCost.value', 0.0, float),
+    ('actual_shipping_currency', 'ShippingServiceCost._currencyID'),
+    ('actual_shipping_service', 'ShippingServiceName'),
+    ('actual_shipping_type', 'ShippingType')]
+
+CATEGORY_FIELDS = [
+    ('id', 'CategoryID'),
+    ('category', 'CategoryName'),
+    ('level', 'CategoryLevel'),
+    ('parent_id', 'CategoryParentID')]
+
+extract_item = compile_fields(ITEM_FIELDS)
+extract_details = compile_fields(DETAIL_FIELDS)
+get_shipping_options = compile_path(
+    'ShippingDetails.ShippingServiceOptions', [])
+get_shipping_cost = compile_path('ShippingServiceCost.value', 0.0, float)
+extract_shipping = compile_fields(SHIPPING_FIELDS)
+extract_category = compile_fields(CATEGORY_FIELDS)
+extract_item_element = compile_element_fields(ITEM_FIELDS)
+extract_category_element = compile_element_fields(CATEGORY_FIELDS)
+
+
 class Andand(object):
     """A Ruby inspired null soaking object"""
 
@@ -63,9 +272,59 @@ class Andand(object):
         return self._item_ or default
 
 
+class KeepAliveSession(Session):
+    """A requests session that keeps its connections open between calls"""
+
+    def __init__(self, pool_size=10, max_retries=0):
+        super(KeepAliveSession, self).__init__()
+
+        # `Resilience` retries calls (within the quotas and circuit breakers),
+        # so the adapter mustn't retry them again
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=max_retries)
+
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def close(self):
+        # ebaysdk (>= 2.2.0) closes the session after processing every
+        # response, which throws away the pooled (keep-alive) connections
+        pass
+
+    def shutdown(self):
+        super(KeepAliveSession, self).close()
+
+
 class Ebay(object):
     """A general Ebay API config object"""
 
+    connection = None
+    flights = flights
+    scheduler = scheduler
+    resilience = resilience
+    timeouts = timeouts
+    item_cache = item_cache
+    global_ids = {
+        'US': {
+            'countryabbr': 'EBAY-US', 'countryid': '0', 'currency': 'USD'},
+        'UK': {
+            'countryabbr': 'EBAY-GB', 'countryid': '3', 'currency': 'GBP'},
+        'FR': {
+            'countryabbr': 'EBAY-FR', 'countryid': '71', 'currency': 'EUR'},
+        'DE': {
+            'countryabbr': 'EBAY-DE', 'countryid': '77', 'currency': 'EUR'},
+        'IT': {
+            'countryabbr': 'EBAY-IT', 'countryid': '101',
+            'currency': 'EUR'},
+        'ES': {
+            'countryabbr': 'EBAY-ES', 'countryid': '186',
+            'currency': 'EUR'},
+        'CA': {
+            'countryabbr': 'EBAY-ENCA', 'countryid': '2',
+            'currency': 'CAD'},
+    }
+
     def __init__(self, sandbox=False, config_file=None, **kwargs):
         """Initialization method.
 
@@ -78,6 +337,16 @@ class Ebay(object):
         country : eBay country (default: US)
         timeout : HTTP request timeout (default: 20)
         parallel : ebaysdk parallel object
+        session : requests session shared by all of the client's connections
+            (default: a new KeepAliveSession)
+        pool_size : number of keep-alive connections per host (default: 10)
+        stream : incrementally parse responses (see `stream`) where supported
+            (default: False)
+
+        domain : API host, e.g., a local stand-in (see `app.standin`)
+            (default: eBay's host for the API)
+
+        https : use https (default: True)
 
         Returns
         -------
@@ -88,26 +357,6 @@ class Ebay(object):
         >>> Ebay()  #doctest: +ELLIPSIS
         <app.api.Ebay object at 0x...>
         """
-        self.global_ids = {
-            'US': {
-                'countryabbr': 'EBAY-US', 'countryid': '0', 'currency': 'USD'},
-            'UK': {
-                'countryabbr': 'EBAY-GB', 'countryid': '3', 'currency': 'GBP'},
-            'FR': {
-                'countryabbr': 'EBAY-FR', 'countryid': '71', 'currency': 'EUR'},
-            'DE': {
-                'countryabbr': 'EBAY-DE', 'countryid': '77', 'currency': 'EUR'},
-            'IT': {
-                'countryabbr': 'EBAY-IT', 'countryid': '101',
-                'currency': 'EUR'},
-            'ES': {
-                'countryabbr': 'EBAY-ES', 'countryid': '186',
-                'currency': 'EUR'},
-            'CA': {
-                'countryabbr': 'EBAY-ENCA', 'countryid': '2',
-                'currency': 'CAD'},
-        }
-
         self.sandbox = sandbox
 
         if self.sandbox:
@@ -127,8 +376,158 @@ class Ebay(object):
             'timeout': kwargs.get('timeout', 20),
         }
 
+        pool_size = kwargs.get('pool_size', 10)
+        self.domain = kwargs.get('domain')
+        self.https = kwargs.get('https', True)
+        self.streaming = kwargs.get('stream', False)
+        self.session = kwargs.get('session') or KeepAliveSession(pool_size)
+        self.stats = {'hits': 0, 'opens': 0, 'reaps': 0}
+        self._idle = []
+        self._lock = Lock()
+
+    def open(self):
+        """Open a new ebaysdk connection that uses the shared session.
+
+        Returns
+        -------
+        ebaysdk connection : Connection
+        """
+        api = self.connection(**self.kwargs)
+        api.session = self.session
+
+        # ebaysdk always forces https
+        api.config.set('https', self.https, force=True)
+
+        with self._lock:
+            self.stats['opens'] += 1
+
+        return api
+
+    def close(self):
+        """Close all of the client's connections."""
+        with self._lock:
+            self._idle = []
+
+        shutdown = getattr(self.session, 'shutdown', self.session.close)
+        shutdown()
+
+    @contextmanager
+    def checkout(self):
+        """Borrow an idle ebaysdk connection (opening one if none are idle).
+
+        ebaysdk connections store the state of the current call, so each one
+        may only serve a single caller at a time.
+
+        Yields
+        ------
+        ebaysdk connection : Connection
+
+        Examples
+        --------
+        >>> finding = Finding(sandbox=True)
+        >>> with finding.checkout() as api:
+        ...     api is finding.api
+        True
+        >>> finding.stats == {'hits': 1, 'opens': 1, 'reaps': 0}
+        True
+        """
+        with self._lock:
+            if self._idle:
+                api = self._idle.pop()[0]
+                self.stats['hits'] += 1
+            else:
+                api = None
+
+        api = api or self.open()
+
+        try:
+            yield api
+        finally:
+            with self._lock:
+                self._idle.append((api, monotonic()))
+
+    def reap(self, max_idle_time, max_idle=None):
+        """Close connections that have been idle for too long.
+
+        Parameters
+        ----------
+        max_idle_time : number of seconds a connection may sit idle
+        max_idle : maximum number of idle connections to keep
+
+        Returns
+        -------
+        Number of connections reaped : int
+        """
+        expires = monotonic() - max_idle_time
+
+        with self._lock:
+            # `_idle` is ordered oldest first. The most recently used
+            # connection is always kept so the session stays warm.
+            idle = [c for c in self._idle[:-1] if c[1] >= expires]
+            idle += self._idle[-1:]
+            idle = idle[-max_idle:] if max_idle else idle
+            reaped = len(self._idle) - len(idle)
+            self._idle = idle
+            self.stats['reaps'] += reaped
+
+        return reaped
+
+    def complete(self, item):
+        """Add the derived fields to an extracted search result item.
+
+        Parameters
+        ----------
+        item : dict
+            an `extract_item` (or `extract_details`) result
+
+        Returns
+        -------
+        Cleaned up search result : dict
+        """
+        country = self.kwargs['country']
+        end_date, end_time, end_date_time = parse_end_time(
+            item.pop('timestamp'))
+
+        shipping = item['shipping']
+
+        item.update({
+            'price_and_shipping': item['price'] + shipping,
+            'buy_now_price_and_shipping': item['buy_now_price'] + shipping,
+            'end_date_time': end_date_time,
+            'end_date': end_date,
+            'end_time': end_time,
+            'country': country,
+            'currency': self.global_ids[country]['currency'],
+        })
+
+        return item
+
+    def get_call_key(self, verb, data=None, *args):
+        """Identify an eBay API request (see `app.upstream.SingleFlight`).
+
+        Parameters
+        ----------
+        verb : string
+        data : dict
+        args : any other values that determine the response
+
+        Returns
+        -------
+        Call key : string
+
+        Examples
+        --------
+        >>> finding = Finding(sandbox=True)
+        >>> key = finding.get_call_key('findItemsAdvanced', {'keywords': 'a'})
+        >>> key == finding.get_call_key('findItemsAdvanced', {'keywords': 'b'})
+        False
+        """
+        name = self.__class__.__name__
+        return make_call_key(name, self.kwargs, verb, data or {}, *args)
+
     def execute(self, verb, data=None):
-        """Execute the eBay API request.
+        """Execute the eBay API request. Identical concurrent requests are
+        coalesced into a single upstream call.
 
         Parameters
         ----------
@@ -149,12 +548,30 @@ class Ebay(object):
         ...     'searchResult', 'version'}
         True
         """
-        data = data or {}
+        key = self.get_call_key(verb, data)
+        return self.flights.do(key, lambda: self.call(verb, data))
 
-        try:
-            response = self.api.execute(verb, data)
-        except (ConnectionError, eBayConnectionError) as e:
-            response = e.response
+    def call(self, verb, data=None):
+        """Execute the eBay API request (without coalescing).
+
+        Parameters
+        ----------
+        verb : string
+        data : dict
+
+        Returns
+        -------
+        eBay API response. : dict
+
+        Raises
+        ------
+        QuotaExceeded : if the call was refused by the scheduler, or eBay
+            reports that a call limit was reached
+
+        CircuitOpen : if the eBay endpoint is unhealthy
+        Unavailable : if eBay kept failing
+        """
+        response = self.get_response(verb, data or {})
 
         try:
             success = response.reply.ack == 'Success'
@@ -169,18 +586,228 @@ class Ebay(object):
         if not success:
             try:
                 msg = response.reply.Errors.ShortMessage
+                code = response.reply.Errors.ErrorCode
             except AttributeError:
                 msg = response.reply.errorMessage.error.message
+                code = response.reply.errorMessage.error.errorId
 
             logger.error(msg)
             result['message'] = msg
+            self.check_throttled(code, msg)
 
         return result
 
+    def get_response(self, verb, data):
+        """Get the (retried) eBay API response, whether or not the request
+        succeeded.
+
+        Returns
+        -------
+        ebaysdk response : Response
+        """
+        try:
+            return self.resilient(verb, lambda: self.send(verb, data))
+        except Unavailable:
+            raise
+        except (ConnectionError, eBayConnectionError) as e:
+            # eBay still failed (e.g., with a 503) after the retries
+            if is_transient(e):
+                raise Unavailable('{} failed: {}'.format(verb, e))
+
+            return e.response
+
+    def send(self, verb, data):
+        """Make a single upstream call (see `call`).
+
+        Returns
+        -------
+        ebaysdk response : Response
+        """
+        self.acquire()
+        timeout = self.get_timeout(verb)
+
+        with self.checkout() as api, self.track(verb, timeout):
+            api.timeout = timeout
+            return api.execute(verb, data)
+
+    @contextmanager
+    def track(self, verb, timeout=None):
+        """Record the latency of the upstream call made within the context
+        (see `app.upstream.Timeouts.track`).
+        """
+        family, country, verb = endpoint = self.get_endpoint(verb)
+        timer = metrics.timer(
+            'upstream_request_seconds', api=family, country=country,
+            verb=verb)
+
+        with self.timeouts.track(*endpoint, timeout=timeout), timer:
+            yield
+
+    def resilient(self, verb, func, hedge=True):
+        """Make an upstream call through the resilience layer (see
+        `app.upstream.Resilience.call`).
+        """
+        family, country, _ = self.get_endpoint(verb)
+        return self.resilience.call(family, country, verb, func, hedge)
+
+    def get_endpoint(self, verb):
+        """Identify the API family, country, and verb of a call.
+
+        Returns
+        -------
+        (family, country, verb) : tuple
+
+        Examples
+        --------
+        >>> Finding(sandbox=True).get_endpoint('findItemsAdvanced') == (
+        ...     'Finding', 'US', 'findItemsAdvanced')
+        True
+        """
+        return (self.__class__.__name__, self.kwargs['country'], verb)
+
+    def get_timeout(self, verb):
+        """Get a call's timeout (see `app.upstream.Timeouts.get_timeout`).
+        """
+        endpoint = self.get_endpoint(verb)
+        default = self.kwargs['timeout']
+        return self.timeouts.get_timeout(*endpoint, default=default)
+
+    def acquire(self):
+        """Wait for the scheduler's permission to make a call (see
+        `app.upstream.CallScheduler.acquire`), but not past the deadline.
+        """
+        remaining = self.timeouts.get_remaining()
+        max_wait = None if remaining is None else max(remaining, 0)
+        return self.scheduler.acquire(
+            self.kwargs['appid'], self.__class__.__name__, max_wait)
+
+    def check_throttled(self, code, msg):
+        """Raise an error if eBay refused a call because a call limit was
+        reached (so the failed response isn't cached).
+
+        Parameters
+        ----------
+        code : string
+            the eBay error code
+
+        msg : string
+            the eBay error message
+
+        Examples
+        --------
+        >>> Finding(sandbox=True).check_throttled('10001', 'Limit reached')
+        Traceback (most recent call last):
+        ...
+        app.upstream.QuotaExceeded: Limit reached
+        """
+        if str(code) in THROTTLE_ERRORS:
+            self.scheduler.count('throttled')
+            raise QuotaExceeded(msg)
+
+    def stream(self, verb, data, record_path, extract, transform=None):
+        """Execute the eBay API request and incrementally parse the response.
+
+        Unlike `execute`, the response is never converted into a dict. Only
+        the fields `extract` asks for are read (as the body downloads).
+
+        Parameters
+        ----------
+        verb : string
+        data : dict
+        record_path : string
+            path (relative to the root) of the record elements
+
+        extract : function
+            converts a record element into a dict
+
+        transform : function
+            applied to each extracted record
+
+        Returns
+        -------
+        (records, summary) : tuple
+            The parsed records and the response summary. The summary
+            includes a `message` if the request failed.
+        """
+        names = [
+            getattr(f, 'spec', getattr(f, '__name__', None))
+            for f in (extract, transform)]
+
+        key = self.get_call_key(verb, data, record_path, *names)
+        args = (verb, data, record_path, extract, transform)
+        return self.flights.do(key, lambda: self.call_stream(*args))
+
+    def call_stream(self, verb, data, record_path, extract, transform=None):
+        """Execute the eBay API request and incrementally parse the response
+        (without coalescing). See `stream`.
+        """
+        func = lambda: self.open_stream(verb, data)
+
+        try:
+            # a hedged stream would leave the losing download running
+            response = self.resilient(verb, func, hedge=False)
+        except HTTPError as e:
+            response = e.response
+
+        try:
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                timer = metrics.timer(
+                    'parse_seconds', api=self.__class__.__name__,
+                    mode='stream')
+
+                with timer:
+                    records, summary = parse_stream(
+                        response.raw, record_path, extract, transform)
+            else:
+                records, summary = [], {'message': response.reason}
+        finally:
+            response.close()
+
+        if summary.get('ack') != 'Success':
+            summary.setdefault('message', 'Request failed')
+            logger.error(summary['message'])
+            self.check_throttled(summary.get('code'), summary['message'])
+        else:
+            summary.pop('message', None)
+
+        return records, summary
+
+    def open_stream(self, verb, data=None):
+        """Send the eBay API request without reading the response body.
+
+        Returns
+        -------
+        requests response : Response
+
+        Raises
+        ------
+        HTTPError : if eBay (probably temporarily) failed
+        """
+        self.acquire()
+        timeout = self.get_timeout(verb)
+
+        with self.checkout() as api:
+            api.build_request(verb, data or {}, None)
+            request = api.request
+
+        with self.track(verb, timeout):
+            response = self.session.send(
+                request, stream=True, verify=True, proxies=api.proxies,
+                timeout=timeout, allow_redirects=True)
+
+        if response.status_code in TRANSIENT_STATUSES:
+            response.close()
+            raise HTTPError(response.reason, response=response)
+
+        return response
+
 
 class Trading(Ebay):
     """An Ebay Trading API object"""
 
+    connection = trading
+
     def __init__(self, **kwargs):
         """Initialization method.
 
@@ -223,7 +850,7 @@ class Trading(Ebay):
         # TODO: add KeyError exception handling
         new = {
             'siteid': self.global_ids[self.kwargs['country']]['countryid'],
-            'domain': domain,
+            'domain': self.domain or domain,
             'certid': certid,
             'token': token,
             'version': '861',
@@ -231,7 +858,8 @@ class Trading(Ebay):
         }
 
         self.kwargs.update(new)
-        self.api = trading(**self.kwargs)
+        self.api = self.open()
+        self._idle.append((self.api, monotonic()))
 
     # def get_usage(self):
     #     """Get eBay API usage details
@@ -287,14 +915,60 @@ class Trading(Ebay):
         True
         """
         data = {'DetailLevel': 'ItemReturnAttributes', 'ItemID': item_id}
-        return self.execute('GetItem', data)
+        response = self.execute('GetItem', data)
+
+        if response.get('Item'):
+            entities = {str(item_id): response['Item']}
+            self.item_cache.put(self.kwargs['country'], DETAILS, entities)
+
+        return response
+
+    def summarize(self, item):
+        """Get the search result fields (see `Finding.parse`) of an item's
+        details.
+
+        Parameters
+        ----------
+        item : dict
+            a `get_item` item
+
+        Returns
+        -------
+        Item summary : dict
 
-    def get_categories(self):
-        """Get eBay top level categories.
+        Examples
+        --------
+        >>> item = {
+        ...     'ItemID': '1', 'Title': 'Lego',
+        ...     'SellingStatus': {'CurrentPrice': {'value': '2.5'}},
+        ...     'ShippingDetails': {'ShippingServiceOptions': [
+        ...         {'ShippingServiceCost': {'value': '1.0'}}]},
+        ...     'ListingDetails': {'EndTime': '2017-03-10T22:04:31.000Z'}}
+        >>> summary = Trading(sandbox=True, token='t').summarize(item)
+        >>> summary['title'], summary['price_and_shipping']
+        ('Lego', 3.5)
+        """
+        summary = extract_details(item)
+        options = get_shipping_options(item)
+
+        if hasattr(options, 'get'):  # one shipping service
+            options = [options]
+
+        summary['shipping'] = get_shipping_cost(options[0]) if options else 0.0
+        return self.complete(summary)
+
+    def get_categories(self, level_limit=1):
+        """Get eBay categories.
+
+        Parameters
+        ----------
+        level_limit : int
+            deepest level to retrieve (default: 1, i.e., only the top level
+            categories). Set to None to retrieve the entire category tree.
 
         Returns
         -------
-        eBay top level categories. : dict
+        eBay categories. : dict
 
         Examples
         --------
@@ -307,7 +981,11 @@ class Trading(Ebay):
         >>> response.CategoryArray.Category[3]['CategoryName']
         'Books, Comics & Magazines'
         """
-        data = {'DetailLevel': 'ReturnAll', 'LevelLimit': 1}
+        data = {'DetailLevel': 'ReturnAll'}
+
+        if level_limit:
+            data['LevelLimit'] = level_limit
+
         response = self.execute('GetCategories', data)
         return Andand(response)
 
@@ -347,6 +1025,114 @@ class Trading(Ebay):
         response = self.execute('GetCategories', data)
         return Andand(response)
 
+    def fetch_categories(self, category_id=None, level_limit=1):
+        """Get and parse eBay categories.
+
+        Same as `parse(get_categories().CategoryArray.Category)` (or
+        `get_hierarchy(category_id)` if given), but when streaming is enabled,
+        the categories are parsed straight from the response body.
+
+        Parameters
+        ----------
+        category_id : int
+            top level category whose hierarchy to get (default: None, i.e.,
+            get the categories from the top level down to `level_limit`)
+
+        level_limit : int
+            see `get_categories`
+
+        Returns
+        -------
+        Cleaned up categories (empty if none were found) : list
+
+        Examples
+        --------
+        >>> trading = Trading(sandbox=True, stream=True)
+        >>> trading.fetch_categories()[0] == {
+        ...     'category': 'Antiques', 'parent_id': '20081', 'country': 'US',
+        ...     'id': '20081', 'level': '1'}
+        True
+        """
+        if not self.streaming:
+            if category_id:
+                response = self.get_hierarchy(category_id)
+            else:
+                response = self.get_categories(level_limit)
+
+            categories = response.CategoryArray.Category()
+            return self.parse(categories) if categories else []
+
+        data = {'DetailLevel': 'ReturnAll'}
+
+        if category_id:
+            data['CategoryParent'] = category_id
+        elif level_limit:
+            data['LevelLimit'] = level_limit
+
+        return self.stream_categories(data)[0]
+
+    def fetch_category_tree(self):
+        """Get and parse the entire eBay category tree.
+
+        Returns
+        -------
+        (categories, version) : tuple
+            The cleaned up categories and the tree's CategoryVersion
+
+        Examples
+        --------
+        >>> trading = Trading(sandbox=True)
+        >>> categories, version = trading.fetch_category_tree()
+        >>> len(categories) > 1000
+        True
+        >>> version == trading.get_category_version()
+        True
+        """
+        if self.streaming:
+            data = {'DetailLevel': 'ReturnAll'}
+            categories, summary = self.stream_categories(data)
+            version = summary.get('version')
+        else:
+            response = self.get_categories(None)
+            categories = self.parse(response.CategoryArray.Category() or [])
+            version = response.CategoryVersion()
+
+        return categories, version
+
+    def stream_categories(self, data):
+        """Execute a GetCategories request and incrementally parse the
+        response (see `Ebay.stream`).
+
+        Parameters
+        ----------
+        data : dict
+
+        Returns
+        -------
+        (categories, summary) : tuple
+        """
+        country = self.kwargs['country']
+        return self.stream(
+            'GetCategories', data, 'CategoryArray/Category',
+            extract_category_element, lambda c: dict(c, country=country))
+
+    def get_category_version(self):
+        """Get the current version of the eBay category tree. Much cheaper
+        than `get_categories` since no categories are returned.
+
+        Returns
+        -------
+        Category version (None if the request failed) : string
+
+        Examples
+        --------
+        >>> trading = Trading(sandbox=True)
+        >>> trading.get_category_version().isdigit()
+        True
+        """
+        return self.execute('GetCategories', {}).get('CategoryVersion')
+
+    @metrics.timed('parse_seconds', api='Trading', mode='dict')
     def parse(self, response):
         """Convert Trading API search response into a more readable format.
 
@@ -371,14 +1157,8 @@ class Trading(Ebay):
         if response and hasattr(response, 'update'):  # one result
             response = [response]
 
-        return [
-            {
-                'id': r['CategoryID'],
-                'category': r['CategoryName'],
-                'level': r['CategoryLevel'],
-                'parent_id': r['CategoryParentID'],
-                'country': self.kwargs['country'],
-            } for r in response]
+        country = self.kwargs['country']
+        return [dict(extract_category(r), country=country) for r in response]
 
     def make_lookup(self, results):
         """Convert Trading API category list into a lookup table.
@@ -419,6 +1199,12 @@ class Trading(Ebay):
 class Finding(Ebay):
     """An eBay Finding API object"""
 
+    connection = finding
+    verbs = {
+        'findCompletedItems', 'findItemsAdvanced', 'findItemsByCategory',
+        'findItemsByImage', 'findItemsByKeywords', 'findItemsByProduct',
+        'findItemsIneBayStores', 'getHistograms'}
+
     def __init__(self, **kwargs):
         """Initialization method.
 
@@ -441,19 +1227,24 @@ class Finding(Ebay):
         >>> finding = Finding(sandbox=False)
         >>> finding.kwargs['domain'] == 'svcs.ebay.com'
         True
+        >>> finding = Finding(domain='localhost:8089', https=False)
+        >>> url = finding.api.build_request_url('findItemsAdvanced')
+        >>> url == 'http://localhost:8089/services/search/FindingService/v1'
+        True
         """
         super(Finding, self).__init__(**kwargs)
         domain = 'svcs.sandbox.ebay.com' if self.sandbox else 'svcs.ebay.com'
 
         new = {
             'siteid': self.global_ids[self.kwargs['country']]['countryabbr'],
-            'domain': domain,
+            'domain': self.domain or domain,
             'version': '1.0.0',
             'compatibility': '1.0.0',
         }
 
         self.kwargs.update(new)
-        self.api = finding(**self.kwargs)
+        self.api = self.open()
+        self._idle.append((self.api, monotonic()))
 
     def search(self, options):
         """Search eBay using the Finding API.
@@ -541,6 +1332,7 @@ class Finding(Ebay):
         verb = options.pop('verb', 'findItemsAdvanced')
         return self.execute(verb, options)
 
+    @metrics.timed('parse_seconds', api='Finding', mode='dict')
     def parse(self, response):
         """Convert Finding search response into a more readable format.
 
@@ -571,67 +1363,100 @@ class Finding(Ebay):
         >>> 'www.ebay.co.uk' in item['url']
         True
         """
-        items = []
-        currency = self.global_ids[self.kwargs['country']]['currency']
-        result = Andand(response).searchResult.item([])
-        pages = Andand(response).paginationOutput.totalPages(0)
+        result = get_search_items(response)
+        pages = get_total_pages(response)
 
         if result and hasattr(result, 'update'):  # one result
             result = [result]
 
-        for r in result:
-            date_time = du_parse(r['listingInfo']['endTime'])
-            end_date = date_time.strftime("%Y-%m-%d")
-            end_time = date_time.strftime("%H:%M")
-            offset_years = int(date_time.strftime("%Y")) - 2010
-            year_in_sec = offset_years * 365 * 24 * 60 * 60
-            days_in_sec = int(date_time.strftime("%j")) * 24 * 60 * 60
-            hours_in_sec = int(date_time.strftime("%H")) * 60 * 60
-            minutes_in_sec = int(date_time.strftime("%M")) * 60
-            secs_in_sec = int(date_time.strftime("%S"))
-
-            args = [year_in_sec, days_in_sec, hours_in_sec, minutes_in_sec]
-            args.append(secs_in_sec)
-            end_date_time = sum(args)
-
-            price = float(Andand(r).sellingStatus.currentPrice.value(0))
-            buy_now_price = float(Andand(r).listingInfo.buyItNowPrice.value(0))
-
-            shipping = float(
-                Andand(r).shippingInfo.shippingServiceCost.value(0))
-
-            condition = Andand(r).condition.conditionDisplayName()
-            price_and_shipping = price + shipping
-            buy_now_price_and_shipping = buy_now_price + shipping
-
-            item = {
-                'id': str(r['itemId']),
-                'url': r['viewItemURL'],
-                'title': r['title'],
-                'condition': condition,
-                'item_type': r['listingInfo']['listingType'],
-                'price': price,
-                'buy_now_price': buy_now_price,
-                'shipping': shipping,
-                'price_and_shipping': price_and_shipping,
-                'buy_now_price_and_shipping': buy_now_price_and_shipping,
-                'end_date_time': end_date_time,
-                'end_date': end_date,
-                'end_time': end_time,
-                'country': self.kwargs['country'],
-                'currency': currency,
-            }
-
-            items.append(item)
-
-        results = {r['id']: r for r in items}
+        items = (self.complete(extract_item(r)) for r in result)
+        results = {item['id']: item for item in items}
         message = response.get('message')
         return {'results': results, 'pages': pages, 'message': message}
 
+    def fetch(self, options):
+        """Search eBay and parse the results.
+
+        Same as `parse(search(options))`, but when streaming is enabled, the
+        results are parsed straight from the response body. The results are
+        also added to the item cache.
+
+        Parameters
+        ----------
+        options : dict
+            see `search`
+
+        Returns
+        -------
+        Cleaned up search results : dict
+
+        Examples
+        --------
+        >>> finding = Finding(sandbox=True, stream=True)
+        >>> parsed = finding.fetch({'keywords': 'Harry Potter'})
+        >>> set(parsed) == {'message', 'results', 'pages'}
+        True
+        """
+        if self.streaming:
+            parsed = self.fetch_stream(options)
+        else:
+            parsed = self.parse(self.search(dict(options)))
+
+        # outside of `parse` so its timings don't include cache round trips
+        self.item_cache.put(self.kwargs['country'], SUMMARY, parsed['results'])
+        return parsed
+
+    def fetch_stream(self, options):
+        options = dict(options)
+        verb = options.pop('verb', 'findItemsAdvanced')
+        items, summary = self.stream(
+            verb, options, 'searchResult/item', extract_item_element,
+            self.complete)
+
+        results = {item['id']: item for item in items}
+        pages = int(summary.get('pages') or 0)
+        message = summary.get('message')
+        return {'results': results, 'pages': pages, 'message': message}
+
+    def merge(self, parsed):
+        """Combine several `parse` results (e.g., pages) into one.
+
+        Parameters
+        ----------
+        parsed : list of dicts
+            `parse` results
+
+        Returns
+        -------
+        Combined search results : dict
+
+        Examples
+        --------
+        >>> finding = Finding(sandbox=True)
+        >>> merged = finding.merge([
+        ...     {'results': {'1': {'id': '1'}}, 'pages': '3', 'message': None},
+        ...     {'results': {'2': {'id': '2'}}, 'pages': 0, 'message': 'Oops'}])
+        >>> merged == {
+        ...     'results': {'1': {'id': '1'}, '2': {'id': '2'}}, 'pages': '3',
+        ...     'message': 'Oops'}
+        True
+        """
+        results = {}
+
+        for page in parsed:
+            results.update(page['results'])
+
+        pages = max((pg['pages'] for pg in parsed), key=int) if parsed else 0
+        messages = [pg['message'] for pg in parsed if pg.get('message')]
+        message = '; '.join(messages) if messages else None
+        return {'results': results, 'pages': pages, 'message': message}
+
 
 class Shopping(Ebay):
     """An eBay Shopping API object"""
 
+    connection = shopping
+
     def __init__(self, **kwargs):
         """Initialization method.
 
@@ -665,14 +1490,15 @@ class Shopping(Ebay):
 
         new = {
             'siteid': self.global_ids[self.kwargs['country']]['countryid'],
-            'domain': domain,
+            'domain': self.domain or domain,
             'uri': '/shopping',
             'version': '873',
             'compatibility': '873',
         }
 
         self.kwargs.update(new)
-        self.api = shopping(**self.kwargs)
+        self.api = self.open()
+        self._idle.append((self.api, monotonic()))
 
     def search(self, options):
         """Search eBay using the Shopping API.
@@ -730,6 +1556,97 @@ class Shopping(Ebay):
         else:
             return self.execute(verb, options)
 
+    def get_items(self, item_ids, selector='Details', max_workers=None):
+        """Get the details of multiple eBay items using GetMultipleItems.
+
+        The item IDs are split into chunks of 20 (the most GetMultipleItems
+        accepts) which are fetched concurrently.
+
+        Parameters
+        ----------
+        item_ids : list of ebay item ids
+        selector : string
+            GetMultipleItems IncludeSelector, e.g., 'Details,ItemSpecifics'
+
+        max_workers : int
+            maximum number of concurrent calls (default: one per chunk)
+
+        Returns
+        -------
+        eBay item details keyed by item id, and the messages of the chunks
+        that failed : dict
+
+        Examples
+        --------
+        >>> finding = Finding()
+        >>> response = finding.search({'keywords': 'lego'})
+        >>> parsed = finding.parse(response)
+        >>> item_ids = list(parsed['results'])
+        >>> shopping = Shopping()
+        >>> response = shopping.get_items(item_ids)
+        >>> set(response) == {'results', 'message'}
+        True
+        >>> set(response['results']) == set(item_ids)
+        True
+        >>> shopping.get_items([]) == {'results': {}, 'message': None}
+        True
+        """
+        item_ids = [str(item_id) for item_id in item_ids]
+        size = MAX_ITEMS_PER_CALL
+        chunks = [item_ids[i:i + size] for i in range(0, len(item_ids), size)]
+        results, messages = {}, []
+
+        def fetch(chunk):
+            data = {'ItemID': chunk, 'IncludeSelector': selector}
+            return self.execute('GetMultipleItems', data)
+
+        # a failed chunk mustn't throw away the chunks that succeeded
+        outcomes = gen_outcomes(bind_context(fetch), chunks, max_workers)
+
+        for chunk, response, err in outcomes:
+            if err:
+                msg = 'Failed to get items {}: {}'
+                messages.append(msg.format(', '.join(chunk), err))
+                continue
+
+            items = response.get('Item') or []
+
+            if hasattr(items, 'update'):  # one result
+                items = [items]
+
+            results.update((str(item['ItemID']), item) for item in items)
+
+            if response.get('message'):
+                messages.append(response['message'])
+
+        message = '; '.join(messages) if messages else None
+        return {'results': results, 'message': message}
+
+    def fetch(self, options):
+        """Calculate an item's shipping cost, i.e., `parse(search(options))`,
+        and add it to the item cache.
+
+        Parameters
+        ----------
+        options : dict
+            see `search`
+
+        Returns
+        -------
+        Cleaned up search results : dict
+        """
+        parsed = self.parse(self.search(dict(options)))
+        results = parsed['results']
+
+        # failed calculations have a message instead of the shipping fields
+        if 'message' not in results:
+            section = get_shipping_section(options)
+            entities = {str(results['item_id']): results}
+            self.item_cache.put(self.kwargs['country'], section, entities)
+
+        return parsed
+
+    @metrics.timed('parse_seconds', api='Shopping', mode='dict')
     def parse(self, response):
         """Convert Shopping search response into a more readable format.
 
@@ -767,16 +1684,217 @@ class Shopping(Ebay):
         deets = response.get('ShippingCostSummary')
 
         if deets:
-            cost = deets['ShippingServiceCost']
-
-            results = {
-                'item_id': item_id,
-                'actual_shipping': float(cost['value'] or 0),
-                'actual_shipping_currency': cost['_currencyID'],
-                'actual_shipping_service': deets['ShippingServiceName'],
-                'actual_shipping_type': deets['ShippingType'],
-            }
+            results = dict(extract_shipping(deets), item_id=item_id)
         else:
             results = {'message': response.get('message'), 'item_id': item_id}
 
         return {'results': results}
+
+
+class ClientRegistry(object):
+    """A registry of long-lived, shareable eBay API clients"""
+
+    def __init__(self, app=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        max_idle_time : seconds a connection may sit idle (default: 300)
+        max_idle : max idle connections per client (default: 16)
+        pool_size : keep-alive connections per host (default: 10)
+        reap_interval : seconds between idle connection reaps (default: 60)
+        max_clients : number of clients kept (the least recently used are
+            closed) (default: 64)
+
+        stream : incrementally parse responses (default: False)
+        domain : API host of every client, e.g., a local stand-in (default:
+            None, i.e., eBay's)
+
+        https : use https (default: True)
+
+        Returns
+        -------
+        New instance of :class:`ClientRegistry` : ClientRegistry
+
+        Examples
+        --------
+        >>> ClientRegistry()  #doctest: +ELLIPSIS
+        <app.api.ClientRegistry object at 0x...>
+        """
+        self.max_idle_time = kwargs.get('max_idle_time', 300)
+        self.max_idle = kwargs.get('max_idle', 16)
+        self.pool_size = kwargs.get('pool_size', 10)
+        self.reap_interval = kwargs.get('reap_interval', 60)
+        self.max_clients = kwargs.get('max_clients', 64)
+        self.stream = kwargs.get('stream', False)
+        self.domain = kwargs.get('domain')
+        self.https = kwargs.get('https', True)
+        self.clients = OrderedDict()
+        self._lock = Lock()
+        self._last_reap = monotonic()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_idle_time = app.config['CLIENT_MAX_IDLE_TIME']
+        self.max_idle = app.config['CLIENT_MAX_IDLE']
+        self.pool_size = app.config['CLIENT_POOL_SIZE']
+        self.reap_interval = app.config['CLIENT_REAP_INTERVAL']
+        self.max_clients = app.config['CLIENT_MAX_CLIENTS']
+        self.stream = app.config['STREAM_RESPONSES']
+        endpoint = (app.config['EBAY_DOMAIN'], app.config['EBAY_HTTPS'])
+
+        # existing clients talk to the old host
+        if endpoint != (self.domain, self.https):
+            self.clear()
+
+        self.domain, self.https = endpoint
+
+    def clear(self):
+        """Close and remove all of the registered clients."""
+        with self._lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+
+        for client in clients:
+            client.close()
+
+    def make_key(self, api_class, **kwargs):
+        """Create the registry key for a client.
+
+        Parameters
+        ----------
+        api_class : the Ebay subclass
+        kwargs : the client's init kwargs
+
+        Returns
+        -------
+        Registry key : tuple
+            credentials are hashed (so they can be shown in stats)
+
+        Examples
+        --------
+        >>> registry = ClientRegistry()
+        >>> registry.make_key(Finding, keywords='lego', verbose=True) == (
+        ...     'Finding', 'US', False, (('verbose', 'True'),))
+        True
+        >>> key = registry.make_key(Finding, token='secret')
+        >>> 'secret' in str(key)
+        False
+        """
+        country = kwargs.get('country', 'US')
+        sandbox = bool(kwargs.get('sandbox'))
+        names = sorted(CLIENT_KWARGS.intersection(kwargs))
+
+        def get_value(name):
+            value = str(kwargs[name])
+            hashed = make_call_key(name, value)[:8]
+            return hashed if name in CREDENTIAL_KWARGS else value
+
+        options = tuple((name, get_value(name)) for name in names)
+        return (api_class.__name__, country, sandbox, options)
+
+    def get(self, api_class, **kwargs):
+        """Get (or create) the shared client for a given configuration.
+
+        Parameters
+        ----------
+        api_class : the Ebay subclass
+        kwargs : the client's init kwargs (non client kwargs are ignored)
+
+        Returns
+        -------
+        eBay API client : Ebay
+
+        Examples
+        --------
+        >>> registry = ClientRegistry()
+        >>> finding = registry.get(Finding, sandbox=True)
+        >>> registry.get(Finding, sandbox=True, keywords='lego') is finding
+        True
+        >>> registry.get(Finding, sandbox=True, country='UK') is finding
+        False
+        >>> registry = ClientRegistry(max_clients=1)
+        >>> finding = registry.get(Finding, sandbox=True)
+        >>> uk_finding = registry.get(Finding, sandbox=True, country='UK')
+        >>> len(registry.clients)
+        1
+        """
+        key = self.make_key(api_class, **kwargs)
+        evicted = []
+
+        with self._lock:
+            client = self.clients.pop(key, None)
+
+            if not client:
+                names = CLIENT_KWARGS.union(['country', 'sandbox'])
+                options = {k: v for k, v in kwargs.items() if k in names}
+                options['pool_size'] = self.pool_size
+                options['stream'] = self.stream
+                options['domain'] = self.domain
+                options['https'] = self.https
+                client = api_class(**options)
+
+            # most recently used last
+            self.clients[key] = client
+
+            while len(self.clients) > self.max_clients:
+                evicted.append(self.clients.popitem(last=False)[1])
+
+        for old in evicted:
+            old.close()
+
+        if monotonic() - self._last_reap > self.reap_interval:
+            self.reap()
+
+        return client
+
+    def reap(self):
+        """Close idle connections of all registered clients.
+
+        Returns
+        -------
+        Number of connections reaped : int
+        """
+        self._last_reap = monotonic()
+        clients = list(self.clients.values())
+        return sum(c.reap(self.max_idle_time, self.max_idle) for c in clients)
+
+    def stats(self):
+        """Get this worker's client statistics.
+
+        Returns
+        -------
+        Client statistics : dict
+
+        Examples
+        --------
+        >>> registry = ClientRegistry()
+        >>> finding = registry.get(Finding, sandbox=True)
+        >>> stats = registry.stats()
+        >>> stats['totals'] == {
+        ...     'clients': 1, 'hits': 0, 'opens': 1, 'reaps': 0, 'idle': 1}
+        True
+        >>> set(stats['clients']) == {'Finding:US:sandbox'}
+        True
+        """
+        totals = {'clients': 0, 'hits': 0, 'opens': 0, 'reaps': 0, 'idle': 0}
+        clients = {}
+
+        for key, client in list(self.clients.items()):
+            mode = 'sandbox' if key[2] else 'live'
+            name = '{}:{}:{}'.format(key[0], key[1], mode)
+
+            if key[3]:
+                name += ':' + ','.join('{}={}'.format(*o) for o in key[3])
+
+            stats = dict(client.stats, idle=len(client._idle))
+            clients[name] = stats
+            totals['clients'] += 1
+
+            for k, v in stats.items():
+                totals[k] += v
+
+        return {'clients': clients, 'totals': totals}
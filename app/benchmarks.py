@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+"""
+    app.benchmarks
+    ~~~~~~~~~~~~~~
+
+    Provides offline micro-benchmarks of the API hot paths
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from datetime import datetime as dt
+from io import BytesIO
+from json import dumps
+from timeit import repeat
+
+from dateutil.parser import parse as du_parse
+from ebaysdk.response import Response, ResponseDataObject
+from flask import Response as FlaskResponse
+from meza import fntools as ft
+
+from app.api import (
+    Andand, Finding, extract_item, extract_category, extract_item_element,
+    extract_category_element, parse_end_time)
+
+from app.stream import parse_stream
+from app.utils import encode, encode_default, make_envelope
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+FINDING_NS = 'http://www.ebay.com/marketplace/search/v1/services'
+TRADING_NS = 'urn:ebay:apis:eBLBaseComponents'
+
+ITEM_XML = (
+    '<item><itemId>{id}</itemId><title>LEGO Star Wars set #{num}</title>'
+    '<globalId>EBAY-US</globalId><primaryCategory><categoryId>19006'
+    '</categoryId><categoryName>LEGO Complete Sets &amp; Packs</categoryName>'
+    '</primaryCategory><galleryURL>http://thumbs.ebaystatic.com/{id}.jpg'
+    '</galleryURL><viewItemURL>http://www.ebay.com/itm/{id}</viewItemURL>'
+    '<paymentMethod>PayPal</paymentMethod><autoPay>false</autoPay>'
+    '<postalCode>606**</postalCode><location>Chicago,IL,USA</location>'
+    '<country>US</country><shippingInfo><shippingServiceCost currencyId="USD">'
+    '{shipping}</shippingServiceCost><shippingType>Flat</shippingType>'
+    '<shipToLocations>Worldwide</shipToLocations><expeditedShipping>true'
+    '</expeditedShipping><handlingTime>1</handlingTime></shippingInfo>'
+    '<sellingStatus><currentPrice currencyId="USD">{price}</currentPrice>'
+    '<convertedCurrentPrice currencyId="USD">{price}</convertedCurrentPrice>'
+    '<sellingState>Active</sellingState><timeLeft>P0DT0H{num}M3S</timeLeft>'
+    '</sellingStatus><listingInfo><bestOfferEnabled>false</bestOfferEnabled>'
+    '<buyItNowAvailable>false</buyItNowAvailable><startTime>'
+    '2017-03-01T22:{minute:02d}:31.000Z</startTime><endTime>'
+    '2017-03-10T22:{minute:02d}:31.000Z</endTime><listingType>FixedPrice'
+    '</listingType><gift>false</gift></listingInfo><returnsAccepted>true'
+    '</returnsAccepted><condition><conditionId>1000</conditionId>'
+    '<conditionDisplayName>New</conditionDisplayName></condition>'
+    '<isMultiVariationListing>false</isMultiVariationListing>'
+    '<topRatedListing>false</topRatedListing></item>')
+
+CATEGORY_XML = (
+    '<Category><BestOfferEnabled>true</BestOfferEnabled><AutoPayEnabled>true'
+    '</AutoPayEnabled><CategoryID>{id}</CategoryID><CategoryLevel>{level}'
+    '</CategoryLevel><CategoryName>Category #{id}</CategoryName>'
+    '<CategoryParentID>{parent}</CategoryParentID><LeafCategory>{leaf}'
+    '</LeafCategory></Category>')
+
+
+def gen_finding_xml(num_items=100):
+    """ Generates a findItemsAdvanced response payload
+
+    Args:
+        num_items (int): The number of items to include (default: 100)
+
+    Returns:
+        (bytes): The XML response
+
+    Examples:
+        >>> gen_finding_xml(2).count(b'<item>')
+        2
+    """
+    items = ''.join(
+        ITEM_XML.format(
+            id=110000000000 + num, num=num, minute=num % 60,
+            price='{:.2f}'.format(10 + num), shipping='{:.2f}'.format(num % 7))
+        for num in range(num_items))
+
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<findItemsAdvancedResponse xmlns="{ns}"><ack>Success</ack>'
+        '<version>1.13.0</version><timestamp>2017-03-10T21:04:31.000Z'
+        '</timestamp><searchResult count="{count}">{items}</searchResult>'
+        '<paginationOutput><pageNumber>1</pageNumber><entriesPerPage>{count}'
+        '</entriesPerPage><totalPages>90</totalPages><totalEntries>9000'
+        '</totalEntries></paginationOutput><itemSearchURL>'
+        'http://www.ebay.com/sch/i.html?_nkw=lego</itemSearchURL>'
+        '</findItemsAdvancedResponse>')
+
+    return xml.format(ns=FINDING_NS, count=num_items, items=items).encode()
+
+
+def gen_categories_xml(num_categories=10000):
+    """ Generates a GetCategories (DetailLevel=ReturnAll) response payload
+
+    Args:
+        num_categories (int): The number of categories to include (default:
+            10000)
+
+    Returns:
+        (bytes): The XML response
+
+    Examples:
+        >>> gen_categories_xml(2).count(b'<Category>')
+        2
+    """
+    categories = ''.join(
+        CATEGORY_XML.format(
+            id=20000 + num, level=1 + num % 4,
+            parent=20000 + num - num % 4, leaf=str(num % 4 == 3).lower())
+        for num in range(num_categories))
+
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<GetCategoriesResponse xmlns="{ns}"><Timestamp>'
+        '2017-03-10T21:04:31.000Z</Timestamp><Ack>Success</Ack><Version>1001'
+        '</Version><Build>E1001_CORE_API_1</Build><CategoryArray>{categories}'
+        '</CategoryArray><CategoryCount>{count}</CategoryCount><UpdateTime>'
+        '2017-02-01T02:00:00.000Z</UpdateTime><CategoryVersion>117'
+        '</CategoryVersion><MinimumReservePrice>0.0</MinimumReservePrice>'
+        '</GetCategoriesResponse>')
+
+    kwargs = {'categories': categories, 'count': num_categories}
+    return xml.format(ns=TRADING_NS, **kwargs).encode()
+
+
+def load_response(xml, verb, list_nodes):
+    """ Converts a payload into a dict the same way `Ebay.execute` does
+
+    Args:
+        xml (bytes): The XML response
+        verb (str): The API call
+        list_nodes (List[str]): The nodes to always convert to lists
+
+    Returns:
+        (dict): The response
+    """
+    obj = ResponseDataObject({'content': xml}, [])
+    response = Response(obj, verb=verb, list_nodes=list_nodes)
+    return response.dict()
+
+
+def load_finding_response(xml):
+    """ Converts a findItemsAdvanced payload the same way `Ebay.execute` does
+
+    Args:
+        xml (bytes): The XML response
+
+    Returns:
+        (dict): The response
+
+    Examples:
+        >>> response = load_finding_response(gen_finding_xml(2))
+        >>> len(response['searchResult']['item'])
+        2
+    """
+    list_nodes = ['finditemsadvancedresponse.searchresult.item']
+    return load_response(xml, 'findItemsAdvanced', list_nodes)
+
+
+def load_categories_response(xml):
+    """ Converts a GetCategories payload the same way `Ebay.execute` does
+
+    Args:
+        xml (bytes): The XML response
+
+    Returns:
+        (dict): The response
+
+    Examples:
+        >>> response = load_categories_response(gen_categories_xml(2))
+        >>> len(response['CategoryArray']['Category'])
+        2
+    """
+    list_nodes = ['getcategoriesresponse.categoryarray.category']
+    return load_response(xml, 'GetCategories', list_nodes)
+
+
+def legacy_end_time(timestamp):
+    """ The original `Finding.parse` end time conversion (for comparison)
+    """
+    date_time = du_parse(timestamp)
+    end_date = date_time.strftime("%Y-%m-%d")
+    end_time = date_time.strftime("%H:%M")
+    offset_years = int(date_time.strftime("%Y")) - 2010
+    year_in_sec = offset_years * 365 * 24 * 60 * 60
+    days_in_sec = int(date_time.strftime("%j")) * 24 * 60 * 60
+    hours_in_sec = int(date_time.strftime("%H")) * 60 * 60
+    minutes_in_sec = int(date_time.strftime("%M")) * 60
+    secs_in_sec = int(date_time.strftime("%S"))
+
+    args = [year_in_sec, days_in_sec, hours_in_sec, minutes_in_sec]
+    args.append(secs_in_sec)
+    return end_date, end_time, sum(args)
+
+
+def legacy_fields(r):
+    """ The original `Finding.parse` Andand field access (for comparison)
+    """
+    return {
+        'id': str(r['itemId']),
+        'url': r['viewItemURL'],
+        'title': r['title'],
+        'condition': Andand(r).condition.conditionDisplayName(),
+        'item_type': r['listingInfo']['listingType'],
+        'price': float(Andand(r).sellingStatus.currentPrice.value(0)),
+        'buy_now_price': float(Andand(r).listingInfo.buyItNowPrice.value(0)),
+        'shipping': float(Andand(r).shippingInfo.shippingServiceCost.value(0)),
+        'timestamp': r['listingInfo']['endTime']}
+
+
+def time_per_item(func, num_items, number=100):
+    """ Times a function and returns the best per item cost
+
+    Args:
+        func (func): The function to time (processes `num_items` items)
+        num_items (int): The number of items `func` processes
+        number (int): The number of times to call `func` per trial
+
+    Returns:
+        (float): Microseconds per item
+    """
+    best = min(repeat(func, number=number, repeat=3))
+    return best * 1e6 / (number * num_items)
+
+
+def gen_parse_benchmarks(num_items=100, number=100):
+    """ Benchmarks the parts of `Finding.parse` over a findItemsAdvanced page
+
+    Args:
+        num_items (int): The number of items per page (default: 100)
+        number (int): The number of times to parse the page per trial
+
+    Yields:
+        (Tuple[str, float]): Benchmark name and microseconds per item
+    """
+    response = load_finding_response(gen_finding_xml(num_items))
+    items = response['searchResult']['item']
+    timestamps = [item['listingInfo']['endTime'] for item in items]
+    finding = Finding(sandbox=True)
+
+    benchmarks = [
+        ('end time (dateutil + strftime)', legacy_end_time, timestamps),
+        ('end time (fast path)', parse_end_time, timestamps),
+        ('fields (Andand)', legacy_fields, items),
+        ('fields (compiled)', extract_item, items)]
+
+    for name, parser, values in benchmarks:
+        func = lambda: [parser(value) for value in values]
+        yield name, time_per_item(func, num_items, number)
+
+    func = lambda: finding.parse(response)
+    yield 'Finding.parse', time_per_item(func, num_items, number)
+
+
+def peak_memory(func):
+    """ Measures the peak memory allocated while calling a function
+
+    Args:
+        func (func): The function to measure
+
+    Returns:
+        (float): Peak allocated memory in KiB (None if tracemalloc isn't
+            available)
+
+    Examples:
+        >>> kib = peak_memory(lambda: [0] * 100000)
+        >>> kib is None or kib > 700
+        True
+    """
+    if not tracemalloc:
+        func()
+        return None
+
+    tracemalloc.start()
+
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return peak / 1024
+
+
+def gen_stream_benchmarks(num_items=100, num_categories=10000, number=10):
+    """ Benchmarks dict conversion (`Ebay.execute` + `parse`) against
+    incremental parsing (`Ebay.stream`) of a Finding page and a full
+    GetCategories response
+
+    Args:
+        num_items (int): The number of items per page (default: 100)
+        num_categories (int): The number of categories (default: 10000)
+        number (int): The number of times to parse each payload per trial
+
+    Yields:
+        (Tuple[str, float, float]): Benchmark name, microseconds per record,
+            and peak memory in KiB (None if it can't be measured)
+    """
+    finding = Finding(sandbox=True)
+    finding_xml = gen_finding_xml(num_items)
+    categories_xml = gen_categories_xml(num_categories)
+
+    def parse_categories(xml):
+        categories = load_categories_response(xml)['CategoryArray']['Category']
+        return [extract_category(c) for c in categories]
+
+    benchmarks = [
+        (
+            'Finding (dict)', num_items,
+            lambda: finding.parse(load_finding_response(finding_xml))),
+        (
+            'Finding (stream)', num_items,
+            lambda: parse_stream(
+                BytesIO(finding_xml), 'searchResult/item',
+                extract_item_element, finding.complete)),
+        (
+            'GetCategories (dict)', num_categories,
+            lambda: parse_categories(categories_xml)),
+        (
+            'GetCategories (stream)', num_categories,
+            lambda: parse_stream(
+                BytesIO(categories_xml), 'CategoryArray/Category',
+                extract_category_element))]
+
+    for name, num_records, func in benchmarks:
+        micros = time_per_item(func, num_records, number)
+        yield name, micros, peak_memory(func)
+
+
+def make_json_response(body):
+    """ Creates a `jsonify` style response (outside of a request)
+    """
+    response = FlaskResponse(body, 200, mimetype='application/json')
+    response.last_modified = dt.utcnow()
+    response.add_etag()
+    return response
+
+
+def gen_encode_benchmarks(num_items=100, number=100):
+    """ Benchmarks JSON encoding of a parsed search page and the size of the
+    cached value: the original pretty printed `CustomEncoder` response
+    (cached as a pickled Response) against the compact encoders (cached as
+    an envelope of the body bytes and headers)
+
+    Args:
+        num_items (int): The number of items per page (default: 100)
+        number (int): The number of times to encode the page per trial
+
+    Yields:
+        (Tuple[str, float, int]): Benchmark name, microseconds per response,
+            and cached value size in bytes
+    """
+    finding = Finding(sandbox=True)
+    parsed = finding.parse(load_finding_response(gen_finding_xml(num_items)))
+    objects = {'objects': parsed, 'status': 'OK'}
+
+    benchmarks = [
+        (
+            'CustomEncoder (indent=2)', lambda: dumps(
+                objects, cls=ft.CustomEncoder, indent=2, sort_keys=True,
+                ensure_ascii=False).encode('utf-8'),
+            lambda body: make_json_response(body)),
+        (
+            'json (compact)', lambda: dumps(
+                objects, default=encode_default, sort_keys=True,
+                separators=(',', ':'), ensure_ascii=False).encode('utf-8'),
+            lambda body: make_envelope(make_json_response(body), 60)),
+        (
+            'encode (compact)', lambda: encode(objects),
+            lambda body: make_envelope(make_json_response(body), 60))]
+
+    for name, func, cached in benchmarks:
+        micros = time_per_item(func, 1, number)
+        yield name, micros, len(pickle.dumps(cached(func()), -1))
+
+
+def run(number=100):
+    """ Runs all the benchmarks and prints the results
+    """
+    for name, micros in gen_parse_benchmarks(number=number):
+        print('{:<40} {:>10.2f} us/item'.format(name, micros))
+
+    for name, micros, size in gen_encode_benchmarks(number=number):
+        msg = '{:<40} {:>10.2f} us/page {:>10} bytes cached'
+        print(msg.format(name, micros, size))
+
+    number = max(number // 10, 1)
+
+    for name, micros, kib in gen_stream_benchmarks(number=number):
+        peak = 'n/a' if kib is None else '{:.0f}'.format(kib)
+        msg = '{:<40} {:>10.2f} us/item {:>10} KiB peak'
+        print(msg.format(name, micros, peak))
@@ -0,0 +1,483 @@
+# -*- coding: utf-8 -*-
+"""
+    app.caches
+    ~~~~~~~~~~
+
+    Provides Flask-Caching backends (a bounded in-process LRU cache and a
+    two-tier cache that puts it in front of memcached) and tag based
+    invalidation
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from collections import OrderedDict, namedtuple
+from hashlib import md5
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+import pygogo as gogo
+
+from flask_caching import backends
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+# remote key whose value changes whenever the cache is cleared
+GENERATION_KEY = 'tiered:generation'
+
+# a remote value and its (wall clock) expiry, so local copies never outlive it
+Entry = namedtuple('Entry', ['expires', 'value'])
+
+# prefix of the keys holding each tag's generation
+TAG_PREFIX = 'tag:'
+
+
+def get_generations(cache, tags):
+    """ Gets the current generation of each tag
+
+    Args:
+        cache (obj): A Flask-Caching cache or backend
+        tags (Iterable[str]): The tags, e.g., ['search', 'country:UK']
+
+    Returns:
+        (dict): The generations keyed by tag (tags that were never
+            invalidated are generation 0)
+
+    Examples:
+        >>> cache = LRUCache()
+        >>> get_generations(cache, ['search']) == {'search': 0}
+        True
+    """
+    tags = sorted(set(tags))
+
+    try:
+        values = cache.get_many(*(TAG_PREFIX + tag for tag in tags))
+    except Exception as err:
+        logger.error('Failed to get tag generations: %s', err)
+        values = [None] * len(tags)
+
+    return {tag: value or 0 for tag, value in zip(tags, values)}
+
+
+def tag_key(key, tags, generations):
+    """ Adds the generations of a key's tags to the key, so invalidating
+    any of the tags makes every key tagged with it unreachable (the stale
+    entries simply expire)
+
+    Args:
+        key (str): The cache key
+        tags (Iterable[str]): The key's tags
+        generations (dict): The current generations (see `get_generations`)
+
+    Returns:
+        (str): The tagged key
+
+    Examples:
+        >>> tags = ['search', 'country:UK']
+        >>> key = tag_key('search:1', tags, {'search': 0, 'country:UK': 0})
+        >>> key.startswith('search:1:')
+        True
+        >>> key == tag_key('search:1', tags, {'search': 0, 'country:UK': 1})
+        False
+    """
+    gens = ','.join(
+        '{}={}'.format(tag, generations[tag]) for tag in sorted(set(tags)))
+
+    return '{}:{}'.format(key, md5(gens.encode('utf-8')).hexdigest()[:12])
+
+
+def invalidate_tag(cache, tag):
+    """ Invalidates every key tagged with `tag` in O(1), i.e., by bumping
+    the tag's generation
+
+    Args:
+        cache (obj): A Flask-Caching cache or backend
+        tag (str): The tag, e.g., 'country:UK'
+
+    Returns:
+        (int): The new generation
+
+    Examples:
+        >>> cache = LRUCache()
+        >>> generation = invalidate_tag(cache, 'search')
+        >>> get_generations(cache, ['search']) == {'search': generation}
+        True
+        >>> invalidate_tag(cache, 'search') == generation + 1
+        True
+    """
+    key = TAG_PREFIX + tag
+
+    try:
+        generation = cache.inc(key)
+    except Exception:
+        generation = None
+
+    if not generation or generation == 1:
+        # memcached can't increment missing keys, and a generation that
+        # restarted at 0 (e.g., after an eviction) could revive old keys, so
+        # start from the current time instead
+        generation = int(time() * 1000)
+        cache.set(key, generation, timeout=0)
+
+    return generation
+
+
+class LRUCache(object):
+    """ A thread safe, size bounded, TTL aware, in-process cache. Values are
+    pickled so callers never share (and mutate) cached objects.
+    """
+    def __init__(self, max_entries=1024, default_timeout=300):
+        """
+        Args:
+            max_entries (int): Maximum number of entries (the least recently
+                used entries are evicted first)
+
+            default_timeout (int): Default entry timeout in seconds (0 means
+                never expire)
+
+        Examples:
+            >>> lru = LRUCache(2)
+            >>> lru.set('a', 1)
+            True
+            >>> lru.set('b', 2)
+            True
+            >>> lru.get('a')
+            1
+            >>> lru.set('c', 3)
+            True
+            >>> lru.get('b') is None
+            True
+            >>> lru.set('d', 4, timeout=-1)
+            True
+            >>> lru.get('d') is None
+            True
+        """
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get_expiry(self, timeout=None):
+        timeout = self.default_timeout if timeout is None else timeout
+        return monotonic() + timeout if timeout else None
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry and entry[0] is not None and entry[0] <= monotonic():
+                entry = None
+
+            if entry:
+                # move to the most recently used end
+                self._entries[key] = entry
+
+        return pickle.loads(entry[1]) if entry else None
+
+    def set(self, key, value, timeout=None, overwrite=True):
+        entry = (self.get_expiry(timeout), pickle.dumps(value, -1))
+
+        with self._lock:
+            existing = self._entries.pop(key, None)
+            live = existing and (
+                existing[0] is None or existing[0] > monotonic())
+
+            if live and not overwrite:
+                self._entries[key] = existing
+                return False
+
+            self._entries[key] = entry
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return True
+
+    def add(self, key, value, timeout=None):
+        return self.set(key, value, timeout, overwrite=False)
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set_many(self, mapping, timeout=None):
+        return all([self.set(k, v, timeout) for k, v in mapping.items()])
+
+    def delete_many(self, *keys):
+        return all([self.delete(key) for key in keys])
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry and entry[0] is not None and entry[0] <= monotonic():
+                entry = None
+
+            # keep the entry's expiry
+            expiry = entry[0] if entry else self.get_expiry()
+            value = (pickle.loads(entry[1]) if entry else 0) + delta
+            self._entries[key] = (expiry, pickle.dumps(value, -1))
+
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TieredCache(object):
+    """ A local LRU cache in front of a shared (remote) cache
+
+    Reads are served locally when possible; remote hits are promoted into
+    the local tier for the lesser of the local timeout and the time the
+    remote entry has left. Writes go to both tiers, locally with a (shorter)
+    local timeout. Counters (ints) are never kept locally, so they can be
+    incremented remotely. Deletes only affect other workers once their local
+    copies expire; clearing the cache changes a remote generation token that
+    every worker polls (at most every `sync_interval` seconds), clearing its
+    local tier when the token changes.
+    """
+    def __init__(self, remote, local=None, local_timeout=60, sync_interval=1):
+        """
+        Args:
+            remote (obj): The shared Flask-Caching backend, e.g., memcached
+            local (obj): The local cache (default: `LRUCache()`)
+            local_timeout (int): Maximum local entry timeout in seconds
+            sync_interval (float): Seconds between remote invalidation checks
+
+        Examples:
+            >>> remote = LRUCache()
+            >>> tiered = TieredCache(remote, sync_interval=0)
+            >>> tiered.set('a', 'x')
+            True
+            >>> tiered.local.delete('a')
+            True
+            >>> tiered.get('a') == 'x'
+            True
+            >>> len(tiered.local)
+            1
+            >>> other = TieredCache(remote, sync_interval=0)
+            >>> other.get('a') == 'x'
+            True
+            >>> remote.set('b', Entry(time() - 1, 'y'))
+            True
+            >>> other.get('b') == 'y'
+            True
+            >>> other.local.get('b') is None
+            True
+            >>> tiered.inc('n')
+            1
+            >>> other.get('n')
+            1
+            >>> other.local.get('n') is None
+            True
+            >>> tiered.clear()
+            True
+            >>> other.get('a') is None
+            True
+        """
+        self.remote = remote
+        self.local = LRUCache() if local is None else local
+        self.local_timeout = local_timeout
+        self.sync_interval = sync_interval
+        self.stats = {'local_hits': 0, 'remote_hits': 0, 'misses': 0}
+        self._generation = None
+        self._last_sync = None
+        self._lock = Lock()
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.stats[name] += num
+
+    def sync(self):
+        """ Clears the local tier if another worker invalidated any keys
+        """
+        now = monotonic()
+
+        if self._last_sync and now - self._last_sync < self.sync_interval:
+            return
+
+        self._last_sync = now
+
+        try:
+            generation = self.remote.get(GENERATION_KEY)
+        except Exception as err:
+            logger.error('Failed to get cache generation: %s', err)
+        else:
+            if generation != self._generation:
+                self.local.clear()
+                self._generation = generation
+
+    def invalidate(self):
+        """ Tells every worker to clear its local tier
+        """
+        self._generation = uuid4().hex
+        self.remote.set(GENERATION_KEY, self._generation, timeout=0)
+
+    def get_local_timeout(self, timeout=None):
+        if timeout:
+            return min(timeout, self.local_timeout)
+        else:
+            return self.local_timeout
+
+    def wrap(self, value, timeout=None):
+        if isinstance(value, int):
+            # memcached can only increment raw counters
+            return value
+
+        if timeout is None:
+            timeout = getattr(self.remote, 'default_timeout', 0)
+
+        return Entry(time() + timeout if timeout else None, value)
+
+    def promote(self, key, value):
+        """ Copies a remote value into the local tier (if its expiry is
+        known) and unwraps it
+        """
+        if not isinstance(value, Entry):
+            return value
+
+        if value.expires is None:
+            timeout = self.local_timeout
+        else:
+            timeout = min(self.local_timeout, value.expires - time())
+
+        if timeout > 0:
+            self.local.set(key, value.value, timeout)
+
+        return value.value
+
+    def set_local(self, mapping, timeout=None):
+        # counters change remotely, so only the remote tier keeps them
+        local = {k: v for k, v in mapping.items() if not isinstance(v, int)}
+        self.local.set_many(local, self.get_local_timeout(timeout))
+
+    def get(self, key):
+        self.sync()
+        value = self.local.get(key)
+
+        if value is None:
+            value = self.remote.get(key)
+
+            if value is None:
+                self.count('misses')
+            else:
+                self.count('remote_hits')
+                value = self.promote(key, value)
+        else:
+            self.count('local_hits')
+
+        return value
+
+    def set(self, key, value, timeout=None):
+        self.set_local({key: value}, timeout)
+        return self.remote.set(key, self.wrap(value, timeout), timeout=timeout)
+
+    def add(self, key, value, timeout=None):
+        entry = self.wrap(value, timeout)
+        added = self.remote.add(key, entry, timeout=timeout)
+
+        if added:
+            self.set_local({key: value}, timeout)
+
+        return added
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def delete(self, key):
+        self.local.delete(key)
+        return self.remote.delete(key)
+
+    def get_many(self, *keys):
+        self.sync()
+        values = dict(zip(keys, self.local.get_many(*keys)))
+        missing = [key for key in keys if values[key] is None]
+        self.count('local_hits', len(keys) - len(missing))
+
+        if missing:
+            fetched = dict(zip(missing, self.remote.get_many(*missing)))
+            found = {
+                k: self.promote(k, v) for k, v in fetched.items()
+                if v is not None}
+
+            self.count('remote_hits', len(found))
+            self.count('misses', len(missing) - len(found))
+            values.update(found)
+
+        return [values[key] for key in keys]
+
+    def get_dict(self, *keys):
+        return dict(zip(keys, self.get_many(*keys)))
+
+    def set_many(self, mapping, timeout=None):
+        self.set_local(mapping, timeout)
+        entries = {k: self.wrap(v, timeout) for k, v in mapping.items()}
+        return self.remote.set_many(entries, timeout=timeout)
+
+    def delete_many(self, *keys):
+        self.local.delete_many(*keys)
+        return self.remote.delete_many(*keys)
+
+    def inc(self, key, delta=1):
+        self.local.delete(key)
+        return self.remote.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        self.local.delete(key)
+        return self.remote.dec(key, delta)
+
+    def clear(self):
+        self.local.clear()
+        cleared = self.remote.clear()
+        self.invalidate()
+        return cleared
+
+
+def lru(app, config, args, kwargs):
+    """ Flask-Caching factory for `LRUCache` (CACHE_TYPE='app.caches.lru')
+    """
+    max_entries = config.get('CACHE_LOCAL_MAX_ENTRIES', 1024)
+    return LRUCache(max_entries, kwargs.get('default_timeout', 300))
+
+
+def tiered(app, config, args, kwargs):
+    """ Flask-Caching factory for `TieredCache`, i.e.,
+    CACHE_TYPE='app.caches.tiered'. CACHE_REMOTE_TYPE names the remote
+    Flask-Caching backend, e.g., 'memcached' or 'saslmemcached'.
+    """
+    remote_factory = getattr(backends, config['CACHE_REMOTE_TYPE'])
+    remote = remote_factory(app, config, args, kwargs)
+    local = lru(app, config, args, kwargs)
+    local_timeout = config.get('CACHE_LOCAL_TIMEOUT', 60)
+    sync_interval = config.get('CACHE_SYNC_INTERVAL', 1)
+    return TieredCache(remote, local, local_timeout, sync_interval)
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+"""
+    app.categories
+    ~~~~~~~~~~~~~~
+
+    Provides in-memory eBay category tree indexes and their on-disk snapshots
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+import sqlite3
+
+from collections import defaultdict
+from contextlib import closing
+from threading import Lock, Thread
+from time import time
+
+import pygogo as gogo
+
+from app.api import Trading
+from app.upstream import scheduler
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+# seconds to wait before retrying a failed build
+RETRY_INTERVAL = 60
+
+SNAPSHOT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    site TEXT PRIMARY KEY, version TEXT, updated REAL);
+CREATE TABLE IF NOT EXISTS categories (
+    site TEXT, pos INTEGER, id TEXT, parent_id TEXT, level TEXT,
+    category TEXT, country TEXT, PRIMARY KEY (site, pos));
+"""
+
+CATEGORY_COLUMNS = ('id', 'parent_id', 'level', 'category', 'country')
+
+
+def normalize(name):
+    """Normalize a category name for lookups.
+
+    Parameters
+    ----------
+    name : string
+
+    Returns
+    -------
+    Normalized name : string
+
+    Examples
+    --------
+    >>> normalize(' Toys & Hobbies ') == 'toys & hobbies'
+    True
+    """
+    return name.strip().lower()
+
+
+def make_site(country='US', sandbox=False):
+    """Create the name of an eBay site.
+
+    Parameters
+    ----------
+    country : string
+    sandbox : bool
+
+    Returns
+    -------
+    Site name : string
+
+    Examples
+    --------
+    >>> make_site('UK', True) == 'UK:sandbox'
+    True
+    """
+    return '{}:{}'.format(country, 'sandbox' if sandbox else 'live')
+
+
+class CategoryIndex(object):
+    """An eBay category tree"""
+
+    def __init__(self, categories, version=None, updated=None):
+        """Initialization method.
+
+        Parameters
+        ----------
+        categories : list
+            a `Trading.fetch_categories` result (the entire tree)
+
+        version : string
+            the tree's eBay CategoryVersion (optional)
+
+        updated : float
+            when the tree was last checked against eBay, in seconds since
+            epoch (default: now)
+
+        Returns
+        -------
+        New instance of :class:`CategoryIndex` : CategoryIndex
+
+        Examples
+        --------
+        >>> CategoryIndex([])  #doctest: +ELLIPSIS
+        <app.categories.CategoryIndex object at 0x...>
+        """
+        self.version = version
+        self.updated = updated or time()
+        self.categories = categories
+        self.nodes = {}
+        self.children = defaultdict(list)
+        self.names = {}
+        self.roots = []
+
+        # shallowest categories win name collisions, e.g., 'Other'
+        for node in sorted(categories, key=lambda c: int(c['level'])):
+            cid, parent_id = node['id'], node['parent_id']
+            self.nodes[cid] = node
+            self.names.setdefault(normalize(node['category']), cid)
+
+            if cid == parent_id:
+                self.roots.append(cid)
+            else:
+                self.children[parent_id].append(cid)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def top_level(self):
+        """Get the top level categories.
+
+        Returns
+        -------
+        Top level categories : list
+
+        Examples
+        --------
+        >>> index = CategoryIndex([
+        ...     {'id': '1', 'parent_id': '1', 'level': '1', 'category': 'A'},
+        ...     {'id': '2', 'parent_id': '1', 'level': '2', 'category': 'B'}])
+        >>> [c['id'] for c in index.top_level()] == ['1']
+        True
+        """
+        return [self.nodes[cid] for cid in self.roots]
+
+    def resolve(self, name):
+        """Get the ID of a category by name.
+
+        Parameters
+        ----------
+        name : string
+            category name (case insensitive)
+
+        Returns
+        -------
+        Category ID (None if not found) : string
+
+        Examples
+        --------
+        >>> index = CategoryIndex([
+        ...     {'id': '1', 'parent_id': '1', 'level': '1', 'category': 'A'}])
+        >>> index.resolve('a') == '1'
+        True
+        >>> index.resolve('b')
+        """
+        return self.names.get(normalize(name))
+
+    def subtree(self, category_id):
+        """Get a category and all its descendants (same as
+        `Trading.fetch_categories(category_id)`).
+
+        Parameters
+        ----------
+        category_id : int or string
+
+        Returns
+        -------
+        Categories in depth first order (empty if not found) : list
+
+        Examples
+        --------
+        >>> index = CategoryIndex([
+        ...     {'id': '3', 'parent_id': '1', 'level': '2', 'category': 'C'},
+        ...     {'id': '1', 'parent_id': '1', 'level': '1', 'category': 'A'},
+        ...     {'id': '4', 'parent_id': '2', 'level': '3', 'category': 'D'},
+        ...     {'id': '2', 'parent_id': '1', 'level': '2', 'category': 'B'}])
+        >>> [c['id'] for c in index.subtree(1)] == ['1', '3', '2', '4']
+        True
+        >>> index.subtree(5)
+        []
+        """
+        category_id = str(category_id)
+        stack = [category_id] if category_id in self.nodes else []
+        result = []
+
+        while stack:
+            cid = stack.pop()
+            result.append(self.nodes[cid])
+            stack.extend(reversed(self.children.get(cid, [])))
+
+        return result
+
+
+class CategorySnapshot(object):
+    """An SQLite store of eBay category trees, shared by all workers"""
+
+    def __init__(self, path):
+        """Initialization method.
+
+        Parameters
+        ----------
+        path : string
+            the database file path (created if missing)
+
+        Returns
+        -------
+        New instance of :class:`CategorySnapshot` : CategorySnapshot
+
+        Examples
+        --------
+        >>> from os import path as p
+        >>> from tempfile import mkdtemp
+        >>> path = p.join(mkdtemp(), 'categories.db')
+        >>> CategorySnapshot(path)  #doctest: +ELLIPSIS
+        <app.categories.CategorySnapshot object at 0x...>
+        """
+        self.path = path
+
+        with closing(self.connect()) as conn:
+            conn.executescript(SNAPSHOT_SCHEMA)
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def sites(self):
+        """Get the sites with a stored category tree.
+
+        Returns
+        -------
+        Site names : list
+        """
+        with closing(self.connect()) as conn:
+            return [row[0] for row in conn.execute('SELECT site FROM sites')]
+
+    def version(self, site):
+        """Get the version of a site's stored category tree.
+
+        Parameters
+        ----------
+        site : string
+            see `make_site`
+
+        Returns
+        -------
+        Category version (None if not stored) : string
+        """
+        query = 'SELECT version FROM sites WHERE site = ?'
+
+        with closing(self.connect()) as conn:
+            row = conn.execute(query, (site,)).fetchone()
+
+        return row[0] if row else None
+
+    def load(self, site):
+        """Load a site's category tree.
+
+        Parameters
+        ----------
+        site : string
+            see `make_site`
+
+        Returns
+        -------
+        Category index (None if not stored) : CategoryIndex
+        """
+        columns = ', '.join(CATEGORY_COLUMNS)
+        query = 'SELECT {} FROM categories WHERE site = ? ORDER BY pos'
+
+        with closing(self.connect()) as conn:
+            sql = 'SELECT version, updated FROM sites WHERE site = ?'
+            row = conn.execute(sql, (site,)).fetchone()
+            rows = conn.execute(query.format(columns), (site,)) if row else []
+            categories = [dict(zip(CATEGORY_COLUMNS, r)) for r in rows]
+
+        return CategoryIndex(categories, *row) if categories else None
+
+    def save(self, site, index):
+        """Store (replace) a site's category tree.
+
+        Parameters
+        ----------
+        site : string
+            see `make_site`
+
+        index : CategoryIndex
+
+        Examples
+        --------
+        >>> from os import path as p
+        >>> from tempfile import mkdtemp
+        >>> snapshot = CategorySnapshot(p.join(mkdtemp(), 'categories.db'))
+        >>> category = {
+        ...     'id': '1', 'parent_id': '1', 'level': '1', 'category': 'A',
+        ...     'country': 'US'}
+        >>> snapshot.save('US:live', CategoryIndex([category], '117'))
+        >>> snapshot.sites() == ['US:live']
+        True
+        >>> index = snapshot.load('US:live')
+        >>> index.version == '117'
+        True
+        >>> index.top_level() == [category]
+        True
+        """
+        rows = (
+            (site, pos) + tuple(c.get(col) for col in CATEGORY_COLUMNS)
+            for pos, c in enumerate(index.categories))
+
+        with closing(self.connect()) as conn, conn:
+            conn.execute('DELETE FROM categories WHERE site = ?', (site,))
+            conn.executemany(
+                'INSERT INTO categories VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.execute(
+                'INSERT OR REPLACE INTO sites VALUES (?, ?, ?)',
+                (site, index.version, index.updated))
+
+    def touch(self, site, updated):
+        """Mark a site's category tree as up to date.
+
+        Parameters
+        ----------
+        site : string
+            see `make_site`
+
+        updated : float
+            seconds since epoch
+        """
+        with closing(self.connect()) as conn, conn:
+            conn.execute(
+                'UPDATE sites SET updated = ? WHERE site = ?', (updated, site))
+
+
+class CategoryIndexes(object):
+    """Per-country category indexes, loaded from a snapshot at startup and
+    refreshed in the background"""
+
+    def __init__(self, app=None, clients=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        clients : ClientRegistry (optional)
+        refresh_interval : seconds before an index is rechecked (default: 86400)
+        snapshot : snapshot file path (default: None, i.e., don't persist)
+
+        Returns
+        -------
+        New instance of :class:`CategoryIndexes` : CategoryIndexes
+
+        Examples
+        --------
+        >>> CategoryIndexes()  #doctest: +ELLIPSIS
+        <app.categories.CategoryIndexes object at 0x...>
+        """
+        self.refresh_interval = kwargs.get('refresh_interval', 86400)
+        self.clients = clients
+        self.indexes = {}
+        self.building = set()
+        self.failed = {}
+        self.snapshot = None
+        self._lock = Lock()
+
+        if kwargs.get('snapshot'):
+            self.load_snapshot(kwargs['snapshot'])
+
+        if app is not None:
+            self.init_app(app, clients)
+
+    def init_app(self, app, clients):
+        self.refresh_interval = app.config['CATEGORY_REFRESH_INTERVAL']
+        self.clients = clients
+
+        if app.config['CATEGORY_SNAPSHOT']:
+            self.load_snapshot(app.config['CATEGORY_SNAPSHOT'])
+
+    def load_snapshot(self, path):
+        """Load all the category indexes stored in a snapshot.
+
+        Parameters
+        ----------
+        path : string
+            the snapshot file path (created if missing)
+        """
+        try:
+            self.snapshot = CategorySnapshot(path)
+
+            for site in self.snapshot.sites():
+                country, mode = site.split(':')
+                self.indexes[(country, mode == 'sandbox')] = (
+                    self.snapshot.load(site))
+        except sqlite3.Error as err:
+            logger.error('Failed to load category snapshot %s: %s', path, err)
+            self.snapshot = None
+
+    def load(self, country='US', sandbox=False):
+        """Get an up to date category index. The full category tree is only
+        downloaded if its CategoryVersion changed.
+
+        Parameters
+        ----------
+        country : string
+        sandbox : bool
+
+        Returns
+        -------
+        Category index : CategoryIndex
+        """
+        site = make_site(country, sandbox)
+        index = self.indexes.get((country, sandbox))
+
+        if not index and self.snapshot:
+            # another worker may have already downloaded this site
+            index = self.snapshot.load(site)
+
+            if index and time() - index.updated < self.refresh_interval:
+                return index
+
+        trading = self.clients.get(Trading, country=country, sandbox=sandbox)
+
+        if index:
+            version = trading.get_category_version()
+
+            if not version:
+                raise ValueError('No {} category version found'.format(site))
+
+            stored = self.snapshot.version(site) if self.snapshot else None
+
+            if version != index.version and version == stored:
+                # another worker already downloaded this version
+                index = self.snapshot.load(site)
+
+            if version == index.version:
+                index.updated = time()
+
+                if self.snapshot:
+                    self.snapshot.touch(site, index.updated)
+
+                return index
+
+        categories, version = trading.fetch_category_tree()
+
+        if not categories:
+            raise ValueError('No {} categories found'.format(site))
+
+        index = CategoryIndex(categories, version)
+
+        if self.snapshot:
+            self.snapshot.save(site, index)
+
+        return index
+
+    def build(self, key):
+        try:
+            with scheduler.priority('background'):
+                index = self.load(*key)
+        except Exception as err:
+            self.failed[key] = time()
+            logger.error('Failed to build %s category index: %s', key[0], err)
+        else:
+            self.failed.pop(key, None)
+            self.indexes[key] = index
+            msg = 'Refreshed %s category index (version %s)'
+            logger.info(msg, key[0], index.version)
+        finally:
+            self.building.discard(key)
+
+    def get(self, country='US', sandbox=False, **kwargs):
+        """Get the category index for a site.
+
+        Never waits on upstream: a missing index is built (and a stale one
+        rebuilt) in a background thread.
+
+        Parameters
+        ----------
+        country : string
+        sandbox : bool
+        kwargs : ignored
+
+        Returns
+        -------
+        Category index (None if it isn't built yet) : CategoryIndex
+
+        Examples
+        --------
+        >>> indexes = CategoryIndexes(clients=object())
+        >>> indexes.get('XX')
+        >>> indexes.building
+        set()
+        """
+        key = (country, bool(sandbox))
+        index = self.indexes.get(key)
+        failed = self.failed.get(key)
+        now = time()
+
+        if index is None:
+            stale = country in Trading.global_ids
+        else:
+            stale = now - index.updated > self.refresh_interval
+
+        # back off after a failed build, whether or not an index exists
+        if failed is not None and now - failed < RETRY_INTERVAL:
+            stale = False
+
+        if stale and key not in self.building and self.clients:
+            with self._lock:
+                start = key not in self.building
+                self.building.add(key)
+
+            if start:
+                thread = Thread(target=self.build, args=(key,))
+                thread.daemon = True
+                thread.start()
+
+        return index
+
+    def stats(self):
+        """Get this worker's category index statistics.
+
+        Returns
+        -------
+        Category index statistics : dict
+
+        Examples
+        --------
+        >>> CategoryIndexes().stats()
+        {}
+        """
+        stats = {}
+
+        for key, index in list(self.indexes.items()):
+            stats[make_site(*key)] = {
+                'categories': len(index), 'version': index.version,
+                'age': round(time() - index.updated)}
+
+        return stats
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+    app.entities
+    ~~~~~~~~~~~~
+
+    Provides a cache of eBay items shared by all endpoints
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+from collections import Counter
+from threading import Lock
+
+import pygogo as gogo
+
+from app.caches import get_generations, tag_key
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+# the `Finding.parse` fields
+SUMMARY = 'summary'
+
+# the `Trading.get_item` fields
+DETAILS = 'details'
+
+
+def get_shipping_section(options):
+    """Get the entity section of a shipping calculation.
+
+    Parameters
+    ----------
+    options : dict
+        `Shopping.search` GetShippingCosts options
+
+    Returns
+    -------
+    Section name : string
+
+    Examples
+    --------
+    >>> section = get_shipping_section({
+    ...     'ItemID': '1', 'DestinationCountryCode': 'US',
+    ...     'DestinationPostalCode': '61605'})
+    >>> section == 'ship:US:61605:1:False'
+    True
+    """
+    return 'ship:{}:{}:{}:{}'.format(
+        options.get('DestinationCountryCode'),
+        options.get('DestinationPostalCode', ''),
+        options.get('QuantitySold', 1),
+        bool(options.get('IncludeDetails')))
+
+
+def project(entity, fields=None):
+    """Select fields from a (merged) entity.
+
+    Parameters
+    ----------
+    entity : dict
+    fields : list of field names (default: None, i.e., all fields)
+
+    Returns
+    -------
+    The selected fields, or None if any are missing : dict
+
+    Examples
+    --------
+    >>> entity = {'id': '1', 'title': 'Lego', 'price': 2.5}
+    >>> project(entity, ['title', 'price']) == {'title': 'Lego', 'price': 2.5}
+    True
+    >>> project(entity, ['title', 'Seller']) is None
+    True
+    """
+    if not fields:
+        return entity
+    elif all(field in entity for field in fields):
+        return {field: entity[field] for field in fields}
+
+
+class ItemCache(object):
+    """Caches what each endpoint learns about an eBay item.
+
+    Items are stored by country and ID in sections, e.g., the search result
+    fields (`SUMMARY`), the item details (`DETAILS`), or a shipping
+    calculation (see `get_shipping_section`). Sections are written blindly,
+    so concurrent writers never need to read-modify-write an entry. Keys are
+    tagged with the item and country (see `app.caches.tag_key`).
+    """
+
+    def __init__(self, app=None, cache=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        cache : Flask-Caching Cache (optional)
+        timeout : entry timeout in seconds (default: 3600)
+
+        Returns
+        -------
+        New instance of :class:`ItemCache` : ItemCache
+
+        Examples
+        --------
+        >>> ItemCache()  #doctest: +ELLIPSIS
+        <app.entities.ItemCache object at 0x...>
+        """
+        self.timeout = kwargs.get('timeout', 3600)
+        self.backend = None
+        self.counts = Counter()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app, cache)
+
+    def init_app(self, app, cache):
+        self.timeout = app.config['ITEM_CACHE_TIMEOUT']
+
+        if app.config['ITEM_CACHE']:
+            with app.app_context():
+                self.backend = cache.cache
+
+    def get_tags(self, country, item_id):
+        return ['country:{}'.format(country), 'item:{}'.format(item_id)]
+
+    def make_key(self, country, item_id, section, generations):
+        key = 'item:{}:{}:{}'.format(country, item_id, section)
+        return tag_key(key, self.get_tags(country, item_id), generations)
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counts[name] += num
+
+    def put(self, country, section, entities):
+        """Cache a section of several items.
+
+        Parameters
+        ----------
+        country : string
+        section : string
+        entities : dict
+            the section fields keyed by item id
+
+        Examples
+        --------
+        >>> from app.caches import LRUCache
+        >>> items = ItemCache()
+        >>> items.backend = LRUCache()
+        >>> items.put('US', SUMMARY, {'1': {'id': '1', 'title': 'Lego'}})
+        >>> items.get('US', '1') == {'id': '1', 'title': 'Lego'}
+        True
+        >>> items.get('UK', '1') is None
+        True
+        """
+        if self.backend is None or not entities:
+            return
+
+        tags = [
+            tag for item_id in entities
+            for tag in self.get_tags(country, item_id)]
+
+        generations = get_generations(self.backend, tags)
+        mapping = {
+            self.make_key(country, item_id, section, generations): fields
+            for item_id, fields in entities.items()}
+
+        try:
+            self.backend.set_many(mapping, timeout=self.timeout)
+        except Exception as err:
+            logger.error('Failed to cache items: %s', err)
+        else:
+            self.count('writes', len(mapping))
+
+    def get(self, country, item_id, sections=(SUMMARY, DETAILS)):
+        """Get an item's cached sections, merged into one dict.
+
+        Parameters
+        ----------
+        country : string
+        item_id : string
+        sections : list of section names (default: summary and details)
+
+        Returns
+        -------
+        The merged sections, or None if none are cached : dict
+
+        Examples
+        --------
+        >>> from app.caches import LRUCache
+        >>> items = ItemCache()
+        >>> items.backend = LRUCache()
+        >>> items.put('US', SUMMARY, {'1': {'title': 'Lego'}})
+        >>> items.put('US', DETAILS, {'1': {'Title': 'Lego'}})
+        >>> items.get('US', '1') == {'title': 'Lego', 'Title': 'Lego'}
+        True
+        >>> items.get('US', '1', [DETAILS]) == {'Title': 'Lego'}
+        True
+        """
+        if self.backend is None:
+            return
+
+        tags = self.get_tags(country, item_id)
+        generations = get_generations(self.backend, tags)
+        keys = [
+            self.make_key(country, item_id, section, generations)
+            for section in sections]
+
+        try:
+            found = [s for s in self.backend.get_many(*keys) if s is not None]
+        except Exception as err:
+            logger.error('Failed to get cached item: %s', err)
+            found = []
+
+        entity = {} if found else None
+
+        for section in found:
+            entity.update(section)
+
+        return entity
+
+    def lookup(self, country, item_id, sections=(SUMMARY, DETAILS),
+               fields=None):
+        """Get an item's cached fields (if they cover the request).
+
+        Parameters
+        ----------
+        country : string
+        item_id : string
+        sections : list of section names (default: summary and details)
+        fields : list of field names (default: None, i.e., all fields of the
+            last section)
+
+        Returns
+        -------
+        The requested fields, or None if they aren't all cached : dict
+
+        Examples
+        --------
+        >>> from app.caches import LRUCache
+        >>> items = ItemCache()
+        >>> items.backend = LRUCache()
+        >>> items.put('US', SUMMARY, {'1': {'title': 'Lego', 'price': 2.5}})
+        >>> items.lookup('US', '1', fields=['title']) == {'title': 'Lego'}
+        True
+        >>> items.lookup('US', '1') is None
+        True
+        >>> items.stats() == {'hits': 1, 'misses': 1, 'writes': 1}
+        True
+        """
+        # without a field list, the entire last section is required
+        entity = self.get(country, item_id, sections if fields else [
+            sections[-1]])
+
+        result = project(entity, fields) if entity else None
+        self.count('misses' if result is None else 'hits')
+        return result
+
+    def stats(self):
+        """Get this worker's item cache statistics.
+
+        Returns
+        -------
+        Item cache statistics : dict
+        """
+        with self._lock:
+            counts = Counter(self.counts)
+
+        return {name: counts[name] for name in ['hits', 'misses', 'writes']}
+
+
+item_cache = ItemCache()
@@ -70,6 +70,17 @@ def gen_params(columns):
             yield param
 
 
+def gen_body(params):
+    excluded = {'name', 'in', 'required'}
+    properties = {
+        param['name']: {k: v for k, v in param.items() if k not in excluded}
+        for param in params}
+
+    return {
+        'in': 'body', 'name': 'body', 'required': True,
+        'schema': {'type': 'object', 'properties': properties}}
+
+
 class Swaggerify(object):
     swagger = {
         'swagger': '2.0',
@@ -190,6 +201,15 @@ class Swaggerify(object):
                     'description': '{tag} operations'.format(**table)}
 
                 self.swagger['tags'].append(tag)
+        elif table['method'] == 'POST':
+            self.swagger['paths'][path]['post'] = {
+                'summary': table.get('desc', 'post {name}'.format(**table)),
+                'tags': [table['tag']] if table.get('tag') else [],
+                'parameters': [gen_body(parameters)],
+                'responses': {
+                    200: {
+                        'description': '{name} result'.format(**table),
+                        'schema': schema}}}
         elif table['method'] == 'DELETE':
             self.swagger['paths'][path]['delete'] = {
                 'summary': table.get('desc', 'delete {name}'.format(**table)),
@@ -17,11 +17,12 @@ from builtins import *  # noqa  # pylint: disable=unused-import
 def gen_tables(view_functions, rule_map, SWAGGER_EXCLUDE_ROUTES=None, **kwargs):
     exclude_routes = SWAGGER_EXCLUDE_ROUTES or {}
     exclude_methods = {'OPTIONS', 'HEAD'}
-    other = {'cached', 'lorem'}
+    other = {'cached', 'lorem', 'stats'}
 
     ftypes = {
-        'search': 'dict', 'ship': 'wrapped', 'item': 'wrapped',
-        'category': 'list', 'sub_category': 'list'}
+        'search': 'dict', 'ship': 'wrapped', 'ship_batch': 'dict',
+        'item': 'wrapped', 'item_batch': 'dict', 'category': 'list',
+        'sub_category': 'list'}
 
     func_filterer = lambda item: item[0] not in exclude_routes
     rule_filterer = lambda rule: 'api' not in str(rule)
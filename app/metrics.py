@@ -0,0 +1,491 @@
+# -*- coding: utf-8 -*-
+"""
+    app.metrics
+    ~~~~~~~~~~~
+
+    Provides Prometheus style metrics (counters and histograms). Each worker
+    periodically writes a snapshot of its metrics to a shared directory, so
+    that any worker can report the totals of all of them.
+
+    The totals only make sense for the workers of one server (e.g., gunicorn)
+    process, so the snapshots are kept in a subdirectory named after it (the
+    workers' parent pid). The subdirectories of servers that are no longer
+    running are removed.
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+import errno
+import os
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from glob import glob
+from json import dump, load
+from os import path as p
+from shutil import rmtree
+from threading import Lock, local
+from uuid import uuid4
+
+import pygogo as gogo
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+NAMESPACE = 'ebay_search_api'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+    30)
+
+# bytes
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# name: (type, description, buckets)
+METRICS = {
+    'upstream_request_seconds': (
+        'histogram', 'eBay API call latency', LATENCY_BUCKETS),
+    'parse_seconds': (
+        'histogram', 'eBay API response parsing time', LATENCY_BUCKETS),
+    'serialize_seconds': (
+        'histogram', 'JSON response serialization time', LATENCY_BUCKETS),
+    'request_seconds': (
+        'histogram', 'API request latency', LATENCY_BUCKETS),
+    'compress_seconds': (
+        'histogram', 'Response compression time', LATENCY_BUCKETS),
+    'response_bytes': ('histogram', 'API response size', SIZE_BUCKETS),
+    'cache_requests_total': (
+        'counter', 'Cache lookups by outcome', None),
+}
+
+
+def format_labels(labels):
+    """ Formats metric labels, e.g., for a sample line
+
+    Args:
+        labels (dict): The label values keyed by name
+
+    Returns:
+        (str): The labels, sorted by name
+
+    Examples:
+        >>> format_labels({'verb': 'findItemsAdvanced', 'country': 'US'})
+        'country="US",verb="findItemsAdvanced"'
+        >>> format_labels({'path': 'a"b'})
+        'path="a\\\\"b"'
+    """
+    def escape(value):
+        value = '{}'.format(value).replace('\\', '\\\\')
+        return value.replace('\n', '\\n').replace('"', '\\"')
+
+    return ','.join(
+        '{}="{}"'.format(name, escape(labels[name])) for name in sorted(labels))
+
+
+def is_running(pid):
+    """ Determines whether a process is running
+
+    Args:
+        pid (int): The process id
+
+    Returns:
+        (bool): True if the process is running
+
+    Examples:
+        >>> is_running(os.getpid())
+        True
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # the process exists, but belongs to another user
+        return err.errno == errno.EPERM
+    else:
+        return True
+
+
+def remove_stale(path):
+    """ Removes the snapshot subdirectories of servers that are no longer
+    running
+
+    Args:
+        path (str): The metrics directory
+
+    Examples:
+        >>> from tempfile import mkdtemp
+        >>> path = mkdtemp()
+        >>> os.makedirs(p.join(path, str(os.getpid())))
+        >>> os.makedirs(p.join(path, '999999999'))
+        >>> remove_stale(path)
+        >>> os.listdir(path) == [str(os.getpid())]
+        True
+        >>> rmtree(path)
+    """
+    for name in os.listdir(path):
+        dirpath = p.join(path, name)
+
+        if name.isdigit() and p.isdir(dirpath) and not is_running(int(name)):
+            rmtree(dirpath, ignore_errors=True)
+
+
+def merge(snapshots):
+    """ Adds up metric snapshots (see `Metrics.snapshot`)
+
+    Args:
+        snapshots (Iter[dict]): The snapshots
+
+    Returns:
+        (dict): The totals
+
+    Examples:
+        >>> snapshot = {'cache_requests_total': {'outcome="hits"': 2}}
+        >>> merge([snapshot, snapshot]) == {
+        ...     'cache_requests_total': {'outcome="hits"': 4}}
+        True
+    """
+    totals = defaultdict(dict)
+
+    for snapshot in snapshots:
+        for name, samples in snapshot.items():
+            for labels, value in samples.items():
+                total = totals[name].get(labels)
+
+                if total is None:
+                    totals[name][labels] = value
+                elif isinstance(value, dict):
+                    totals[name][labels] = {
+                        'buckets': [
+                            a + b for a, b in zip(
+                                total['buckets'], value['buckets'])],
+                        'sum': total['sum'] + value['sum'],
+                        'count': total['count'] + value['count']}
+                else:
+                    totals[name][labels] = total + value
+
+    return dict(totals)
+
+
+def render(snapshot):
+    """ Renders a metrics snapshot in the Prometheus text format
+
+    Args:
+        snapshot (dict): The snapshot (see `Metrics.snapshot`)
+
+    Returns:
+        (str): The metrics
+
+    Examples:
+        >>> metrics = Metrics()
+        >>> metrics.observe('response_bytes', 300, endpoint='search')
+        >>> lines = render(metrics.snapshot()).splitlines()
+        >>> lines[0]
+        '# HELP ebay_search_api_response_bytes API response size'
+        >>> lines[3]
+        'ebay_search_api_response_bytes_bucket{endpoint="search",le="1024"} 1'
+    """
+    lines = []
+
+    def add_sample(name, labels, value):
+        lines.append('{}{} {}'.format(
+            name, '{{{}}}'.format(labels) if labels else '', value))
+
+    for name in sorted(set(snapshot).intersection(METRICS)):
+        kind, description, buckets = METRICS[name]
+        full_name = '{}_{}'.format(NAMESPACE, name)
+        lines.append('# HELP {} {}'.format(full_name, description))
+        lines.append('# TYPE {} {}'.format(full_name, kind))
+
+        for labels, value in sorted(snapshot[name].items()):
+            if kind == 'counter':
+                add_sample(full_name, labels, value)
+                continue
+
+            bucket_name = '{}_bucket'.format(full_name)
+            prefix = '{},'.format(labels) if labels else ''
+            cumulative = 0
+
+            for bound, count in zip(buckets + ('+Inf',), value['buckets']):
+                cumulative += count
+                bucket_labels = '{}le="{}"'.format(prefix, bound)
+                add_sample(bucket_name, bucket_labels, cumulative)
+
+            add_sample('{}_sum'.format(full_name), labels, value['sum'])
+            add_sample('{}_count'.format(full_name), labels, value['count'])
+
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+    """ A thread safe registry of this worker's metrics (see `METRICS`)
+
+    With a `path`, the worker's metrics are written to
+    `<path>/<server pid>/<pid>-<token>.json` (at most every `flush_interval`
+    seconds), and `collect` adds up the metrics of every worker of the same
+    server. The snapshots of workers that exited are kept (until the server
+    exits) so the totals never go down, and the random token keeps a new
+    worker that reuses a pid from overwriting an old worker's snapshot.
+    """
+    def __init__(self, app=None, path=None, flush_interval=5):
+        """
+        Args:
+            app (obj): Flask app (optional)
+            path (str): The directory shared by all workers (default: None,
+                i.e., only report this worker's metrics)
+
+            flush_interval (float): Seconds between snapshot writes
+
+        Examples:
+            >>> metrics = Metrics()
+            >>> metrics.inc('cache_requests_total', outcome='hits')
+            >>> metrics.collect() == {
+            ...     'cache_requests_total': {'outcome="hits"': 1}}
+            True
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+        self.metrics = defaultdict(dict)
+        self._last_flush = None
+        self._owner = None
+        self._context = local()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+
+        if self.path:
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another worker already made it
+                pass
+
+    def inc(self, name, num=1, **labels):
+        """ Increments a counter
+
+        Args:
+            name (str): The metric name, e.g., 'cache_requests_total'
+            num (int): The increment (default: 1)
+            labels (dict): The label values, e.g., {'outcome': 'hits'}
+        """
+        key = format_labels(labels)
+
+        with self._lock:
+            samples = self.metrics[name]
+            samples[key] = samples.get(key, 0) + num
+
+    def observe(self, name, value, **labels):
+        """ Adds an observation to a histogram
+
+        Args:
+            name (str): The metric name, e.g., 'parse_seconds'
+            value (float): The observation
+            labels (dict): The label values, e.g., {'api': 'Finding'}
+        """
+        buckets = METRICS[name][2]
+        key = format_labels(labels)
+        pos = bisect_left(buckets, value)
+        recorder = self.get_recorder()
+
+        with self._lock:
+            if recorder is not None:
+                recorder[name] += value
+
+            samples = self.metrics[name]
+
+            if key not in samples:
+                samples[key] = {
+                    'buckets': [0] * (len(buckets) + 1), 'sum': 0,
+                    'count': 0}
+
+            sample = samples[key]
+            sample['buckets'][pos] += 1
+            sample['sum'] += value
+            sample['count'] += 1
+
+    def get_recorder(self):
+        return getattr(self._context, 'recorder', None)
+
+    def set_recorder(self, recorder):
+        """ Sets the recorder that totals the observations made in this
+        thread, e.g., the time a request spent parsing responses
+
+        Args:
+            recorder (obj): A `collections.Counter` (None stops recording)
+        """
+        self._context.recorder = recorder
+
+    @contextmanager
+    def recording(self, recorder):
+        """ Totals the observations made (in this thread) within the context
+
+        Args:
+            recorder (obj): The `collections.Counter` to add them to (None
+                stops recording)
+
+        Yields:
+            (obj): The recorder
+
+        Examples:
+            >>> from collections import Counter
+            >>> metrics = Metrics()
+            >>> with metrics.recording(Counter()) as recorder:
+            ...     metrics.observe('parse_seconds', 0.5, api='Finding')
+            ...     metrics.observe('parse_seconds', 0.25, api='Shopping')
+            >>> recorder['parse_seconds']
+            0.75
+        """
+        previous = self.get_recorder()
+        self.set_recorder(recorder)
+
+        try:
+            yield recorder
+        finally:
+            self.set_recorder(previous)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ Observes the time spent within the context
+
+        Args:
+            name (str): The metric name, e.g., 'parse_seconds'
+            labels (dict): The label values, e.g., {'api': 'Finding'}
+
+        Examples:
+            >>> metrics = Metrics()
+            >>> with metrics.timer('parse_seconds', api='Finding'):
+            ...     pass
+            >>> metrics.snapshot()['parse_seconds']['api="Finding"']['count']
+            1
+        """
+        start = monotonic()
+
+        try:
+            yield
+        finally:
+            self.observe(name, monotonic() - start, **labels)
+
+    def timed(self, name, **labels):
+        """ Decorates a function so that its calls are timed (see `timer`)
+
+        Args:
+            name (str): The metric name, e.g., 'parse_seconds'
+            labels (dict): The label values, e.g., {'api': 'Finding'}
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def snapshot(self):
+        """ Gets a copy of this worker's metrics
+
+        Returns:
+            (dict): The samples (keyed by their formatted labels) of each
+                metric
+        """
+        with self._lock:
+            return {
+                name: {
+                    labels: dict(value, buckets=list(value['buckets']))
+                    if isinstance(value, dict) else value
+                    for labels, value in samples.items()}
+                for name, samples in self.metrics.items()}
+
+    def get_dirpath(self):
+        # workers are forked after `init_app` (e.g., by `gunicorn --preload`)
+        return p.join(self.path, str(os.getppid()))
+
+    def get_filepath(self):
+        pid = os.getpid()
+
+        if not self._owner or self._owner[0] != pid:
+            self._owner = (pid, uuid4().hex[:8])
+            self.start()
+
+        return p.join(self.get_dirpath(), '{}-{}.json'.format(*self._owner))
+
+    def start(self):
+        """ Prepares this worker's snapshot directory
+        """
+        try:
+            os.makedirs(self.get_dirpath())
+        except OSError:
+            # another worker already made it
+            pass
+
+        try:
+            remove_stale(self.path)
+        except (IOError, OSError) as err:
+            logger.error('Failed to remove stale metrics: %s', err)
+
+    def flush(self):
+        """ Writes this worker's metrics to the shared directory
+        """
+        if not self.path:
+            return
+
+        self._last_flush = monotonic()
+        filepath = self.get_filepath()
+        tmp_path = '{}.tmp'.format(filepath)
+
+        try:
+            with open(tmp_path, 'w') as f:
+                dump(self.snapshot(), f)
+
+            # readers never see a partially written snapshot
+            os.rename(tmp_path, filepath)
+        except (IOError, OSError) as err:
+            logger.error('Failed to write metrics: %s', err)
+
+    def maybe_flush(self):
+        """ Writes this worker's metrics if the last write was more than
+        `flush_interval` seconds ago
+        """
+        last_flush = self._last_flush
+
+        if not last_flush or monotonic() - last_flush >= self.flush_interval:
+            self.flush()
+
+    def gen_snapshots(self):
+        for filepath in glob(p.join(self.get_dirpath(), '*.json')):
+            try:
+                with open(filepath) as f:
+                    yield load(f)
+            except (IOError, OSError, ValueError) as err:
+                logger.error('Failed to read %s: %s', filepath, err)
+
+    def collect(self):
+        """ Gets the metrics of all workers
+
+        Returns:
+            (dict): The total samples (keyed by their formatted labels) of
+                each metric
+        """
+        if self.path:
+            self.flush()
+            return merge(self.gen_snapshots())
+        else:
+            return self.snapshot()
+
+
+metrics = Metrics()
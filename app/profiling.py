@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""
+    app.profiling
+    ~~~~~~~~~~~~~
+
+    Provides on demand request profiling (for admins) and sampling of the
+    slowest requests
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from collections import Counter
+from cProfile import Profile
+from heapq import heappush, heappushpop
+from hmac import compare_digest
+from itertools import count
+from pstats import Stats
+from threading import Lock, local
+
+from app.metrics import metrics
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+# query parameter (or header) that asks for a profile
+PROFILE_ARG = '_profile'
+PROFILE_HEADER = 'X-Profile'
+TOKEN_HEADER = 'X-Profile-Token'
+
+# metric name: phase name
+PHASES = {
+    'upstream_request_seconds': 'ebay',
+    'parse_seconds': 'parse',
+    'serialize_seconds': 'serialize',
+    'compress_seconds': 'compress'}
+
+
+def get_phases(recorder):
+    """ Gets the time a request spent in each phase
+
+    Args:
+        recorder (obj): The request's metrics recorder (see
+            `app.metrics.Metrics.recording`)
+
+    Returns:
+        (dict): Seconds spent by phase. Concurrent upstream calls are all
+            counted, so the phases may add up to more than the request took.
+
+    Examples:
+        >>> get_phases(Counter({'parse_seconds': 0.25})) == {
+        ...     'ebay': 0, 'parse': 0.25, 'serialize': 0, 'compress': 0}
+        True
+    """
+    return {
+        phase: round(recorder[name], 6) for name, phase in PHASES.items()}
+
+
+def get_functions(profile, limit=25):
+    """ Gets the functions a profile spent the most cumulative time in
+
+    Args:
+        profile (obj): A `cProfile.Profile`
+        limit (int): The number of functions
+
+    Returns:
+        (List[dict]): The function, its number of calls, and the (total and
+            cumulative) seconds spent in it
+
+    Examples:
+        >>> profile = Profile()
+        >>> profile.enable()
+        >>> numbers = sorted(range(10))
+        >>> profile.disable()
+        >>> functions = get_functions(profile)
+        >>> set(functions[0]) == {'function', 'calls', 'total', 'cumulative'}
+        True
+    """
+    stats = Stats(profile).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    functions = []
+
+    for (filename, line, name), (_, calls, total, cum, _) in ranked[:limit]:
+        functions.append({
+            'function': '{}:{}({})'.format(filename, line, name),
+            'calls': calls, 'total': round(total, 6),
+            'cumulative': round(cum, 6)})
+
+    return functions
+
+
+class Profiler(object):
+    """ Profiles the requests that ask for it (see `is_requested`), e.g.,
+    `?_profile=1`, from admins that send the `PROFILE_TOKEN` in an
+    `X-Profile-Token` header. Profiled requests get a report of where the
+    time went instead of the usual response. Only the request's own thread
+    is profiled, but the phase breakdown also covers upstream calls made in
+    other threads (see `app.upstream.bind_context`).
+
+    Only one request per process is profiled at a time (others get a report
+    without functions). Under gevent every greenlet shares one thread, so a
+    profile also includes the functions of any requests that ran
+    concurrently, i.e., it is process wide.
+
+    With `slowest`, every request's phases are recorded (without the
+    profiler's overhead), and the slowest requests are kept.
+    """
+    def __init__(self, app=None, token=None, top=25, slowest=0):
+        """
+        Args:
+            app (obj): Flask app (optional)
+            token (str): The admin token (default: None, i.e., profiling is
+                disabled)
+
+            top (int): Number of functions to report
+            slowest (int): Number of slowest requests to keep (default: 0,
+                i.e., don't sample)
+
+        Examples:
+            >>> profiler = Profiler(token='secret')
+            >>> profiler.is_authorized({TOKEN_HEADER: 'secret'})
+            True
+            >>> profiler.is_authorized({TOKEN_HEADER: 'guess'})
+            False
+        """
+        self.token = token
+        self.top = top
+        self.max_slowest = slowest
+        self.slowest = []
+        self._ids = count()
+        self._context = local()
+        self._lock = Lock()
+        self._profiling = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.token = app.config['PROFILE_TOKEN']
+        self.top = app.config['PROFILE_TOP_FUNCTIONS']
+        self.max_slowest = app.config['PROFILE_SLOWEST']
+
+    @property
+    def sampling(self):
+        return bool(self.max_slowest)
+
+    def is_requested(self, args, headers):
+        """ Determines whether a request asked to be profiled
+
+        Args:
+            args (dict): The query parameters
+            headers (dict): The request headers
+
+        Returns:
+            (bool): True if the request should be profiled
+
+        Examples:
+            >>> profiler = Profiler()
+            >>> profiler.is_requested({PROFILE_ARG: '1'}, {})
+            True
+            >>> profiler.is_requested({}, {PROFILE_HEADER: 'false'})
+            False
+        """
+        value = args.get(PROFILE_ARG) or headers.get(PROFILE_HEADER) or ''
+        return value.lower() not in {'', '0', 'false', 'no'}
+
+    def is_authorized(self, headers):
+        given = headers.get(TOKEN_HEADER) or ''
+        valid = self.token or ''
+        return bool(valid) and compare_digest(
+            given.encode('utf-8'), valid.encode('utf-8'))
+
+    def start(self, profile=False):
+        """ Starts timing (and optionally profiling) the current request
+
+        Args:
+            profile (bool): Run the profiler (unless another request is being
+                profiled)
+        """
+        self._context.start = monotonic()
+        self._context.recorder = Counter()
+        self._context.requested = profile
+        self._context.profile = None
+        metrics.set_recorder(self._context.recorder)
+
+        if profile and self._profiling.acquire(False):
+            self._context.profile = Profile()
+
+            try:
+                # python 3.12+ refuses to enable two profilers at once
+                self._context.profile.enable()
+            except ValueError:
+                self._context.profile = None
+                self._profiling.release()
+
+    def stop(self):
+        """ Stops timing (and profiling) the current request
+
+        Returns:
+            (dict): The request's elapsed time and phases (and functions if
+                it asked to be profiled, None if another request was being
+                profiled), or None if it wasn't being timed
+
+        Examples:
+            >>> profiler = Profiler()
+            >>> profiler.start(profile=True)
+            >>> report = profiler.stop()
+            >>> set(report) == {'elapsed', 'phases', 'functions'}
+            True
+            >>> profiler.stop() is None
+            True
+            >>> with profiler._profiling:
+            ...     profiler.start(profile=True)
+            ...     profiler.stop()['functions'] is None
+            True
+        """
+        start = getattr(self._context, 'start', None)
+
+        if start is None:
+            return
+
+        profile = self._context.profile
+
+        if profile:
+            profile.disable()
+            self._profiling.release()
+
+        metrics.set_recorder(None)
+        elapsed = monotonic() - start
+        phases = get_phases(self._context.recorder)
+        self._context.start = self._context.recorder = None
+        self._context.profile = None
+
+        report = {'elapsed': round(elapsed, 6), 'phases': phases}
+
+        if profile:
+            report['functions'] = get_functions(profile, self.top)
+        elif self._context.requested:
+            report['functions'] = None
+
+        return report
+
+    def record(self, report, **info):
+        """ Keeps a request's report if it is one of the slowest
+
+        Args:
+            report (dict): The request's report (see `stop`)
+            info (dict): Other request details, e.g., its url
+
+        Examples:
+            >>> profiler = Profiler(slowest=2)
+            >>> for elapsed in [1, 3, 2]:
+            ...     profiler.record({'elapsed': elapsed})
+            >>> [r['elapsed'] for r in profiler.get_slowest()]
+            [3, 2]
+        """
+        if not self.sampling:
+            return
+
+        entry = (report['elapsed'], next(self._ids), dict(report, **info))
+
+        with self._lock:
+            if len(self.slowest) < self.max_slowest:
+                heappush(self.slowest, entry)
+            else:
+                heappushpop(self.slowest, entry)
+
+    def get_slowest(self):
+        """ Gets the slowest requests (of this worker)
+
+        Returns:
+            (List[dict]): The requests' reports, slowest first
+        """
+        with self._lock:
+            slowest = sorted(self.slowest, reverse=True)
+
+        return [entry[2] for entry in slowest]
+
+
+profiler = Profiler()
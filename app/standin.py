@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+    app.standin
+    ~~~~~~~~~~~
+
+    Provides a local stand-in for the eBay Finding, Shopping, and Trading
+    APIs. In record mode, calls are forwarded to eBay and the exchanges are
+    saved as fixtures. In replay mode, the fixtures are served (with optional
+    latency, errors, and throttling), so load tests and benchmarks don't need
+    network access.
+
+    Point the clients at it with, e.g.,
+    `Finding(domain='localhost:8089', https=False)` (or the `EBAY_DOMAIN` and
+    `EBAY_HTTPS` settings).
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+import os
+import re
+
+from collections import defaultdict, deque
+from datetime import datetime as dt
+from glob import glob
+from hashlib import sha1
+from json import dump, load
+from os import path as p
+from random import Random
+from threading import Lock
+from time import sleep
+from xml.sax.saxutils import escape
+
+import pygogo as gogo
+
+from requests import Session
+from requests.exceptions import RequestException
+from werkzeug.wrappers import Request, Response
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+RECORD, REPLAY = 'record', 'replay'
+
+FINDING_NS = 'http://www.ebay.com/marketplace/search/v1/services'
+TRADING_NS = 'urn:ebay:apis:eBLBaseComponents'
+CONTENT_TYPE = 'text/xml;charset=UTF-8'
+
+# uri: (api, verb header, site header)
+APIS = {
+    '/services/search/FindingService/v1': (
+        'Finding', 'X-EBAY-SOA-OPERATION-NAME', 'X-EBAY-SOA-GLOBAL-ID'),
+    '/shopping': ('Shopping', 'X-EBAY-API-CALL-NAME', 'X-EBAY-API-SITE-ID'),
+    '/ws/api.dll': ('Trading', 'X-EBAY-API-CALL-NAME', 'X-EBAY-API-SITEID'),
+}
+
+# api: (live domain, sandbox domain)
+DOMAINS = {
+    'Finding': ('svcs.ebay.com', 'svcs.sandbox.ebay.com'),
+    'Shopping': ('open.api.ebay.com', 'open.api.sandbox.ebay.com'),
+    'Trading': ('api.ebay.com', 'api.sandbox.ebay.com'),
+}
+
+# api: the error code eBay uses when a call limit is reached (see
+# `app.upstream.THROTTLE_ERRORS`)
+THROTTLE_CODES = {'Finding': '10001', 'Shopping': '1.23', 'Trading': '518'}
+
+# the error code of calls that have no fixture
+MISSING_CODE = '404'
+
+# request headers forwarded to eBay (in record mode)
+FORWARD_HEADERS = ('Content-Type', 'User-Agent')
+
+CREDENTIALS = re.compile(
+    r'<RequesterCredentials>.*?</RequesterCredentials>', re.DOTALL)
+
+FINDING_ERROR = (
+    '<?xml version="1.0" encoding="UTF-8"?><{verb}Response xmlns="{ns}">'
+    '<ack>Failure</ack><errorMessage><error><errorId>{code}</errorId>'
+    '<domain>Marketplace</domain><severity>Error</severity><category>System'
+    '</category><message>{message}</message><subdomain>Search</subdomain>'
+    '</error></errorMessage><version>1.13.0</version><timestamp>{timestamp}'
+    '</timestamp></{verb}Response>')
+
+TRADING_ERROR = (
+    '<?xml version="1.0" encoding="UTF-8"?><{verb}Response xmlns="{ns}">'
+    '<Timestamp>{timestamp}</Timestamp><Ack>Failure</Ack><Errors>'
+    '<ShortMessage>{message}</ShortMessage><LongMessage>{message}'
+    '</LongMessage><ErrorCode>{code}</ErrorCode><SeverityCode>Error'
+    '</SeverityCode><ErrorClassification>RequestError</ErrorClassification>'
+    '</Errors><Version>861</Version></{verb}Response>')
+
+
+def normalize(body):
+    """ Removes the parts of a request body that don't affect the response,
+    i.e., credentials and whitespace between tags
+
+    Args:
+        body (bytes): The request body
+
+    Returns:
+        (str): The normalized body
+
+    Examples:
+        >>> normalize(
+        ...     b'<a>\\n  <RequesterCredentials><eBayAuthToken>secret'
+        ...     b'</eBayAuthToken></RequesterCredentials>\\n  <b>1</b></a>')
+        '<a><b>1</b></a>'
+    """
+    text = body.decode('utf-8', 'replace') if hasattr(body, 'decode') else body
+    text = CREDENTIALS.sub('', text)
+    return re.sub(r'>\s+<', '><', text).strip()
+
+
+def get_key(api, verb, site, body):
+    """ Identifies an exchange (and its fixture)
+
+    Args:
+        api (str): The API name, e.g., 'Finding'
+        verb (str): The call name, e.g., 'findItemsAdvanced'
+        site (str): The eBay site, e.g., 'EBAY-US'
+        body (bytes): The request body
+
+    Returns:
+        (str): The key
+
+    Examples:
+        >>> key = get_key('Finding', 'findItemsAdvanced', 'EBAY-US', b'<a/>')
+        >>> len(key)
+        16
+        >>> key == get_key('Finding', 'findItemsAdvanced', 'EBAY-GB', b'<a/>')
+        False
+    """
+    parts = [api, verb, site or '', normalize(body)]
+    return sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def make_error(api, verb, code, message):
+    """ Creates an eBay style failure response
+
+    Args:
+        api (str): The API name, e.g., 'Finding'
+        verb (str): The call name, e.g., 'findItemsAdvanced'
+        code (str): The eBay error code
+        message (str): The error message
+
+    Returns:
+        (bytes): The XML response
+
+    Examples:
+        >>> xml = make_error('Trading', 'GetItem', '518', 'Limit reached')
+        >>> b'<ErrorCode>518</ErrorCode>' in xml
+        True
+    """
+    template = FINDING_ERROR if api == 'Finding' else TRADING_ERROR
+    ns = FINDING_NS if api == 'Finding' else TRADING_NS
+    timestamp = dt.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    xml = template.format(
+        verb=verb, ns=ns, code=code, message=escape(message),
+        timestamp=timestamp)
+
+    return xml.encode('utf-8')
+
+
+class StandIn(object):
+    """ A WSGI app that speaks the eBay Finding, Shopping, and Trading XML
+    protocols (see `app.api`)
+
+    Fixtures are stored as `<path>/<api>/<verb>/<key>.json`. In replay mode,
+    a call without a fixture of its own gets one recorded for the same verb
+    (unless `strict`), or else an eBay failure response.
+    """
+    def __init__(self, path, mode=REPLAY, sandbox=False, **kwargs):
+        """
+        Args:
+            path (str): The fixtures directory
+            mode (str): One of 'record' or 'replay' (default: 'replay')
+            sandbox (bool): Record from the eBay sandbox
+
+        Kwargs:
+            latency (float): Seconds added to each replayed call (default: 0)
+            jitter (float): Max random seconds added to `latency` (default: 0)
+            error_rate (float): Share of calls that fail with `error_status`
+                (default: 0)
+
+            error_status (int): HTTP status of injected errors (default: 503)
+            throttle_rate (float): Share of calls refused with eBay's call
+                limit error (default: 0)
+
+            calls_per_second (int): Calls per second allowed before the rest
+                are refused with eBay's call limit error (default: None,
+                i.e., unlimited)
+
+            strict (bool): Don't serve fixtures recorded for other requests
+            seed (int): Seed for the injected faults (default: None)
+            timeout (float): Seconds to wait for eBay (in record mode)
+
+        Examples:
+            >>> from tempfile import mkdtemp
+            >>> from werkzeug.test import Client
+            >>> standin = StandIn(mkdtemp(), strict=True)
+            >>> response = Client(standin).post(
+            ...     '/shopping', data='<a/>',
+            ...     headers={'X-EBAY-API-CALL-NAME': 'GetMultipleItems'})
+            >>> b'<ErrorCode>404</ErrorCode>' in response.get_data()
+            True
+            >>> standin.stats['missing']
+            1
+        """
+        self.path = path
+        self.mode = mode
+        self.sandbox = sandbox
+        self.latency = kwargs.get('latency', 0)
+        self.jitter = kwargs.get('jitter', 0)
+        self.error_rate = kwargs.get('error_rate', 0)
+        self.error_status = kwargs.get('error_status', 503)
+        self.throttle_rate = kwargs.get('throttle_rate', 0)
+        self.calls_per_second = kwargs.get('calls_per_second')
+        self.strict = kwargs.get('strict', False)
+        self.timeout = kwargs.get('timeout', 20)
+        self.random = Random(kwargs.get('seed'))
+        self.session = Session()
+        self.fixtures = {}
+        self.by_verb = defaultdict(list)
+        self.stats = defaultdict(int)
+        self._calls = deque()
+        self._lock = Lock()
+        self.load()
+
+    def __call__(self, environ, start_response):
+        request = Request(environ)
+        response = self.handle(request)
+        return response(environ, start_response)
+
+    def get_filepath(self, api, verb, key):
+        return p.join(self.path, api, verb, '{}.json'.format(key))
+
+    def load(self):
+        """ Loads the recorded fixtures
+
+        Returns:
+            (int): The number of fixtures
+        """
+        for filepath in sorted(glob(p.join(self.path, '*', '*', '*.json'))):
+            try:
+                with open(filepath) as f:
+                    fixture = load(f)
+            except (IOError, OSError, ValueError) as err:
+                logger.error('Failed to read %s: %s', filepath, err)
+            else:
+                self.add(fixture)
+
+        return len(self.fixtures)
+
+    def add(self, fixture):
+        api, verb = fixture['api'], fixture['verb']
+
+        with self._lock:
+            if fixture['key'] not in self.fixtures:
+                self.by_verb[(api, verb)].append(fixture)
+
+            self.fixtures[fixture['key']] = fixture
+
+    def save(self, fixture):
+        """ Saves a recorded exchange
+
+        Args:
+            fixture (dict): The exchange
+        """
+        filepath = self.get_filepath(
+            fixture['api'], fixture['verb'], fixture['key'])
+
+        try:
+            os.makedirs(p.dirname(filepath))
+        except OSError:
+            # it already exists
+            pass
+
+        with open(filepath, 'w') as f:
+            dump(fixture, f, indent=2, sort_keys=True)
+
+        self.add(fixture)
+
+    def handle(self, request):
+        """ Responds to an eBay API call
+
+        Args:
+            request (obj): The werkzeug request
+
+        Returns:
+            (obj): The werkzeug response
+        """
+        endpoint = APIS.get(request.path)
+
+        if not endpoint:
+            return Response('Unknown API', status=404)
+
+        api, verb_header, site_header = endpoint
+        verb = request.headers.get(verb_header, '')
+        site = request.headers.get(site_header, '')
+        body = request.get_data()
+        key = get_key(api, verb, site, body)
+
+        with self._lock:
+            self.stats['calls'] += 1
+
+        if self.mode == RECORD:
+            return self.record(request, api, verb, key, body)
+        else:
+            return self.replay(api, verb, key)
+
+    def record(self, request, api, verb, key, body):
+        """ Forwards a call to eBay and saves the exchange
+        """
+        domain = DOMAINS[api][1 if self.sandbox else 0]
+        url = 'https://{}{}'.format(domain, request.path)
+        names = set(APIS[request.path][1:]).union(FORWARD_HEADERS)
+        headers = {
+            k: v for k, v in request.headers.items()
+            if k in names or k.upper().startswith('X-EBAY-')}
+
+        start = monotonic()
+
+        try:
+            r = self.session.post(
+                url, data=body, headers=headers, timeout=self.timeout)
+        except RequestException as err:
+            logger.error('Failed to forward %s %s: %s', api, verb, err)
+            return self.count(Response('Bad Gateway', status=502), 'errors')
+
+        fixture = {
+            'api': api, 'verb': verb, 'key': key,
+            'request': normalize(body), 'status': r.status_code,
+            'content_type': r.headers.get('Content-Type', CONTENT_TYPE),
+            'elapsed': round(monotonic() - start, 6),
+            'body': r.content.decode('utf-8', 'replace')}
+
+        # only the failures that are meant to be replayed are recorded
+        if r.status_code < 500:
+            self.save(fixture)
+            self.count(None, 'recorded')
+
+        return self.make_response(fixture)
+
+    def replay(self, api, verb, key):
+        """ Serves the fixture of a call (or an injected fault)
+        """
+        delay = self.latency + self.random.uniform(0, self.jitter)
+
+        if delay:
+            sleep(delay)
+
+        if self.random.random() < self.error_rate:
+            response = Response('Injected error', status=self.error_status)
+            return self.count(response, 'errors')
+
+        if self.is_throttled():
+            code = THROTTLE_CODES[api]
+            xml = make_error(api, verb, code, 'Call limit reached')
+            response = Response(xml, content_type=CONTENT_TYPE)
+            return self.count(response, 'throttled')
+
+        fixture = self.find(api, verb, key)
+
+        if fixture:
+            return self.count(self.make_response(fixture), 'replayed')
+
+        logger.warning('No fixture for %s %s (%s)', api, verb, key)
+        message = 'No fixture for {} ({})'.format(verb, key)
+        xml = make_error(api, verb, MISSING_CODE, message)
+        response = Response(xml, content_type=CONTENT_TYPE)
+        return self.count(response, 'missing')
+
+    def find(self, api, verb, key):
+        fixture = self.fixtures.get(key)
+
+        if not (fixture or self.strict):
+            fixtures = self.by_verb.get((api, verb)) or [None]
+            fixture = fixtures[int(key, 16) % len(fixtures)]
+
+        return fixture
+
+    def is_throttled(self):
+        """ Determines whether a call should be refused for exceeding a call
+        limit
+
+        Returns:
+            (bool): True if the call should be refused
+        """
+        if self.random.random() < self.throttle_rate:
+            return True
+
+        if not self.calls_per_second:
+            return False
+
+        now = monotonic()
+
+        with self._lock:
+            while self._calls and now - self._calls[0] >= 1:
+                self._calls.popleft()
+
+            throttled = len(self._calls) >= self.calls_per_second
+
+            if not throttled:
+                self._calls.append(now)
+
+        return throttled
+
+    def make_response(self, fixture):
+        return Response(
+            fixture['body'], status=fixture['status'],
+            content_type=fixture['content_type'])
+
+    def count(self, response, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+        return response
+
+
+def serve(standin, host='127.0.0.1', port=8089):
+    """ Serves a stand-in (with a thread per request)
+
+    Args:
+        standin (obj): The `StandIn`
+        host (str): The host to listen on
+        port (int): The port to listen on
+    """
+    from werkzeug.serving import run_simple
+
+    logger.info(
+        'Serving %s fixtures from %s on %s:%s (%s mode)',
+        len(standin.fixtures), standin.path, host, port, standin.mode)
+
+    run_simple(host, port, standin, threaded=True)
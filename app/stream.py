@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+    app.stream
+    ~~~~~~~~~~
+
+    Provides incremental (iterparse based) eBay XML response parsers
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+from xml.etree.ElementTree import iterparse
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+# response summary fields (path: name) common to the Finding, Shopping, and
+# Trading APIs
+SUMMARY_PATHS = {
+    'ack': 'ack',
+    'Ack': 'ack',
+    'timestamp': 'timestamp',
+    'Timestamp': 'timestamp',
+    'paginationOutput/totalPages': 'pages',
+    'errorMessage/error/message': 'message',
+    'errorMessage/error/errorId': 'code',
+    'Errors/ShortMessage': 'message',
+    'Errors/ErrorCode': 'code',
+    'CategoryVersion': 'version',
+}
+
+
+def compile_element_path(path, default=None, convert=None):
+    """ Compiles a `compile_path` style dotted path into an element getter
+
+    ebaysdk turns elements with attributes into dicts, e.g.,
+    `{'_currencyID': 'USD', 'value': '2.5'}`, so a trailing 'value' refers to
+    the element text and a trailing '_name' to the element attribute 'name'.
+
+    Args:
+        path (str): The dotted path, e.g., 'sellingStatus.currentPrice.value'
+        default (obj): Value to return if the path is missing or empty
+        convert (func): Function applied to found values, e.g., `float`
+
+    Returns:
+        (func): getter
+
+    Examples:
+        >>> from xml.etree.ElementTree import fromstring
+        >>> xml = '<item><price currencyID="USD">2.5</price></item>'
+        >>> price = compile_element_path('price.value', 0.0, float)
+        >>> price(fromstring(xml))
+        2.5
+        >>> currency = compile_element_path('price._currencyID')
+        >>> currency(fromstring(xml)) == 'USD'
+        True
+        >>> compile_element_path('shipping.value', 0.0)(fromstring(xml))
+        0.0
+    """
+    keys = path.split('.')
+    attr = None
+
+    if keys[-1] == 'value':
+        keys.pop()
+    elif keys[-1].startswith('_'):
+        attr = keys.pop()[1:]
+
+    xpath = '/'.join(keys)
+
+    def getter(elem):
+        node = elem.find(xpath)
+
+        if node is None:
+            return default
+
+        value = node.get(attr) if attr else node.text
+
+        if not value:
+            return default
+
+        return convert(value) if convert else value
+
+    return getter
+
+
+def compile_element_fields(fields):
+    """ Compiles `compile_fields` style field specs into an element extractor
+
+    Args:
+        fields (List[tuple]): (name, path[, default[, convert]]) specs
+
+    Returns:
+        (func): extractor
+    """
+    getters = tuple(
+        (field[0], compile_element_path(*field[1:])) for field in fields)
+
+    def extract(elem):
+        return {name: getter(elem) for name, getter in getters}
+
+    # identifies the extractor, e.g., in upstream call keys
+    extract.spec = tuple(tuple(field[:2]) for field in fields)
+    return extract
+
+
+def parse_stream(source, record_path, extract, transform=None):
+    """ Incrementally parses an eBay XML response into records
+
+    Only the elements at `record_path` (and the summary fields) are kept;
+    each record is discarded from the tree as soon as it has been extracted.
+
+    Args:
+        source (file): A file like object containing the XML response
+        record_path (str): Path (relative to the root) of the record elements,
+            e.g., 'searchResult/item'
+
+        extract (func): Converts a record element into a dict (see
+            `compile_element_fields`)
+
+        transform (func): Function applied to each extracted record
+
+    Returns:
+        (Tuple[List[dict], dict]): the records and the response summary
+
+    Examples:
+        >>> from io import BytesIO
+        >>> xml = (
+        ...     b'<findItemsAdvancedResponse xmlns="urn:x"><ack>Success</ack>'
+        ...     b'<searchResult><item><title>a</title></item><item><title>b'
+        ...     b'</title></item></searchResult><paginationOutput><totalPages>'
+        ...     b'7</totalPages></paginationOutput>'
+        ...     b'</findItemsAdvancedResponse>')
+        >>> extract = compile_element_fields([('title', 'title')])
+        >>> records, summary = parse_stream(
+        ...     BytesIO(xml), 'searchResult/item', extract)
+        >>> [r['title'] for r in records] == ['a', 'b']
+        True
+        >>> summary == {'ack': 'Success', 'pages': '7'}
+        True
+    """
+    records, summary, path, elems = [], {}, [], []
+
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag.rpartition('}')[2])
+            elems.append(elem)
+            continue
+
+        elem.tag = path[-1]
+        joined = '/'.join(path[1:])
+
+        if joined == record_path:
+            record = extract(elem)
+            records.append(transform(record) if transform else record)
+            elems[-2].remove(elem)
+        elif joined in SUMMARY_PATHS:
+            summary.setdefault(SUMMARY_PATHS[joined], elem.text)
+
+        path.pop()
+        elems.pop()
+
+    return records, summary
@@ -6,19 +6,60 @@
     Provides unit tests for the website.
 """
 
-from json import loads
+from json import dumps, loads
+from threading import Thread
 
 import pytest
 
-from app import create_app
+from werkzeug.serving import make_server
+
+from app import create_app, clients, item_cache
+from app.api import Finding, Shopping
+from app.benchmarks import gen_finding_xml
+from app.entities import get_shipping_section
+from app.standin import StandIn, TRADING_NS
+from app.upstream import resilience, Unavailable
+from app.views import BATCH_MAX_ITEMS, get_batch
 
 JSON = 'application/json'
+CREDENTIALS = [
+    'EBAY_LIVE_APP_ID', 'EBAY_DEV_ID', 'EBAY_LIVE_CERT_ID', 'EBAY_LIVE_TOKEN']
+
+ITEM_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><GetItemResponse xmlns="{}">'
+    '<Ack>Success</Ack><Item><ItemID>110000000001</ItemID><ListingDetails>'
+    '<ViewItemURL>http://www.ebay.com/itm/110000000001</ViewItemURL>'
+    '<EndTime>2017-03-10T22:04:31.000Z</EndTime></ListingDetails>'
+    '<Title>LEGO Star Wars</Title><ListingType>FixedPriceItem</ListingType>'
+    '<SellingStatus><CurrentPrice currencyID="USD">12.5</CurrentPrice>'
+    '</SellingStatus><ShippingDetails><ShippingServiceOptions>'
+    '<ShippingServiceCost currencyID="USD">3.0</ShippingServiceCost>'
+    '</ShippingServiceOptions></ShippingDetails></Item></GetItemResponse>')
+
+SHIPPING_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><GetShippingCostsResponse '
+    'xmlns="{}"><Ack>Success</Ack><CorrelationID>{}</CorrelationID>'
+    '<ShippingCostSummary><ShippingServiceName>'
+    'USPS Priority</ShippingServiceName><ShippingServiceCost currencyID="USD">'
+    '3.5</ShippingServiceCost><ShippingType>Flat</ShippingType>'
+    '</ShippingCostSummary></GetShippingCostsResponse>')
+
+ITEMS_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?><GetMultipleItemsResponse '
+    'xmlns="{}"><Ack>Success</Ack><Item><ItemID>{}</ItemID><Title>LEGO Star '
+    'Wars</Title></Item></GetMultipleItemsResponse>')
 
 
 def get_json(resp):
     return loads(resp.get_data(as_text=True))
 
 
+def add_fixture(standin, api, verb, body, status=200):
+    standin.add({
+        'api': api, 'verb': verb, 'key': '{}:{}'.format(api, verb),
+        'status': status, 'content_type': 'text/xml', 'body': body})
+
+
 @pytest.fixture
 def client(request):
     app = create_app(config_mode='Test')
@@ -27,6 +68,36 @@ def client(request):
     return client
 
 
+@pytest.fixture
+def standin(tmpdir, monkeypatch):
+    for name in CREDENTIALS:
+        monkeypatch.setenv(name, 'standin')
+
+    standin = StandIn(str(tmpdir))
+    server = make_server('127.0.0.1', 0, standin, threaded=True)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    standin.domain = '127.0.0.1:{}'.format(server.server_port)
+
+    # e.g., live eBay calls in other tests may have opened the breakers
+    resilience.breakers.clear()
+    yield standin
+    server.shutdown()
+
+
+@pytest.fixture
+def offline_client(standin):
+    app = create_app(config_mode='Test')
+    app.config.update(EBAY_DOMAIN=standin.domain, EBAY_HTTPS=False)
+    clients.init_app(app)
+    client = app.test_client()
+    client.prefix = app.config['API_URL_PREFIX']
+    yield client
+    app.config.update(EBAY_DOMAIN=None, EBAY_HTTPS=True)
+    clients.init_app(app)
+
+
 def test_home(client):
     r = client.get('{}/'.format(client.prefix))
     assert r.status_code == 200
@@ -37,3 +108,188 @@ def test_search(client):
     assert r.status_code == 200
     results = get_json(r)['objects']['results']
     assert len(results) == 10
+
+
+@pytest.mark.parametrize('query', [
+    'pages=abc', 'pages=5-x', 'limit=0', 'max_results=abc', 'page=-1'])
+def test_search_rejects_bad_pages(client, query):
+    r = client.get('{}/search/?q=lego&{}'.format(client.prefix, query))
+    assert r.status_code == 400
+    assert r.cache_control.no_store
+
+
+@pytest.mark.parametrize('query', [
+    'country=XX', 'country=XX,YY', 'country=US,UK&deadline=abc',
+    'country=US,UK&deadline=-1'])
+def test_search_rejects_bad_sites(client, query):
+    r = client.get('{}/search/?q=lego&{}'.format(client.prefix, query))
+    assert r.status_code == 400
+
+
+def test_search_normalizes_country(offline_client, standin):
+    add_fixture(standin, 'Finding', 'findItemsAdvanced', gen_finding_xml(10))
+    url = '{}/search/?q=lego&country=uk'.format(offline_client.prefix)
+    r = offline_client.get(url)
+    assert r.status_code == 200
+    assert len(get_json(r)['objects']['results']) == 10
+
+
+def test_search_rejects_unknown_verbs(client):
+    r = client.get('{}/search/?q=lego&verb=getItem'.format(client.prefix))
+    assert r.status_code == 400
+
+
+def test_stats(client):
+    r = client.get('{}/stats/'.format(client.prefix))
+    assert r.status_code == 200
+    totals = get_json(r)['objects']['clients']['totals']
+    assert set(totals) == {'clients', 'hits', 'opens', 'reaps', 'idle'}
+
+
+def test_stats_hides_credentials(client):
+    clients.get(Finding, sandbox=True, appid='SECRET-APP', token='SECRET')
+    r = client.get('{}/stats/'.format(client.prefix))
+    assert r.status_code == 200
+    assert 'SECRET' not in r.get_data(as_text=True)
+
+
+def test_ship_batch_requires_items(client):
+    r = client.post('{}/ship/'.format(client.prefix), json={'dest': 'US'})
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize('path', ['ship', 'item'])
+@pytest.mark.parametrize('body', [['1', '2'], '1,2', 1, None])
+def test_batch_requires_json_object(client, path, body):
+    url = '{}/{}/'.format(client.prefix, path)
+    r = client.post(url, data=dumps(body), content_type=JSON)
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize('path', ['ship', 'item'])
+def test_batch_limits_items(client, path):
+    items = [str(item_id) for item_id in range(BATCH_MAX_ITEMS + 1)]
+    url = '{}/{}/'.format(client.prefix, path)
+    r = client.post(url, json={'items': items})
+    assert r.status_code == 400
+    assert str(BATCH_MAX_ITEMS) in get_json(r)['objects']
+
+
+@pytest.mark.parametrize('kwargs', [
+    {'data': {'items': '110000000001, 110000000002', 'dest': 'UK'}},
+    {'data': {'items': '110000000001,110000000002,', 'dest': 'UK'}},
+    {'json': {'items': [110000000001, '110000000002'], 'dest': 'UK'}},
+    {'json': {'items': '110000000001,110000000002', 'dest': 'UK'}}])
+def test_get_batch(client, kwargs):
+    app = client.application
+
+    with app.test_request_context(method='POST', **kwargs):
+        data, item_ids = get_batch()
+
+    assert data == {'dest': 'UK'}
+    assert item_ids == ['110000000001', '110000000002']
+
+
+def test_ship_batch(offline_client, standin):
+    # eBay echoes the MessageID (the item ID) as the CorrelationID
+    xml = SHIPPING_XML.format(TRADING_NS, '120000000001')
+    add_fixture(standin, 'Shopping', 'GetShippingCosts', xml)
+    url = '{}/ship/'.format(offline_client.prefix)
+    data = {'items': ['120000000001'], 'code': 61605}
+    r = offline_client.post(url, json=data)
+    assert r.status_code == 200
+    result = get_json(r)['objects']['results']['120000000001']
+    assert result['status'] == 'ok'
+    assert result['actual_shipping'] == 3.5
+    assert not result['cached']
+
+    calls = standin.stats['calls']
+    data['items'].append('120000000002')
+    r = offline_client.post(url, json=data)
+    assert r.status_code == 200
+    results = get_json(r)['objects']['results']
+    assert results['120000000001']['cached']
+    assert not results['120000000002']['cached']
+    assert standin.stats['calls'] == calls + 1
+
+
+def test_ship_batch_partial_failure(offline_client, standin):
+    options = {'DestinationCountryCode': 'US', 'DestinationPostalCode': '61605'}
+    result = {'item_id': '130000000001', 'actual_shipping': 3.5}
+    item_cache.put('US', get_shipping_section(options), {
+        '130000000001': result})
+
+    # there's no GetShippingCosts fixture, so the uncached item fails
+    url = '{}/ship/'.format(offline_client.prefix)
+    data = {'items': ['130000000001', '130000000002'], 'code': 61605}
+    r = offline_client.post(url, json=data)
+    assert r.status_code == 200
+    results = get_json(r)['objects']['results']
+    assert results['130000000001'] == dict(result, status='ok', cached=True)
+    assert results['130000000002']['status'] == 'error'
+    assert not results['130000000002']['cached']
+    assert results['130000000002']['message']
+
+
+def test_item_batch(offline_client, standin):
+    xml = ITEMS_XML.format(TRADING_NS, '140000000001')
+    add_fixture(standin, 'Shopping', 'GetMultipleItems', xml)
+    url = '{}/item/'.format(offline_client.prefix)
+    r = offline_client.post(url, data={'items': '140000000001,140000000002'})
+    assert r.status_code == 200
+    objects = get_json(r)['objects']
+    assert set(objects['results']) == {'140000000001'}
+    assert objects['message'] == 'Items not found: 140000000002'
+
+    # the found item is cached, so only the missing one is fetched again
+    calls = standin.stats['calls']
+    r = offline_client.post(url, data={'items': '140000000001'})
+    assert r.status_code == 200
+    assert set(get_json(r)['objects']['results']) == {'140000000001'}
+    assert standin.stats['calls'] == calls
+
+
+def test_item_batch_partial_failure(client, monkeypatch):
+    item_ids = [str(160000000000 + num) for num in range(25)]
+
+    def execute(self, verb, data):
+        if item_ids[-1] in data['ItemID']:
+            raise Unavailable('Call limit reached')
+
+        return {'Item': [{'ItemID': item_id} for item_id in data['ItemID']]}
+
+    monkeypatch.setattr(Shopping, 'execute', execute)
+    url = '{}/item/'.format(client.prefix)
+    r = client.post(url, json={'items': item_ids})
+    assert r.status_code == 200
+    objects = get_json(r)['objects']
+    assert set(objects['results']) == set(item_ids[:20])
+    assert item_ids[-1] in objects['message']
+    assert 'Call limit reached' in objects['message']
+
+
+def test_item_batch_failure(offline_client, standin):
+    url = '{}/item/'.format(offline_client.prefix)
+    r = offline_client.post(url, json={'items': ['150000000001']})
+    assert r.status_code == 500
+    assert 'No fixture' in get_json(r)['objects']
+
+
+def test_item_fields_from_details(offline_client, standin):
+    add_fixture(standin, 'Trading', 'GetItem', ITEM_XML.format(TRADING_NS))
+    url = '{}/item/110000000001/?fields=title,price,shipping'
+    r = offline_client.get(url.format(offline_client.prefix))
+    assert r.status_code == 200
+    assert get_json(r)['objects'] == {
+        'title': 'LEGO Star Wars', 'price': 12.5, 'shipping': 3.0}
+
+
+def test_search_cache_headers(offline_client, standin):
+    add_fixture(standin, 'Finding', 'findItemsAdvanced', gen_finding_xml(10))
+    url = '{}/search/?q=lego'.format(offline_client.prefix)
+
+    for _ in range(2):
+        r = offline_client.get(url)
+        assert r.status_code == 200
+        assert r.cache_control.public
+        assert 0 < r.cache_control.max_age <= 3600
@@ -0,0 +1,1552 @@
+# -*- coding: utf-8 -*-
+"""
+    app.upstream
+    ~~~~~~~~~~~~
+
+    Provides controls for the calls made to the eBay APIs
+"""
+from __future__ import (
+    absolute_import, division, print_function, unicode_literals)
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from collections import Counter, deque
+from concurrent.futures import (
+    ThreadPoolExecutor, TimeoutError as FuturesTimeoutError, as_completed,
+    wait)
+from contextlib import contextmanager
+from copy import deepcopy
+from datetime import date
+from hashlib import md5
+from json import dumps
+from math import ceil
+from random import uniform
+from threading import Event, Lock, local
+from time import sleep, time
+
+import pygogo as gogo
+
+from ebaysdk.exception import ConnectionError
+from requests.exceptions import (
+    ConnectionError as RequestsConnectionError, SSLError, Timeout)
+
+from app.metrics import metrics
+
+from builtins import *  # noqa  # pylint: disable=unused-import
+
+logger = gogo.Gogo(__name__, monolog=True).logger
+
+# the share of each quota a priority class may use (the rest is reserved for
+# the higher priority classes)
+PRIORITIES = {'interactive': 1.0, 'background': 0.5}
+
+# eBay error codes that mean a call limit was reached
+THROTTLE_ERRORS = {'10001', '518', '1.23'}
+
+# HTTP statuses of (probably) temporary upstream failures
+TRANSIENT_STATUSES = {500, 502, 503, 504}
+
+# verb prefixes of the read only (and so safely retried) eBay calls
+IDEMPOTENT_PREFIXES = ('find', 'get', 'Get')
+
+# circuit breaker states
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class Unavailable(ConnectionError):
+    """An upstream call can't be made right now"""
+
+    # the HTTP status of the response
+    status = 503
+
+    def __init__(self, msg, retry_after=None):
+        super(Unavailable, self).__init__(msg)
+        self.retry_after = retry_after
+
+
+class QuotaExceeded(Unavailable):
+    """An upstream call was refused because its quota is used up"""
+
+
+class CircuitOpen(Unavailable):
+    """An upstream call was refused because its endpoint is unhealthy"""
+
+
+class DeadlineExceeded(Unavailable):
+    """An upstream call was refused because its request ran out of time"""
+
+    status = 504
+
+
+def get_percentile(values, percent):
+    """Get a (nearest rank) percentile.
+
+    Parameters
+    ----------
+    values : list of numbers
+    percent : number
+
+    Returns
+    -------
+    The percentile, or None if there are no values : number
+
+    Examples
+    --------
+    >>> get_percentile(range(1, 101), 99)
+    99
+    >>> get_percentile([], 99) is None
+    True
+    """
+    values = sorted(values)
+
+    if values:
+        return values[int(ceil(percent / 100 * len(values))) - 1]
+
+
+def is_idempotent(verb):
+    """Determine whether an eBay call may be safely repeated.
+
+    Parameters
+    ----------
+    verb : string
+
+    Returns
+    -------
+    Whether the call only reads data : bool
+
+    Examples
+    --------
+    >>> is_idempotent('findItemsAdvanced')
+    True
+    >>> is_idempotent('AddItem')
+    False
+    """
+    return verb.startswith(IDEMPOTENT_PREFIXES)
+
+
+def is_transient(err):
+    """Determine whether a failed call is worth retrying.
+
+    Parameters
+    ----------
+    err : Exception
+        the error the call raised
+
+    Returns
+    -------
+    Whether the error is (probably) temporary : bool
+
+    Examples
+    --------
+    >>> from requests.exceptions import Timeout
+    >>> is_transient(Timeout())
+    True
+    >>> is_transient(QuotaExceeded('Limit reached'))
+    False
+    >>> from requests.exceptions import InvalidHeader
+    >>> is_transient(InvalidHeader('Invalid header'))
+    False
+    """
+    response = getattr(err, 'response', None)
+
+    if response is not None:
+        return getattr(response, 'status_code', None) in TRANSIENT_STATUSES
+
+    # other request errors (e.g., invalid urls, headers, or certificates)
+    # are misconfigurations that retrying won't fix
+    connection_failed = isinstance(err, RequestsConnectionError)
+    timed_out = isinstance(err, Timeout)
+    return (connection_failed and not isinstance(err, SSLError)) or timed_out
+
+
+def get_backoff(attempt, base, maximum):
+    """Get a (full jitter) exponential backoff delay.
+
+    Parameters
+    ----------
+    attempt : int
+        the number of retries so far
+
+    base : float
+        the first retry's maximum delay in seconds
+
+    maximum : float
+        the maximum delay in seconds
+
+    Returns
+    -------
+    Number of seconds to wait : float
+
+    Examples
+    --------
+    >>> 0 <= get_backoff(3, 0.1, 2) <= 0.8
+    True
+    """
+    return uniform(0, min(maximum, base * 2 ** attempt))
+
+
+def bind_context(func):
+    """Make a function run with the calling thread's upstream call priority,
+    deadline, timeout limit, and metrics recorder (e.g., when it is called
+    from another thread).
+
+    Parameters
+    ----------
+    func : callable
+
+    Returns
+    -------
+    The wrapped function : callable
+
+    Examples
+    --------
+    >>> from threading import Thread
+    >>> priorities = []
+    >>> func = lambda: priorities.append(scheduler.get_priority())
+    >>> with scheduler.priority('background'):
+    ...     thread = Thread(target=bind_context(func))
+    >>> thread.start()
+    >>> thread.join()
+    >>> priorities == ['background']
+    True
+    """
+    priority = scheduler.get_priority()
+    deadline = timeouts.get_deadline()
+    limit = timeouts.get_limit()
+    recorder = metrics.get_recorder()
+
+    def wrapper(*args, **kwargs):
+        with scheduler.priority(priority), timeouts.deadline(deadline):
+            with timeouts.limit(limit), metrics.recording(recorder):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def get_outcome(item, future):
+    """Get the outcome of a `gen_outcomes` call, cancelling it if unfinished.
+
+    Parameters
+    ----------
+    item : object
+        the item the call was applied to
+
+    future : concurrent.futures.Future
+        the call's future
+
+    Returns
+    -------
+    (item, result, error) : tuple
+    """
+    if future.done():
+        error = future.exception()
+        result = None if error else future.result()
+    else:
+        future.cancel()
+        error, result = FuturesTimeoutError('Timed out'), None
+
+    return (item, result, error)
+
+
+def gen_outcomes(func, items, max_workers=None, timeout=None, ordered=True):
+    """Apply a function to each item in a thread pool.
+
+    Parameters
+    ----------
+    func : callable
+    items : list
+    max_workers : int
+        maximum number of concurrent calls (default: the number of items)
+
+    timeout : float
+        number of seconds to wait for all calls to finish (default: None,
+        i.e., wait indefinitely)
+
+    ordered : bool
+        yield outcomes in order of `items` once all calls finish. If False,
+        each outcome is yielded as soon as its call finishes (default: True)
+
+    Yields
+    ------
+    (item, result, error) : tuple
+        only one of result or error will be set
+
+    Examples
+    --------
+    >>> outcomes = gen_outcomes(lambda x: 10 // x, [1, 0])
+    >>> next(outcomes)
+    (1, 10, None)
+    >>> item, result, error = next(outcomes)
+    >>> isinstance(error, ZeroDivisionError)
+    True
+    """
+    executor = ThreadPoolExecutor(max_workers or len(items) or 1)
+    pending = [executor.submit(func, item) for item in items]
+    positions = {future: pos for pos, future in enumerate(pending)}
+    yielded = set()
+
+    if ordered:
+        wait(pending, timeout=timeout)
+        completed = []
+    else:
+        completed = as_completed(pending, timeout=timeout)
+
+    # don't wait for stragglers that missed the deadline
+    executor.shutdown(wait=False)
+
+    try:
+        for future in completed:
+            yielded.add(future)
+            yield get_outcome(items[positions[future]], future)
+    except FuturesTimeoutError:
+        pass
+
+    for item, future in zip(items, pending):
+        if future not in yielded:
+            yield get_outcome(item, future)
+
+
+def make_call_key(*args):
+    """Create the key of an upstream call.
+
+    Parameters
+    ----------
+    args : the call's identifying values, e.g., (api, site, verb, data)
+
+    Returns
+    -------
+    Call key : string
+
+    Examples
+    --------
+    >>> key = make_call_key('Finding', '0', 'findItemsAdvanced', {
+    ...     'keywords': 'lego', 'sortOrder': 'EndTimeSoonest'})
+    >>> key == make_call_key('Finding', '0', 'findItemsAdvanced', {
+    ...     'sortOrder': 'EndTimeSoonest', 'keywords': 'lego'})
+    True
+    """
+    call = dumps(args, sort_keys=True, default=str).encode('utf-8')
+    return md5(call).hexdigest()
+
+
+class Flight(object):
+    """An in progress upstream call"""
+
+    def __init__(self):
+        self.done = Event()
+        self.followers = 0
+        self.results = []
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces identical concurrent upstream calls.
+
+    Only one caller (the leader) makes a given call; every other caller
+    waiting on the same key gets (a copy of) its result. Optionally, callers
+    in other workers wait as well, via a lock key in the shared cache.
+    """
+
+    def __init__(self, app=None, cache=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        cache : Flask-Caching Cache (optional, required if `shared`)
+        shared : coalesce calls across workers (default: False)
+        timeout : seconds to wait on another worker's call (default: 30)
+        poll_interval : seconds between shared result checks (default: 0.05)
+
+        Returns
+        -------
+        New instance of :class:`SingleFlight` : SingleFlight
+
+        Examples
+        --------
+        >>> SingleFlight()  #doctest: +ELLIPSIS
+        <app.upstream.SingleFlight object at 0x...>
+        """
+        self.shared = kwargs.get('shared', False)
+        self.timeout = kwargs.get('timeout', 30)
+        self.poll_interval = kwargs.get('poll_interval', 0.05)
+        self.backend = None
+        self.flights = {}
+        self.counts = Counter()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app, cache)
+
+    def init_app(self, app, cache=None):
+        self.shared = app.config['SINGLE_FLIGHT_SHARED']
+        self.timeout = app.config['SINGLE_FLIGHT_TIMEOUT']
+
+        if self.shared and cache:
+            with app.app_context():
+                backend = cache.cache
+
+            # bypass the local tier, it isn't visible to other workers
+            self.backend = getattr(backend, 'remote', None)
+
+        if self.shared and self.backend is None:
+            logger.warning('Shared single flight requires memcached')
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counts[name] += num
+
+    def do(self, key, func):
+        """Call a function unless an identical call is already in progress,
+        in which case wait for (a copy of) its result. A caller never waits
+        past its request deadline (or `timeout` if it has none).
+
+        Parameters
+        ----------
+        key : string
+            the call key (see `make_call_key`)
+
+        func : callable
+            makes the call
+
+        Returns
+        -------
+        The call result
+
+        Raises
+        ------
+        DeadlineExceeded
+            if the caller ran out of time waiting on another caller's call
+
+        Examples
+        --------
+        >>> from threading import Thread
+        >>> from time import sleep
+        >>> flights = SingleFlight()
+        >>> calls = []
+        >>> def func():
+        ...     calls.append(1)
+        ...     sleep(0.2)
+        ...     return {'results': len(calls)}
+        >>> threads = [
+        ...     Thread(target=flights.do, args=('key', func))
+        ...     for _ in range(5)]
+        >>> [thread.start() for thread in threads]  #doctest: +ELLIPSIS
+        [...]
+        >>> [thread.join() for thread in threads]  #doctest: +ELLIPSIS
+        [...]
+        >>> len(calls)
+        1
+        >>> flights.stats() == {
+        ...     'calls': 1, 'joined': 4, 'shared_joined': 0,
+        ...     'shared_timeouts': 0, 'saved': 4}
+        True
+        >>> leader = Thread(target=flights.do, args=('slow', func))
+        >>> leader.start()
+        >>> sleep(0.05)
+        >>> try:
+        ...     with timeouts.deadline(monotonic() + 0.05):
+        ...         flights.do('slow', func)
+        ... except DeadlineExceeded:
+        ...     print('expired')
+        expired
+        >>> leader.join()
+        """
+        with self._lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            self.count('joined')
+            remaining = timeouts.get_remaining()
+            wait = self.timeout if remaining is None else max(remaining, 0)
+
+            if not flight.done.wait(wait):
+                msg = 'Timed out waiting on an identical call'
+                raise DeadlineExceeded(msg)
+
+            if isinstance(flight.error, Exception):
+                raise flight.error
+            elif flight.error:
+                # e.g., a gevent Timeout that belongs to the leader's greenlet
+                raise Unavailable('An identical call was interrupted')
+
+            return flight.results.pop()
+
+        result = None
+
+        try:
+            if self.backend is not None:
+                result = self.call_shared(key, func)
+            else:
+                result = func()
+                self.count('calls')
+        except BaseException as err:
+            # followers must not mistake e.g. a gevent Timeout for a result
+            flight.error = err
+            raise
+        finally:
+            with self._lock:
+                del self.flights[key]
+
+            # each follower gets its own copy to mutate
+            copies = (deepcopy(result) for _ in range(flight.followers))
+            flight.results.extend([] if flight.error else copies)
+            flight.done.set()
+
+        return result
+
+    def call_shared(self, key, func):
+        """Make a call unless another worker is already making it, in which
+        case wait for its result (or make the call anyway after `timeout`).
+
+        Parameters
+        ----------
+        key : string
+            the call key (see `make_call_key`)
+
+        func : callable
+            makes the call
+
+        Returns
+        -------
+        The call result
+        """
+        lock_key = 'flight:lock:{}'.format(key)
+        result_key = 'flight:result:{}'.format(key)
+
+        if self.backend.add(lock_key, 1, timeout=self.timeout):
+            # don't let waiters pick up a previous call's result
+            self.backend.delete(result_key)
+
+            try:
+                result = func()
+                self.count('calls')
+                self.backend.set(result_key, result, timeout=self.timeout)
+            finally:
+                self.backend.delete(lock_key)
+
+            return result
+
+        deadline = monotonic() + self.timeout
+
+        while monotonic() < deadline:
+            # the result is set before the lock is released, so check the
+            # lock first
+            locked = self.backend.get(lock_key)
+            result = self.backend.get(result_key)
+
+            if result is not None:
+                self.count('shared_joined')
+                return result
+            elif not locked:
+                # the other worker's call failed
+                break
+
+            sleep(self.poll_interval)
+        else:
+            self.count('shared_timeouts')
+
+        result = func()
+        self.count('calls')
+        return result
+
+    def stats(self):
+        """Get this worker's call coalescing statistics.
+
+        Returns
+        -------
+        Call coalescing statistics : dict
+
+        Examples
+        --------
+        >>> SingleFlight().stats()['saved']
+        0
+        """
+        with self._lock:
+            counts = Counter(self.counts)
+
+        names = ['calls', 'joined', 'shared_joined', 'shared_timeouts']
+        stats = {name: counts[name] for name in names}
+        stats['saved'] = counts['joined'] + counts['shared_joined']
+        return stats
+
+
+class CallScheduler(object):
+    """Keeps upstream calls within eBay's call limits.
+
+    Each app ID and API family (Finding, Shopping, or Trading) has a token
+    bucket that refills at the per second rate, and a daily allowance.
+    Lower priority classes may only use their share (see `PRIORITIES`) of
+    each, so e.g., background refreshes can't starve interactive searches.
+    A call that can't go ahead waits (up to `max_wait` seconds) for a token,
+    and is otherwise refused with a `QuotaExceeded` error.
+
+    With `shared`, the buckets are kept in memcached (as per second and per
+    day counters) so that every worker draws from the same quota.
+    """
+
+    def __init__(self, app=None, cache=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        cache : Flask-Caching Cache (optional, required if `shared`)
+        rates : calls per second by API family (default: {}, i.e., no limit)
+        daily : calls per day by API family (default: {}, i.e., no limit)
+        max_wait : seconds a call may wait for a token (default: 5)
+        shared : share the buckets between workers (default: False)
+
+        Returns
+        -------
+        New instance of :class:`CallScheduler` : CallScheduler
+
+        Examples
+        --------
+        >>> CallScheduler()  #doctest: +ELLIPSIS
+        <app.upstream.CallScheduler object at 0x...>
+        """
+        self.rates = kwargs.get('rates', {})
+        self.daily = kwargs.get('daily', {})
+        self.max_wait = kwargs.get('max_wait', 5)
+        self.shared = kwargs.get('shared', False)
+        self.backend = None
+        self.buckets = {}
+        self.days = Counter()
+        self.counts = Counter()
+        self._context = local()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app, cache)
+
+    def init_app(self, app, cache=None):
+        self.rates = app.config['QUOTA_CALLS_PER_SECOND']
+        self.daily = app.config['QUOTA_CALLS_PER_DAY']
+        self.max_wait = app.config['QUOTA_MAX_WAIT']
+        self.shared = app.config['QUOTA_SHARED']
+
+        if self.shared and cache:
+            with app.app_context():
+                backend = cache.cache
+
+            # counters must be visible to every worker
+            self.backend = getattr(backend, 'remote', None)
+
+        if self.shared and self.backend is None:
+            logger.warning('Shared call quotas require memcached')
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counts[name] += num
+
+    @contextmanager
+    def priority(self, name):
+        """Set the priority class of the calls made (in this thread) within
+        the context.
+
+        Parameters
+        ----------
+        name : string
+            one of `PRIORITIES`
+
+        Examples
+        --------
+        >>> scheduler = CallScheduler()
+        >>> with scheduler.priority('background'):
+        ...     scheduler.get_priority() == 'background'
+        True
+        >>> scheduler.get_priority() == 'interactive'
+        True
+        """
+        previous = self.get_priority()
+        self._context.priority = name
+
+        try:
+            yield
+        finally:
+            self._context.priority = previous
+
+    def get_priority(self):
+        return getattr(self._context, 'priority', 'interactive')
+
+    def acquire(self, appid, family, max_wait=None):
+        """Wait for permission to make an upstream call.
+
+        Parameters
+        ----------
+        appid : string
+            the eBay app ID
+
+        family : string
+            the API family, e.g., 'Finding'
+
+        max_wait : float
+            seconds the call may wait for a token (default: `max_wait`)
+
+        Returns
+        -------
+        Number of seconds waited : float
+
+        Raises
+        ------
+        QuotaExceeded : if the daily allowance is used up, or no token
+            became available within `max_wait` seconds
+
+        Examples
+        --------
+        >>> scheduler = CallScheduler(rates={'Finding': 2}, max_wait=0.6)
+        >>> [scheduler.acquire('app', 'Finding') for _ in range(2)]
+        [0, 0]
+        >>> 0.4 < scheduler.acquire('app', 'Finding') < 0.6
+        True
+        >>> with scheduler.priority('background'):
+        ...     scheduler.acquire('app', 'Finding')
+        Traceback (most recent call last):
+        ...
+        app.upstream.QuotaExceeded: Finding call rate limit reached
+        >>> scheduler.acquire('app', 'Shopping')
+        0
+        """
+        rate = self.rates.get(family)
+        daily = self.daily.get(family)
+
+        if not (rate or daily):
+            return 0
+
+        share = PRIORITIES[self.get_priority()]
+        if max_wait is None or max_wait > self.max_wait:
+            max_wait = self.max_wait
+
+        start = monotonic()
+        deadline = start + max_wait
+
+        while True:
+            shared = self.backend is not None
+            take = self.take_shared if shared else self.take
+            wait = take(appid or 'default', family, share, rate, daily)
+
+            if not wait:
+                self.count('granted')
+                waited = monotonic() - start
+                return round(waited, 3) if waited > 0.001 else 0
+            elif monotonic() + wait > deadline:
+                self.count('refused')
+                msg = '{} call rate limit reached'.format(family)
+                raise QuotaExceeded(msg, wait)
+
+            self.count('waited')
+            sleep(wait)
+
+    def check_daily(self, family, calls, share, daily):
+        if daily and calls > daily * share:
+            self.count('refused')
+            msg = '{} daily call limit reached'.format(family)
+            raise QuotaExceeded(msg, 86400 - time() % 86400)
+
+    def take(self, appid, family, share, rate=None, daily=None):
+        """Take a token from this worker's bucket.
+
+        Returns
+        -------
+        Number of seconds until a token is available (0 if one was taken)
+        : float
+        """
+        key = (appid, family)
+        day = (appid, family, date.today())
+        now = monotonic()
+
+        with self._lock:
+            self.check_daily(family, self.days[day] + 1, share, daily)
+
+            if rate:
+                tokens, last = self.buckets.get(key, (rate, now))
+                tokens = min(rate, tokens + (now - last) * rate)
+
+                # lower priorities leave a reserve in the bucket
+                needed = 1 + rate * (1 - share)
+
+                if tokens < needed:
+                    self.buckets[key] = (tokens, now)
+                    return (needed - tokens) / rate
+
+                self.buckets[key] = (tokens - 1, now)
+
+            self.days[day] += 1
+
+        return 0
+
+    def incr(self, key, timeout):
+        calls = self.backend.inc(key)
+
+        if not calls:
+            # memcached can't increment missing keys
+            if self.backend.add(key, 1, timeout=timeout):
+                calls = 1
+            else:
+                calls = self.backend.inc(key)
+
+        return calls
+
+    def take_shared(self, appid, family, share, rate=None, daily=None):
+        """Take a token from the (memcached) bucket shared by all workers.
+        The bucket is approximated by a counter per second.
+
+        Returns
+        -------
+        Number of seconds until a token is available (0 if one was taken)
+        : float
+        """
+        now = time()
+        prefix = 'quota:{}:{}'.format(appid, family)
+
+        if rate:
+            calls = self.incr('{}:{}'.format(prefix, int(now)), 2)
+
+            if calls > rate * share:
+                return 1 - now % 1
+
+        if daily:
+            key = '{}:{}'.format(prefix, date.today())
+            self.check_daily(family, self.incr(key, 172800), share, daily)
+
+        return 0
+
+    def stats(self):
+        """Get this worker's call scheduling statistics.
+
+        Returns
+        -------
+        Call scheduling statistics : dict
+
+        Examples
+        --------
+        >>> CallScheduler().stats()['refused']
+        0
+        """
+        with self._lock:
+            counts = Counter(self.counts)
+
+        names = ['granted', 'waited', 'refused', 'throttled']
+        return {name: counts[name] for name in names}
+
+
+class CircuitBreaker(object):
+    """Tracks the health of an upstream endpoint.
+
+    The breaker opens after `failures` consecutive transient failures and
+    then fails calls fast for `reset_timeout` seconds. After that, it lets a
+    single probe call through (half open): the probe's success closes the
+    breaker, and its failure opens it again. The latencies of successful
+    calls are kept to tell when a call is running late (see `get_p95`).
+    """
+
+    def __init__(self, name, failures=5, reset_timeout=30, window=100):
+        """Initialization method.
+
+        Parameters
+        ----------
+        name : string
+            the endpoint name, e.g., 'Finding:US'
+
+        failures : consecutive failures that open the breaker (default: 5)
+        reset_timeout : seconds the breaker stays open (default: 30)
+        window : number of latencies kept (default: 100)
+
+        Returns
+        -------
+        New instance of :class:`CircuitBreaker` : CircuitBreaker
+
+        Examples
+        --------
+        >>> breaker = CircuitBreaker('Finding:US', failures=2)
+        >>> breaker.failed()
+        >>> breaker.allow()
+        >>> breaker.failed()
+        >>> breaker.allow()  #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        app.upstream.CircuitOpen: ...
+        >>> breaker.status()['state'] == OPEN
+        True
+        """
+        self.name = name
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.latencies = deque(maxlen=window)
+        self._lock = Lock()
+
+    def get_retry_after(self):
+        return max(0, self.opened + self.reset_timeout - monotonic())
+
+    def allow(self):
+        """Ask permission to make a call.
+
+        Raises
+        ------
+        CircuitOpen : if the breaker is open, or another call is probing the
+            endpoint
+
+        Examples
+        --------
+        >>> breaker = CircuitBreaker('Finding:US', failures=1, reset_timeout=0)
+        >>> breaker.failed()
+        >>> breaker.allow()
+        >>> breaker.allow()  #doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        app.upstream.CircuitOpen: ...
+        >>> breaker.succeeded(0.1)
+        >>> breaker.allow()
+        """
+        with self._lock:
+            if self.state == OPEN:
+                retry_after = self.get_retry_after()
+
+                if retry_after:
+                    msg = '{} is unavailable'.format(self.name)
+                    raise CircuitOpen(msg, retry_after)
+
+                self.state = HALF_OPEN
+
+            if self.state == HALF_OPEN:
+                if self.probing:
+                    msg = '{} is being probed'.format(self.name)
+                    raise CircuitOpen(msg, 1)
+
+                self.probing = True
+
+    def succeeded(self, latency=None):
+        """Record a successful call.
+
+        Parameters
+        ----------
+        latency : float
+            the call's duration in seconds
+        """
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+
+            # calls made before the breaker opened don't close it
+            if self.state != OPEN:
+                self.state = CLOSED
+                self.failures = 0
+                self.probing = False
+
+    def failed(self):
+        """Record a transiently failed call."""
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            tripped = self.failures >= self.max_failures
+
+            if self.state == HALF_OPEN or (self.state == CLOSED and tripped):
+                logger.warning('Opening circuit breaker %s', self.name)
+                self.state = OPEN
+                self.opened = monotonic()
+
+    def release(self):
+        """Record a call that never reached the endpoint."""
+        with self._lock:
+            self.probing = False
+
+    def get_p95(self, min_samples=20):
+        """Get the 95th percentile latency of the recent successful calls.
+
+        Parameters
+        ----------
+        min_samples : int
+            the number of latencies required (default: 20)
+
+        Returns
+        -------
+        Number of seconds, or None if too few calls were made : float
+
+        Examples
+        --------
+        >>> breaker = CircuitBreaker('Finding:US')
+        >>> for latency in range(1, 101):
+        ...     breaker.succeeded(latency)
+        >>> breaker.get_p95()
+        95
+        """
+        with self._lock:
+            latencies = list(self.latencies)
+
+        if latencies and len(latencies) >= min_samples:
+            return get_percentile(latencies, 95)
+
+    def status(self):
+        """Get the breaker's state.
+
+        Returns
+        -------
+        Breaker state : dict
+        """
+        with self._lock:
+            state, failures = self.state, self.failures
+            is_open = state == OPEN
+            retry_after = self.get_retry_after() if is_open else 0
+
+        p95 = self.get_p95(1)
+
+        return {
+            'state': state, 'failures': failures,
+            'retry_after': round(retry_after, 3),
+            'p95': p95 if p95 is None else round(p95, 3)}
+
+
+class Resilience(object):
+    """Retries, circuit breaking, and hedging of upstream calls.
+
+    Each (API family, country) endpoint has its own `CircuitBreaker`.
+    Idempotent calls (see `is_idempotent`) that fail transiently (see
+    `is_transient`) are retried up to `retries` times with jittered
+    exponential backoff. With `hedge`, an idempotent call that is still
+    running after its endpoint's observed p95 latency is duplicated, and the
+    first of the two to finish wins. Breakers are kept per worker.
+    """
+
+    def __init__(self, app=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        retries : maximum retries of an idempotent call (default: 2)
+        backoff : first retry's maximum delay in seconds (default: 0.1)
+        max_backoff : maximum retry delay in seconds (default: 2)
+        failures : consecutive failures that open a breaker (default: 5)
+        reset_timeout : seconds a breaker stays open (default: 30)
+        hedge : duplicate late idempotent calls (default: False)
+        min_samples : latencies required before hedging (default: 20)
+        max_workers : maximum concurrent hedged calls (default: 8)
+
+        Returns
+        -------
+        New instance of :class:`Resilience` : Resilience
+
+        Examples
+        --------
+        >>> Resilience()  #doctest: +ELLIPSIS
+        <app.upstream.Resilience object at 0x...>
+        """
+        self.retries = kwargs.get('retries', 2)
+        self.backoff = kwargs.get('backoff', 0.1)
+        self.max_backoff = kwargs.get('max_backoff', 2)
+        self.failures = kwargs.get('failures', 5)
+        self.reset_timeout = kwargs.get('reset_timeout', 30)
+        self.hedge = kwargs.get('hedge', False)
+        self.min_samples = kwargs.get('min_samples', 20)
+        self.max_workers = kwargs.get('max_workers', 8)
+        self.breakers = {}
+        self.counts = Counter()
+        self._executor = None
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.retries = app.config['UPSTREAM_RETRIES']
+        self.backoff = app.config['UPSTREAM_BACKOFF']
+        self.max_backoff = app.config['UPSTREAM_MAX_BACKOFF']
+        self.failures = app.config['BREAKER_FAILURES']
+        self.reset_timeout = app.config['BREAKER_RESET_TIMEOUT']
+        self.hedge = app.config['HEDGE_REQUESTS']
+        self.min_samples = app.config['HEDGE_MIN_SAMPLES']
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counts[name] += num
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+
+        return self._executor
+
+    def get_breaker(self, family, country):
+        name = '{}:{}'.format(family, country)
+
+        with self._lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(
+                    name, self.failures, self.reset_timeout)
+
+        return self.breakers[name]
+
+    def call(self, family, country, verb, func, hedge=True):
+        """Make an upstream call through its endpoint's circuit breaker,
+        retrying (and hedging) it if it is idempotent.
+
+        Parameters
+        ----------
+        family : string
+            the API family, e.g., 'Finding'
+
+        country : string
+        verb : string
+        func : callable
+            makes the call
+
+        hedge : bool
+            allow hedging the call (default: True)
+
+        Returns
+        -------
+        The call result
+
+        Raises
+        ------
+        CircuitOpen : if the endpoint is unhealthy
+
+        Examples
+        --------
+        >>> from requests.exceptions import Timeout
+        >>> resilience = Resilience(backoff=0)
+        >>> calls = []
+        >>> def func():
+        ...     calls.append(1)
+        ...
+        ...     if len(calls) < 3:
+        ...         raise Timeout()
+        ...
+        ...     return len(calls)
+        >>> resilience.call('Finding', 'US', 'findItemsAdvanced', func)
+        3
+        >>> resilience.stats()['retries']
+        2
+        """
+        breaker = self.get_breaker(family, country)
+        idempotent = is_idempotent(verb)
+        retries = self.retries if idempotent else 0
+        hedge = hedge and self.hedge and idempotent
+
+        for attempt in range(retries + 1):
+            if attempt:
+                self.count('retries')
+                sleep(get_backoff(attempt - 1, self.backoff, self.max_backoff))
+
+            try:
+                return self.attempt(breaker, func, hedge)
+            except Exception as err:
+                if attempt == retries or not is_transient(err):
+                    raise
+
+                logger.warning('Retrying %s %s: %s', breaker.name, verb, err)
+
+    def attempt(self, breaker, func, hedge=False):
+        """Make a single (possibly hedged) attempt at an upstream call."""
+        try:
+            breaker.allow()
+        except CircuitOpen:
+            self.count('short_circuited')
+            raise
+
+        start = monotonic()
+
+        try:
+            result = self.call_hedged(breaker, func) if hedge else func()
+        except Exception as err:
+            if is_transient(err):
+                breaker.failed()
+            elif getattr(err, 'response', None) is not None:
+                # the endpoint replied (with an error)
+                breaker.succeeded()
+            else:
+                breaker.release()
+
+            raise
+
+        breaker.succeeded(monotonic() - start)
+        return result
+
+    def call_hedged(self, breaker, func):
+        """Make an upstream call, and make it again if the first call takes
+        longer than the endpoint's p95 latency.
+        """
+        delay = breaker.get_p95(self.min_samples)
+
+        if delay is None:
+            return func()
+
+        # hedged calls run in the executor's threads
+        run = bind_context(func)
+        first = self.executor.submit(run)
+
+        if wait([first], timeout=delay).done:
+            return first.result()
+
+        self.count('hedged')
+        errors = []
+
+        for future in as_completed([first, self.executor.submit(run)]):
+            try:
+                result = future.result()
+            except Exception as err:
+                errors.append(err)
+            else:
+                if future is not first:
+                    self.count('hedge_wins')
+
+                return result
+
+        raise errors[0]
+
+    def stats(self):
+        """Get this worker's retry, circuit breaker, and hedging statistics.
+
+        Returns
+        -------
+        Upstream resilience statistics : dict
+
+        Examples
+        --------
+        >>> Resilience().stats()['hedged']
+        0
+        """
+        with self._lock:
+            counts = Counter(self.counts)
+            breakers = list(self.breakers.values())
+
+        names = ['retries', 'short_circuited', 'hedged', 'hedge_wins']
+        stats = {name: counts[name] for name in names}
+        stats['open'] = sum(b.state != CLOSED for b in breakers)
+        return stats
+
+    def status(self):
+        """Get the state of each endpoint's circuit breaker.
+
+        Returns
+        -------
+        Breaker states keyed by endpoint name : dict
+
+        Examples
+        --------
+        >>> resilience = Resilience()
+        >>> breaker = resilience.get_breaker('Finding', 'US')
+        >>> resilience.status()['Finding:US']['state'] == CLOSED
+        True
+        """
+        with self._lock:
+            breakers = list(self.breakers.values())
+
+        return {breaker.name: breaker.status() for breaker in breakers}
+
+
+class Timeouts(object):
+    """Adapts the timeout of each upstream call to its observed latency.
+
+    Each (API family, country, verb) keeps a window of recent call latencies.
+    A call's timeout is the window's p99 times `factor`, clamped between
+    `minimum` and `maximum` (the client's own timeout applies until
+    `min_samples` latencies are known). Calls made within a `deadline`
+    context never wait past the deadline, and calls made within a `limit`
+    context never wait longer than the limit.
+    """
+
+    def __init__(self, app=None, **kwargs):
+        """Initialization method.
+
+        Parameters
+        ----------
+        app : Flask app (optional)
+        factor : multiple of the p99 latency (default: 3)
+        minimum : minimum timeout in seconds (default: 2)
+        maximum : maximum timeout in seconds (default: 60)
+        min_samples : latencies required to adapt a timeout (default: 20)
+        window : number of latencies kept per verb (default: 200)
+
+        Returns
+        -------
+        New instance of :class:`Timeouts` : Timeouts
+
+        Examples
+        --------
+        >>> Timeouts()  #doctest: +ELLIPSIS
+        <app.upstream.Timeouts object at 0x...>
+        """
+        self.factor = kwargs.get('factor', 3)
+        self.minimum = kwargs.get('minimum', 2)
+        self.maximum = kwargs.get('maximum', 60)
+        self.min_samples = kwargs.get('min_samples', 20)
+        self.window = kwargs.get('window', 200)
+        self.latencies = {}
+        self.counts = Counter()
+        self._context = local()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.factor = app.config['UPSTREAM_TIMEOUT_FACTOR']
+        self.minimum = app.config['UPSTREAM_MIN_TIMEOUT']
+        self.maximum = app.config['UPSTREAM_MAX_TIMEOUT']
+        self.min_samples = app.config['UPSTREAM_TIMEOUT_SAMPLES']
+
+    def count(self, name, num=1):
+        with self._lock:
+            self.counts[name] += num
+
+    @contextmanager
+    def deadline(self, deadline):
+        """Set the time (on the `monotonic` clock) by which the calls made
+        (in this thread) within the context must finish.
+
+        Parameters
+        ----------
+        deadline : float
+            the deadline (None means no deadline)
+
+        Examples
+        --------
+        >>> timeouts = Timeouts()
+        >>> with timeouts.deadline(monotonic() + 5):
+        ...     4 < timeouts.get_remaining() <= 5
+        True
+        >>> timeouts.get_remaining() is None
+        True
+        """
+        previous = self.get_deadline()
+        self.set_deadline(deadline)
+
+        try:
+            yield
+        finally:
+            self.set_deadline(previous)
+
+    def get_deadline(self):
+        return getattr(self._context, 'deadline', None)
+
+    def set_deadline(self, deadline):
+        self._context.deadline = deadline
+
+    def get_remaining(self):
+        deadline = self.get_deadline()
+        return None if deadline is None else deadline - monotonic()
+
+    @contextmanager
+    def limit(self, seconds):
+        """Cap the timeout of each call made (in this thread) within the
+        context, e.g., to the timeout a client asked for.
+
+        Parameters
+        ----------
+        seconds : float
+            the limit (None means no limit)
+
+        Examples
+        --------
+        >>> timeouts = Timeouts()
+        >>> with timeouts.limit(5):
+        ...     timeouts.get_timeout('Finding', 'US', 'findItemsAdvanced')
+        5
+        """
+        previous = self.get_limit()
+        self.set_limit(seconds)
+
+        try:
+            yield
+        finally:
+            self.set_limit(previous)
+
+    def get_limit(self):
+        return getattr(self._context, 'limit', None)
+
+    def set_limit(self, seconds):
+        self._context.limit = seconds
+
+    def get_timeout(self, family, country, verb, default=20):
+        """Get the timeout of an upstream call.
+
+        Parameters
+        ----------
+        family : string
+            the API family, e.g., 'Finding'
+
+        country : string
+        verb : string
+        default : float
+            the timeout if too few latencies are known (default: 20)
+
+        Returns
+        -------
+        Number of seconds : float
+
+        Raises
+        ------
+        DeadlineExceeded : if the deadline has passed
+
+        Examples
+        --------
+        >>> timeouts = Timeouts(min_samples=1)
+        >>> timeouts.get_timeout('Finding', 'US', 'findItemsAdvanced')
+        20
+        >>> timeouts.record('Finding', 'US', 'findItemsAdvanced', 1)
+        >>> timeouts.get_timeout('Finding', 'US', 'findItemsAdvanced')
+        3
+        >>> with timeouts.deadline(monotonic() - 1):
+        ...     timeouts.get_timeout('Finding', 'US', 'findItemsAdvanced')
+        Traceback (most recent call last):
+        ...
+        app.upstream.DeadlineExceeded: Request deadline exceeded
+        """
+        p99 = self.get_p99('{}:{}:{}'.format(family, country, verb))
+        limit = self.get_limit()
+
+        if p99 is None:
+            timeout = default
+        else:
+            timeout = min(max(p99 * self.factor, self.minimum), self.maximum)
+
+        if limit:
+            timeout = min(timeout, limit)
+
+        remaining = self.get_remaining()
+
+        if remaining is not None and remaining <= 0:
+            self.count('expired')
+            raise DeadlineExceeded('Request deadline exceeded')
+        elif remaining is not None and remaining < timeout:
+            self.count('shortened')
+            timeout = remaining
+
+        return timeout
+
+    def get_p99(self, name):
+        with self._lock:
+            latencies = list(self.latencies.get(name, []))
+
+        if len(latencies) >= self.min_samples:
+            return get_percentile(latencies, 99)
+
+    def record(self, family, country, verb, latency):
+        """Record the latency of an upstream call.
+
+        Parameters
+        ----------
+        family : string
+            the API family, e.g., 'Finding'
+
+        country : string
+        verb : string
+        latency : float
+            the call's duration in seconds
+        """
+        name = '{}:{}:{}'.format(family, country, verb)
+
+        with self._lock:
+            if name not in self.latencies:
+                self.latencies[name] = deque(maxlen=self.window)
+
+            self.latencies[name].append(latency)
+
+    @contextmanager
+    def track(self, family, country, verb, timeout=None):
+        """Record the latency of the upstream call made within the context
+        (unless it failed before reaching eBay).
+
+        A timed out call only says its latency exceeded its timeout, so it is
+        recorded as taking `timeout`. That way the timeout recovers (up to
+        `maximum`) when eBay stays slower than it, but doesn't grow past what
+        was observed (a call may run for several timeouts, e.g., one to
+        connect and another to read).
+
+        Parameters
+        ----------
+        family : string
+            the API family, e.g., 'Finding'
+
+        country : string
+        verb : string
+        timeout : float
+            the call's timeout (default: None, i.e., don't record the call
+            if it times out)
+
+        Examples
+        --------
+        >>> timeouts = Timeouts(min_samples=1)
+        >>> with timeouts.track('Finding', 'US', 'findItemsAdvanced'):
+        ...     pass
+        >>> timeouts.stats()['verbs']['Finding:US:findItemsAdvanced']['calls']
+        1
+        >>> with timeouts.track('Finding', 'US', 'findItemsAdvanced', 0):
+        ...     raise Timeout()
+        Traceback (most recent call last):
+        ...
+        requests.exceptions.Timeout
+        >>> timeouts.stats()['timed_out']
+        1
+        >>> timeouts.stats()['verbs']['Finding:US:findItemsAdvanced']['calls']
+        2
+        """
+        start = monotonic()
+
+        try:
+            yield
+        except Exception as err:
+            if getattr(err, 'response', None) is not None:
+                self.record(family, country, verb, monotonic() - start)
+            elif isinstance(err, Timeout):
+                self.count('timed_out')
+
+                if timeout is not None:
+                    self.record(family, country, verb, timeout)
+
+            raise
+        else:
+            self.record(family, country, verb, monotonic() - start)
+
+    def stats(self):
+        """Get this worker's upstream latency and timeout statistics.
+
+        Returns
+        -------
+        Upstream timeout statistics : dict
+
+        Examples
+        --------
+        >>> Timeouts().stats()['expired']
+        0
+        """
+        with self._lock:
+            counts = Counter(self.counts)
+            names = list(self.latencies)
+
+        outcomes = ['shortened', 'expired', 'timed_out']
+        stats = {outcome: counts[outcome] for outcome in outcomes}
+        stats['verbs'] = {}
+
+        for name in names:
+            with self._lock:
+                calls = len(self.latencies[name])
+
+            p99 = self.get_p99(name)
+            stats['verbs'][name] = {
+                'calls': calls, 'p99': p99 if p99 is None else round(p99, 3)}
+
+        return stats
+
+
+flights = SingleFlight()
+scheduler = CallScheduler()
+resilience = Resilience()
+timeouts = Timeouts()
@@ -15,30 +15,74 @@ try:
 except ImportError:
     JSONDecodeError = ValueError
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 try:
     from time import monotonic
 except ImportError:
     from time import time as monotonic
 
 from ast import literal_eval
+from collections import Counter, defaultdict
+from concurrent import futures
 from datetime import datetime as dt, timedelta
+from hashlib import md5
 
 from functools import wraps
+from itertools import islice
+from threading import Lock
+from time import time
 
 import requests
 import pygogo as gogo
 
-from flask import make_response, request
+from flask import (
+    Response, make_response, request, current_app, has_app_context,
+    has_request_context, stream_with_context)
 from dateutil.relativedelta import relativedelta
+from werkzeug.http import is_resource_modified
 from http.client import responses
 from meza import fntools as ft
 
+from config import Config
 from app import cache
+from app.caches import get_generations, tag_key
+from app.metrics import metrics
+from app.profiling import PROFILE_ARG
+from app.upstream import scheduler, bind_context, gen_outcomes
 
 from builtins import *  # noqa  # pylint: disable=unused-import
 
 logger = gogo.Gogo(__name__, monolog=True).logger
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# query parameters that only control the response format (or profiling)
+FORMAT_ARGS = {'format', 'pretty', PROFILE_ARG}
+
+# handles the types json can't, e.g., sets, dates, decimals, and iterators
+encode_default = ft.CustomEncoder().default
+
+if orjson:
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+# query parameter defaults by view name (set via `cache_header`)
+CACHE_KEY_DEFAULTS = {}
+
+# (option, tag name) of the entity IDs cache keys are tagged with
+ENTITY_TAGS = [('item_id', 'item'), ('cid', 'category'), ('name', 'category')]
+
+STALE_TIMEOUT = Config.CACHE_STALE_TIMEOUT
+STALE_RETRY_INTERVAL = Config.CACHE_STALE_RETRY_INTERVAL
+
+# background refreshes of stale cached view responses
+refresher = futures.ThreadPoolExecutor(Config.CACHE_REFRESH_MAX_WORKERS)
+refreshing = set()
+refresh_lock = Lock()
+
 # https://baconipsum.com/?paras=5&type=meat-and-filler&make-it-spicy=1
 BACON_IPSUM = [
     'Spicy jalapeno bacon ipsum dolor amet prosciutto bresaola ball chicken.',
@@ -67,23 +111,95 @@ BACON_IPSUM = [
 ]
 
 
-def jsonify(status=200, indent=2, sort_keys=True, **kwargs):
+def encode(obj, indent=None, sort_keys=True):
+    """ Serializes an object into UTF-8 encoded JSON. Uses orjson if it is
+    installed, and otherwise the C accelerated json encoder (which `json`
+    only uses for compact output).
+
+    Args:
+        obj (obj): The object to serialize
+        indent (int): Number of spaces to indent (default: None, i.e.,
+            compact output)
+
+        sort_keys (bool): Sort dicts by key (default: True).
+
+    Returns:
+        (bytes): The JSON
+
+    Examples:
+        >>> encode({'b': {2, 1}, 'a': 'é'}) == '{"a":"é","b":[1,2]}'.encode(
+        ...     'utf-8')
+        True
+        >>> print(encode({'a': 1}, indent=2).decode('utf-8'))
+        {
+          "a": 1
+        }
+    """
+    if orjson and indent in {None, 2}:
+        options = ORJSON_OPTIONS | (orjson.OPT_INDENT_2 if indent else 0)
+        options |= orjson.OPT_SORT_KEYS if sort_keys else 0
+
+        try:
+            return orjson.dumps(obj, default=encode_default, option=options)
+        except (orjson.JSONEncodeError, TypeError):
+            # e.g., integers over 64 bits or unsortable keys
+            pass
+
+    separators = (',', ': ') if indent else (',', ':')
+    json_str = dumps(
+        obj, default=encode_default, indent=indent, sort_keys=sort_keys,
+        separators=separators, ensure_ascii=False)
+
+    return json_str.encode('utf-8')
+
+
+def wants_pretty():
+    """ Determines whether the client asked for indented JSON, i.e., `pretty`
+    is set (to anything but a false value)
+
+    Returns:
+        (bool): True if the response should be indented
+    """
+    pretty = request.args.get('pretty') if has_request_context() else None
+    return pretty is not None and parse(pretty or 'true') not in {False, 0}
+
+
+def get_request_args():
+    """ Parses the query parameters (minus those in `FORMAT_ARGS`)
+
+    Returns:
+        (dict): The parsed query parameters
+    """
+    args = request.args.to_dict().items()
+    return {k: parse(v) for k, v in args if k not in FORMAT_ARGS}
+
+
+def jsonify(status=200, indent=None, sort_keys=True, **kwargs):
     """ Creates a jsonified response. Necessary because the default
     flask.jsonify doesn't correctly handle sets, dates, or iterators
 
     Args:
         status (int): The status code (default: 200).
-        indent (int): Number of spaces to indent (default: 2).
+        indent (int): Number of spaces to indent (default: None, i.e.,
+            compact unless the request asked for `pretty` output, which is
+            indented by 2 spaces).
+
         sort_keys (bool): Sort response dict by keys (default: True).
         kwargs (dict): The response to jsonify.
 
     Returns:
         (obj): Flask response
     """
-    options = {'indent': indent, 'sort_keys': sort_keys, 'ensure_ascii': False}
+    if indent is None and wants_pretty():
+        indent = 2
+
     kwargs['status'] = responses[status]
-    json_str = dumps(kwargs, cls=ft.CustomEncoder, **options)
-    response = make_response((json_str, status))
+    endpoint = (request.endpoint or '').rpartition('.')[2]
+
+    with metrics.timer('serialize_seconds', endpoint=endpoint):
+        body = encode(kwargs, indent, sort_keys)
+
+    response = make_response((body, status))
     response.headers['Content-Type'] = 'application/json; charset=utf-8'
     response.headers['mimetype'] = 'application/json'
     response.last_modified = dt.utcnow()
@@ -91,6 +207,46 @@ def jsonify(status=200, indent=2, sort_keys=True, **kwargs):
     return response
 
 
+def wants_ndjson():
+    """ Determines whether the client asked for newline delimited JSON, i.e.,
+    either `format=ndjson` or an `Accept: application/x-ndjson` header
+
+    Returns:
+        (bool): True if the response should be streamed as NDJSON
+    """
+    mimetypes = ['application/json', NDJSON_MIMETYPE]
+    fmt = request.args.get('format')
+
+    if fmt:
+        ndjson = fmt.lower() == 'ndjson'
+    else:
+        ndjson = request.accept_mimetypes.best_match(mimetypes) in mimetypes[1:]
+
+    return ndjson
+
+
+def jsonlines(records, status=200):
+    """ Creates a streamed newline delimited JSON response. Each record is
+    serialized (and sent) as soon as it is produced, so memory use doesn't
+    grow with the size of the result.
+
+    Args:
+        records (Iter[dict]): The records to stream (usually a generator)
+        status (int): The status code (default: 200).
+
+    Returns:
+        (obj): Flask response
+    """
+    def gen_lines():
+        for record in records:
+            yield encode(record) + b'\n'
+
+    lines = stream_with_context(gen_lines())
+    response = Response(lines, status, mimetype=NDJSON_MIMETYPE)
+    response.last_modified = dt.utcnow()
+    return response
+
+
 def parse(string):
     """ Parses a string into an equivalent Python object
 
@@ -115,13 +271,348 @@ def parse(string):
             return string
 
 
+def parse_range(spec, limit=None):
+    """ Parses a page range specification into a list of page numbers
+
+    Args:
+        spec (str): The page range, e.g., '1-5' or '1,3,7-9'
+        limit (int): The max number of pages (default: None, i.e., all of
+            them). Pages past the limit are never generated.
+
+    Returns:
+        (List[int]): page numbers
+
+    Raises:
+        ValueError: If the spec isn't a valid page range
+
+    Examples:
+        >>> parse_range('1-5')
+        [1, 2, 3, 4, 5]
+        >>> parse_range('2')
+        [2]
+        >>> parse_range('1, 3, 7-9')
+        [1, 3, 7, 8, 9]
+        >>> parse_range('1-1000000000', limit=3)
+        [1, 2, 3]
+        >>> parse_range('5-x')
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid page range: 5-x
+    """
+    def gen_pages():
+        for part in str(spec).split(','):
+            first, _, last = part.strip().partition('-')
+
+            try:
+                first, last = int(first), int(last or first)
+            except ValueError:
+                raise ValueError('Invalid page range: {}'.format(spec))
+
+            if first < 1:
+                raise ValueError('Invalid page range: {}'.format(spec))
+
+            for page in range(first, last + 1):
+                yield page
+
+    return list(islice(gen_pages(), limit))
+
+
+def fan_out(func, items, max_workers=None, timeout=None, ordered=True):
+    """ Concurrently applies a function to each item (in the current app
+    context, upstream call priority class, and request deadline)
+
+    Args:
+        func (func): The function to apply
+        items (Iter): The items to apply `func` to
+        max_workers (int): Maximum number of concurrent calls (default: the
+            number of items).
+
+        timeout (float): Number of seconds to wait for all calls to finish
+            (default: None, i.e., wait indefinitely)
+
+        ordered (bool): Yield outcomes in order of `items` once all calls
+            finish. If False, each outcome is yielded as soon as its call
+            finishes (default: True).
+
+    Yields:
+        (Tuple[obj, obj, Exception]): the item, its result, and its error (in
+            order of `items`, or of completion if not `ordered`). Only one of
+            result or error will be set.
+
+    Examples:
+        >>> results = fan_out(lambda x: 10 // x, [1, 2, 0])
+        >>> next(results)
+        (1, 10, None)
+        >>> next(results)
+        (2, 5, None)
+        >>> item, result, error = next(results)
+        >>> isinstance(error, ZeroDivisionError)
+        True
+        >>> from time import sleep
+        >>> func = lambda x: sleep(x) or x
+        >>> [r for _, r, _ in fan_out(func, [0.2, 0], ordered=False)]
+        [0, 0.2]
+    """
+    items = list(items)
+    app = current_app._get_current_object() if has_app_context() else None
+
+    @bind_context
+    def call(item):
+        if app:
+            with app.app_context():
+                return func(item)
+        else:
+            return func(item)
+
+    if len(items) < 2 and timeout is None:
+        for item in items:
+            try:
+                yield (item, call(item), None)
+            except Exception as err:
+                yield (item, None, err)
+
+        return
+
+    outcomes = gen_outcomes(call, items, max_workers, timeout, ordered)
+
+    for outcome in outcomes:
+        yield outcome
+
+
+def make_data_key(prefix, **kwargs):
+    """ Creates a memcache key for an upstream call and its options
+
+    Args:
+        prefix (str): The key prefix, e.g., 'search'
+        kwargs (dict): The upstream call options
+
+    Returns:
+        (str): The cache key
+
+    Examples:
+        >>> key = make_data_key('search', keywords='lego', country='US')
+        >>> key == make_data_key('search', country='US', keywords='lego')
+        True
+        >>> key.startswith('search:')
+        True
+    """
+    options = dumps(kwargs, sort_keys=True, default=str).encode('utf-8')
+    return '{}:{}'.format(prefix, md5(options).hexdigest())
+
+
+def cached_result(key, func, timeout=None, cacheable=None):
+    """ Gets a result from the cache, calling `func` and caching its result
+    on a miss
+
+    Args:
+        key (str): The cache key
+        func (func): Function that fetches the result
+        timeout (int): Cache timeout in seconds (default: None, i.e., the
+            cache's default timeout)
+
+        cacheable (func): Function that determines if a result should be
+            cached (default: results without an error message are cached)
+
+    Returns:
+        (Tuple[obj, bool]): the result and whether it came from the cache
+    """
+    result = cache.get(key)
+    name = 'data:{}'.format(key.split(':')[0])
+
+    if result is None:
+        cache_stats.count(name, 'misses')
+        result = func()
+        cacheable = cacheable or (lambda r: not r.get('message'))
+
+        if cacheable(result):
+            cache.set(key, result, timeout=timeout)
+
+        return result, False
+    else:
+        cache_stats.count(name, 'hits')
+        return result, True
+
+
+class CacheStats(object):
+    """ Thread safe cache hit/miss counters (for this worker)
+    """
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+        self._lock = Lock()
+
+    def count(self, name, outcome, num=1):
+        """ Increments a counter
+
+        Args:
+            name (str): The cache name, e.g., 'view:search'
+            outcome (str): One of 'hits', 'stale', 'not_modified', 'misses',
+                'bypassed', or 'refresh_errors'
+            num (int): The increment (default: 1)
+        """
+        with self._lock:
+            self.counts[name][outcome] += num
+
+        metrics.inc('cache_requests_total', num, cache=name, outcome=outcome)
+
+    def stats(self):
+        """ Gets the counts and hit rate (fresh, stale, or not modified) of
+        each cache
+
+        Returns:
+            (dict): cache statistics
+
+        Examples:
+            >>> cache_stats = CacheStats()
+            >>> cache_stats.count('view:search', 'hits', 3)
+            >>> cache_stats.count('view:search', 'misses')
+            >>> cache_stats.stats()['view:search'] == {
+            ...     'hits': 3, 'stale': 0, 'not_modified': 0, 'misses': 1,
+            ...     'bypassed': 0, 'refresh_errors': 0, 'hit_rate': 0.75}
+            True
+        """
+        with self._lock:
+            counts = {name: Counter(c) for name, c in self.counts.items()}
+
+        stats = {}
+
+        outcomes = [
+            'hits', 'stale', 'not_modified', 'misses', 'bypassed',
+            'refresh_errors']
+
+        for name, count in counts.items():
+            stats[name] = {outcome: count[outcome] for outcome in outcomes}
+            served = count['hits'] + count['stale'] + count['not_modified']
+            total = served + count['misses']
+            rate = round(served / total, 3) if total else None
+            stats[name]['hit_rate'] = rate
+
+        return stats
+
+
+cache_stats = CacheStats()
+
+
+def get_view_options(name, args=None, view_args=None):
+    """ Gets the canonical options of a view call, i.e., its parsed query
+    parameters (including any omitted defaults) and route parameters
+
+    Args:
+        name (str): The view name, e.g., 'search'
+        args (dict): The query parameters (unparsed)
+        view_args (dict): The route parameters
+
+    Returns:
+        (dict): The options
+
+    Examples:
+        >>> CACHE_KEY_DEFAULTS['example'] = {'page': 1}
+        >>> get_view_options('example', {'limit': '10'}) == {
+        ...     'page': 1, 'limit': 10}
+        True
+    """
+    args = args or {}
+    defaults = CACHE_KEY_DEFAULTS.get(name) or {}
+    options = dict(defaults(args) if callable(defaults) else defaults)
+
+    for key, value in args.items():
+        options[key] = parse(value) if hasattr(value, 'lower') else value
+
+    options.update(view_args or {})
+    return options
+
+
+def get_tags(endpoint, options=None):
+    """ Gets the invalidation tags of a cache entry: its endpoint, country,
+    endpoint and country, and entity IDs (see `ENTITY_TAGS`)
+
+    Args:
+        endpoint (str): The endpoint (view) name, e.g., 'search'
+        options (dict): The call options, e.g., `get_view_options` or a
+            Finding search's options
+
+    Returns:
+        (List[str]): The tags
+
+    Examples:
+        >>> get_tags('item', {'country': 'UK', 'item_id': '1'}) == [
+        ...     'item', 'country:UK', 'item:country:UK', 'item:1']
+        True
+        >>> get_tags('sub_category', {'name': 'Art'}) == [
+        ...     'sub_category', 'category:Art']
+        True
+    """
+    options = options or {}
+    country = options.get('country')
+    tags = [endpoint]
+
+    if country:
+        tags.append('country:{}'.format(country))
+        tags.append('{}:country:{}'.format(endpoint, country))
+
+    for option, tag in ENTITY_TAGS:
+        if options.get(option) is not None:
+            tags.append('{}:{}'.format(tag, options[option]))
+
+    return tags
+
+
+def make_tagged_key(key, tags):
+    """ Adds the current generations of `tags` to a cache key (see
+    `app.caches.tag_key`)
+
+    Args:
+        key (str): The cache key
+        tags (List[str]): The key's tags (see `get_tags`)
+
+    Returns:
+        (str): The tagged cache key
+    """
+    return tag_key(key, tags, get_generations(cache, tags))
+
+
+def make_view_key(name, args=None, view_args=None, tagged=False):
+    """ Creates a canonical memcache key for a view call. Aliases of a route
+    (e.g., '/search/' and '/api/v1/search/') share the same key, as do
+    query strings that only differ in parameter order, value formatting, or
+    explicitly passed defaults.
+
+    Args:
+        name (str): The view name, e.g., 'search'
+        args (dict): The query parameters (unparsed)
+        view_args (dict): The route parameters
+        tagged (bool): Add the current generations of the call's tags (see
+            `get_tags`) to the key
+
+    Returns:
+        (str): The cache key
+
+    Examples:
+        >>> CACHE_KEY_DEFAULTS['example'] = {'page': 1}
+        >>> key = make_view_key('example', {'q': 'lego', 'limit': '10'})
+        >>> key == make_view_key(
+        ...     'example', {'limit': 10, 'q': 'lego', 'page': '1'})
+        True
+        >>> key == make_view_key('example', {'q': 'lego', 'limit': '10.5'})
+        False
+        >>> key.startswith('view:example:')
+        True
+    """
+    options = get_view_options(name, args, view_args)
+    key = make_data_key('view:{}'.format(name), **options)
+    return make_tagged_key(key, get_tags(name, options)) if tagged else key
+
+
 def make_cache_key(*args, **kwargs):
-    """ Creates a memcache key for a url and its query parameters
+    """ Creates a canonical, tagged memcache key for the current request (see
+    `make_view_key`)
 
     Returns:
-        (obj): Flask request url
+        (str): The cache key
     """
-    return request.url
+    name = request.endpoint.rpartition('.')[2]
+    args = request.args.to_dict()
+    args.pop(PROFILE_ARG, None)
+    return make_view_key(name, args, request.view_args, True)
 
 
 def fmt_elapsed(elapsed):
@@ -172,14 +663,264 @@ def get(url):
 # https://gist.github.com/glenrobertson/954da3acec84606885f5
 # http://stackoverflow.com/a/23115561/408556
 # https://github.com/pallets/flask/issues/637
-def cache_header(max_age, **ckwargs):
+def make_envelope(response, max_age, previous=None):
+    """ Wraps a response for caching
+
+    The response's validators (a content hash ETag and Last-Modified) are
+    kept alongside the body. If the body hasn't changed since the `previous`
+    envelope, its Last-Modified is kept so the validators stay stable across
+    refreshes.
+
+    Args:
+        response (obj): Flask response
+        max_age (int): Number of seconds the response stays fresh
+        previous (dict): The envelope (or metadata) being replaced
+
+    Returns:
+        (dict): The cache envelope
+    """
+    fresh_until = time() + max_age
+    etag = response.get_etag()[0]
+
+    if not etag:
+        response.add_etag()
+        etag = response.get_etag()[0]
+
+    if previous and previous.get('etag') == etag:
+        response.headers['Last-Modified'] = previous['last_modified']
+
+    return {
+        'data': response.get_data(), 'status': response.status_code,
+        'headers': list(response.headers.items()), 'fresh_until': fresh_until,
+        'refresh_after': fresh_until, 'etag': etag,
+        'last_modified': response.headers.get('Last-Modified')}
+
+
+def uncacheable(response):
+    """ Marks a response that `cache_header` mustn't cache, e.g., a partial
+    result
+
+    Args:
+        response (obj): Flask response
+
+    Returns:
+        (obj): The response
+    """
+    response.cacheable = False
+    return response
+
+
+def is_cacheable(response):
+    ok = response.status_code == 200 and not response.is_streamed
+    return ok and getattr(response, 'cacheable', True)
+
+
+def get_meta_key(key):
+    return '{}:meta'.format(key)
+
+
+def store_envelope(key, envelope, timeout):
+    """ Caches an envelope and (separately) its metadata, so conditional
+    requests can be answered without loading the body
+
+    Args:
+        key (str): The cache key
+        envelope (dict): The cache envelope (see `make_envelope`)
+        timeout (int): Cache timeout in seconds
+    """
+    names = ['etag', 'last_modified', 'fresh_until', 'refresh_after']
+    meta = {name: envelope[name] for name in names}
+    cache.set_many({key: envelope, get_meta_key(key): meta}, timeout=timeout)
+
+
+def is_conditional():
+    headers = ['HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE']
+    return any(request.environ.get(header) for header in headers)
+
+
+def make_not_modified(meta):
+    """ Creates a (bodiless) 304 response from cached metadata
+
+    Args:
+        meta (dict): The cached metadata (see `store_envelope`)
+
+    Returns:
+        (obj): Flask response
+    """
+    response = current_app.response_class(status=304)
+    response.set_etag(meta['etag'])
+
+    if meta['last_modified']:
+        response.headers['Last-Modified'] = meta['last_modified']
+
+    return response
+
+
+def open_envelope(envelope):
+    """ Recreates a cached response
+
+    Args:
+        envelope (dict): The cache envelope (see `make_envelope`)
+
+    Returns:
+        (obj): Flask response
+    """
+    return current_app.response_class(
+        envelope['data'], status=envelope['status'],
+        headers=envelope['headers'])
+
+
+def get_cached(key):
+    """ Gets a cached view response for the current request. Conditional
+    requests that match the cached validators are answered from the cached
+    metadata alone, i.e., without loading the body.
+
+    Args:
+        key (str): The cache key
+
+    Returns:
+        (Tuple[dict, obj, str]): The cache envelope (or metadata), response,
+            and outcome ('hits', 'stale', 'not_modified', or 'misses'). The
+            envelope and response are None on a miss.
+    """
+    meta = cache.get(get_meta_key(key)) if is_conditional() else None
+    modified = meta is None or is_resource_modified(
+        request.environ, etag=meta['etag'], last_modified=meta['last_modified'])
+
+    if not modified:
+        return meta, make_not_modified(meta), 'not_modified'
+
+    envelope = cache.get(key)
+
+    if envelope is None:
+        return None, None, 'misses'
+
+    outcome = 'hits' if time() < envelope['fresh_until'] else 'stale'
+    return envelope, open_envelope(envelope), outcome
+
+
+def refresh(app, environ, view, key, max_age, stale_for, *args, **kwargs):
+    """ Re-renders a stale cached view response (in the background). If the
+    view fails, the stale response is kept (and retried) for another
+    `stale_for` seconds.
+
+    Args:
+        app (obj): Flask app
+        environ (dict): The WSGI environment of the stale request
+        view (func): The view function
+        key (str): The cache key
+        max_age (int): Number of seconds the response stays fresh
+        stale_for (int): Number of seconds a stale response may be served
+        args (tuple): The view's positional arguments
+        kwargs (dict): The view's keyword arguments
+    """
+    with app.request_context(environ), scheduler.priority('background'):
+        try:
+            response = view(*args, **kwargs)
+        except Exception as err:
+            logger.error('Failed to refresh %s: %s', key, err)
+            response = None
+
+        try:
+            if response and is_cacheable(response):
+                previous = cache.get(get_meta_key(key))
+                envelope = make_envelope(response, max_age, previous)
+                store_envelope(key, envelope, max_age + stale_for)
+            else:
+                envelope = cache.get(key)
+                name = 'view:{}'.format(request.endpoint.rpartition('.')[2])
+                cache_stats.count(name, 'refresh_errors')
+
+                if envelope:
+                    envelope['refresh_after'] = time() + STALE_RETRY_INTERVAL
+                    store_envelope(key, envelope, stale_for)
+        finally:
+            with refresh_lock:
+                refreshing.discard(key)
+
+
+def schedule_refresh(view, key, max_age, stale_for, *args, **kwargs):
+    """ Refreshes a stale cached view response in the background, unless it
+    is already being refreshed
+
+    Returns:
+        (bool): Whether a refresh was scheduled
+    """
+    with refresh_lock:
+        scheduled = key not in refreshing
+        refreshing.add(key)
+
+    if scheduled:
+        app = current_app._get_current_object()
+        environ = dict(request.environ)
+        args = (app, environ, view, key, max_age, stale_for) + args
+        refresher.submit(refresh, *args, **kwargs)
+
+    return scheduled
+
+
+def set_cache_headers(response, fresh_until=None, stale_for=0):
+    """ Sets a response's caching headers from its cached freshness
+
+    Args:
+        response (obj): Flask response
+        fresh_until (float): When the (cached) response goes stale (default:
+            None, i.e., the response mustn't be stored)
+
+        stale_for (int): Number of seconds a stale response may be served
+            while it is refreshed
+
+    Examples:
+        >>> from flask import Response
+        >>> response = Response()
+        >>> set_cache_headers(response, time() - 10, 60)
+        >>> response.headers['Cache-Control']
+        'max-age=0, public, stale-while-revalidate=50'
+        >>> set_cache_headers(response)
+        >>> response.cache_control.no_store
+        True
+    """
+    if fresh_until is None:
+        response.headers['Pragma'] = 'no-cache'
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+        response.cache_control.no_cache = True
+        response.cache_control.no_store = True
+        response.cache_control.public = False
+        response.headers['Expires'] = '-1'
+        return
+
+    now = time()
+    fresh_for = max(int(round(fresh_until - now)), 0)
+    stale_for = max(int(round(fresh_until + stale_for - now)) - fresh_for, 0)
+    response.cache_control.max_age = fresh_for
+    response.cache_control.public = True
+    response.expires = dt.utcnow() + timedelta(seconds=fresh_for)
+
+    if stale_for:
+        response.cache_control['stale-while-revalidate'] = stale_for
+
+
+def cache_header(max_age, defaults=None, stale_for=None, **ckwargs):
     """
     Add Flask cache response headers based on max_age in seconds.
 
-    If max_age is 0, caching will be disabled.
-    Otherwise, caching headers are set to expire in now + max_age seconds
-    If round_to_minute is True, then it will always expire at the start of a
-    minute (seconds = 0)
+    The response is cached under `make_cache_key` (pass `defaults`, a dict or
+    a function of the query parameters that returns a dict, to have requests
+    that omit default query parameters share a key with those that don't).
+    Cache hits and misses are counted in `cache_stats`.
+
+    Cached responses stay fresh for max_age seconds and may then be served
+    stale for another `stale_for` seconds (default: CACHE_STALE_TIMEOUT)
+    while they are refreshed in the background. Only successful responses
+    are cached (see `uncacheable`). Conditional requests (If-None-Match or
+    If-Modified-Since) that match the cached validators get a 304 without
+    the view running or the cached body being loaded.
+
+    If max_age is 0, caching will be disabled. Otherwise, cacheable responses
+    are public until the cached response goes stale (and may then be served
+    stale while revalidating), and other responses, e.g., errors or partial
+    results, are never stored (see `set_cache_headers`).
 
     Example usage:
 
@@ -189,25 +930,40 @@ def cache_header(max_age, **ckwargs):
         return render_template('index.html')
 
     """
+    # streamed (NDJSON) responses can't be cached
+    unless = ckwargs.get('unless', wants_ndjson)
+    key_prefix = ckwargs.get('key_prefix', make_cache_key)
+    stale_for = STALE_TIMEOUT if stale_for is None else stale_for
+
     def decorator(view):
-        f = cache.cached(max_age, **ckwargs)(view)
+        name = view.__name__
+        stat_name = 'view:{}'.format(name)
+        CACHE_KEY_DEFAULTS[name] = defaults
 
-        @wraps(f)
-        def wrapper(*args, **wkwargs):
-            response = f(*args, **wkwargs)
-            response.cache_control.max_age = max_age
+        def get_response(*args, **kwargs):
+            if not max_age or unless():
+                cache_stats.count(stat_name, 'bypassed')
+                return view(*args, **kwargs), None
 
-            if max_age:
-                response.cache_control.public = True
-                extra = timedelta(seconds=max_age)
-                response.expires = response.last_modified + extra
-            else:
-                response.headers['Pragma'] = 'no-cache'
-                response.cache_control.must_revalidate = True
-                response.cache_control.no_cache = True
-                response.cache_control.no_store = True
-                response.expires = '-1'
+            key = key_prefix()
+            envelope, response, outcome = get_cached(key)
+            cache_stats.count(stat_name, outcome)
 
+            if envelope is None:
+                response = view(*args, **kwargs)
+
+                if is_cacheable(response):
+                    envelope = make_envelope(response, max_age)
+                    store_envelope(key, envelope, max_age + stale_for)
+            elif time() >= envelope['refresh_after']:
+                schedule_refresh(view, key, max_age, stale_for, *args, **kwargs)
+
+            return response, envelope and envelope['fresh_until']
+
+        @wraps(view)
+        def wrapper(*args, **wkwargs):
+            response, fresh_until = get_response(*args, **wkwargs)
+            set_cache_headers(response, fresh_until, stale_for)
             return response.make_conditional(request)
         return wrapper
 
@@ -13,16 +13,32 @@ try:
 except ImportError:
     from urllib import unquote
 
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from concurrent import futures
+from itertools import islice
+from math import ceil
 from random import choice
 
 from ebaysdk.exception import ConnectionError
-from flask import Blueprint, request, url_for
+from flask import Blueprint, request, url_for, g, make_response
 
 from config import Config
 
-from app import cache
+from app import cache, clients, category_indexes, flights, item_cache
 from app.api import Trading, Finding, Shopping
-from app.utils import make_cache_key, jsonify, BACON_IPSUM, cache_header, parse
+from app.upstream import scheduler, resilience, timeouts, Unavailable
+from app.entities import get_shipping_section
+from app.metrics import metrics, render, CONTENT_TYPE
+from app.profiling import profiler
+from app.utils import (
+    jsonify, BACON_IPSUM, cache_header, parse, parse_range, fan_out,
+    make_data_key, cached_result, jsonlines, wants_ndjson, make_view_key,
+    cache_stats, get_tags, make_tagged_key, get_request_args, uncacheable)
+from app.caches import get_generations, tag_key, invalidate_tag
 
 from builtins import *  # noqa  # pylint: disable=unused-import
 
@@ -32,13 +48,127 @@ PREFIX = Config.API_URL_PREFIX
 CACHE_TIMEOUT = Config.CACHE_TIMEOUT
 CAT_CACHE_TIMEOUT = Config.CAT_CACHE_TIMEOUT
 SUB_CAT_CACHE_TIMEOUT = Config.SUB_CAT_CACHE_TIMEOUT
+SEARCH_MAX_PAGES = Config.SEARCH_MAX_PAGES
+FAN_OUT_MAX_WORKERS = Config.FAN_OUT_MAX_WORKERS
+SITE_DEADLINE = Config.SEARCH_SITE_DEADLINE
+BATCH_MAX_ITEMS = Config.BATCH_MAX_ITEMS
+SHIP_BATCH_MAX_WORKERS = Config.SHIP_BATCH_MAX_WORKERS
+REQUEST_DEADLINE = Config.REQUEST_DEADLINE
+UPSTREAM_MAX_TIMEOUT = Config.UPSTREAM_MAX_TIMEOUT
+
+COUNTRY_DEFAULTS = {'country': 'US'}
+SHIP_DEFAULTS = {'country': 'US', 'dest': 'US', 'details': False}
+
+
+def get_search_defaults(args):
+    return {
+        'country': 'US', 'verb': 'findItemsAdvanced', 'page': 1,
+        'sort_order': 'EndTimeSoonest',
+        'limit': 100 if args.get('max_results') else 10}
+
+
+def get_deadline():
+    """Get the number of seconds a request's upstream calls may take. A
+    client may ask for less via the `X-Request-Deadline` header.
+    """
+    try:
+        seconds = float(request.headers.get('X-Request-Deadline', 'inf'))
+    except ValueError:
+        seconds = REQUEST_DEADLINE
+
+    return min(seconds, REQUEST_DEADLINE)
+
+
+def get_call_timeout():
+    """Get the timeout a client asked for (via `timeout`) of each of the
+    request's upstream calls.
+    """
+    try:
+        seconds = float(request.args.get('timeout') or 0)
+    except ValueError:
+        seconds = 0
+
+    return min(seconds, UPSTREAM_MAX_TIMEOUT) if seconds > 0 else None
+
+
+# `create_app` registers the blueprint before Flask-Compress, so the app
+# wide `after_app_request` hooks run after the response is compressed
+@blueprint.before_app_request
+def start_profiler():
+    requested = profiler.is_requested(request.args, request.headers)
+
+    if requested and not profiler.is_authorized(request.headers):
+        return jsonify(403, objects='Profiling requires a valid admin token')
+    elif requested or profiler.sampling:
+        profiler.start(profile=requested)
+
+
+@blueprint.after_app_request
+def stop_profiler(response):
+    report = profiler.stop()
+
+    if report:
+        info = {
+            'endpoint': request.endpoint, 'url': request.full_path,
+            'status': response.status_code,
+            'size': response.calculate_content_length()}
+
+        profiler.record(report, **info)
+
+        # profiled requests get the report instead of the response
+        if 'functions' in report:
+            response = jsonify(objects=dict(report, **info))
+
+    return response
+
+
+@blueprint.teardown_app_request
+def clear_profiler(err=None):
+    # e.g., if the view raised an error
+    profiler.stop()
+
+
+@blueprint.before_request
+def set_deadline():
+    g.start = monotonic()
+
+    if REQUEST_DEADLINE:
+        timeouts.set_deadline(monotonic() + get_deadline())
+
+    timeouts.set_limit(get_call_timeout())
+
+
+@blueprint.after_request
+def record_metrics(response):
+    endpoint = request.endpoint.rpartition('.')[2]
+    start = g.get('start')
+
+    # an earlier hook may have responded before `set_deadline` ran
+    if start is not None:
+        elapsed = monotonic() - start
+        metrics.observe('request_seconds', elapsed, endpoint=endpoint)
+
+    size = response.calculate_content_length()
+
+    # streamed responses have no length
+    if size is not None:
+        metrics.observe('response_bytes', size, endpoint=endpoint)
+
+    metrics.maybe_flush()
+    return response
+
+
+@blueprint.teardown_request
+def clear_deadline(err=None):
+    timeouts.set_deadline(None)
+    timeouts.set_limit(None)
 
 
 # API routes
 @blueprint.route('/search/')
 @blueprint.route('/api/search/')
 @blueprint.route('{}/search/'.format(PREFIX))
-@cache_header(CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(CACHE_TIMEOUT, defaults=get_search_defaults)
 def search():
     """Perform an eBay site search
 
@@ -49,23 +179,43 @@ def search():
         cid (int): ID of the category to display (either this or the 'q'
             parameter is required)
 
-        country (str): eBay country (one of ['US', 'UK'], default: 'US')
+        country (str): eBay country (one of ['US', 'UK', 'FR', 'DE', 'IT', 'ES',
+            'CA'], default: 'US'). Multiple sites are searched concurrently
+            given either a comma separated list, e.g., 'US,UK,DE', or 'all'.
+
+        deadline (float): Number of seconds to wait for each site in a
+            multiple site search (default: 10)
+
         verb (str): The type of search to perform (one of ['findCompletedItems',
-            'findItemsAdvanced', 'findItemsByCategory', 'findItemsByKeywords',
-            'findItemsByProduct', 'findItemsIneBayStores', 'getHistograms'],
-            default: 'findItemsAdvanced')
+            'findItemsAdvanced', 'findItemsByCategory', 'findItemsByImage',
+            'findItemsByKeywords', 'findItemsByProduct',
+            'findItemsIneBayStores', 'getHistograms'], default:
+            'findItemsAdvanced')
 
         sort_order (str): Sort order (one of ['BestMatch',
             'CurrentPriceHighest', 'DistanceNearest', 'EndTimeSoonest',
             'PricePlusShippingHighest', 'PricePlusShippingLowest',
             'StartTimeNewest'], default: 'EndTimeSoonest')
 
-        limit (int): Number of results to return (default: 10)
+        limit (int): Number of results to return per page (default: 10, or
+            100 if 'max_results' is given)
+
         page (int): The results page to view (default: 1)
+        pages (str): A range of results pages to view concurrently, e.g.,
+            '1-5' (overrides 'page')
+
+        max_results (int): Maximum number of results to return (fetches as
+            many pages as needed starting at 'page')
+
+        format (str): Set to 'ndjson' to stream one result per line as each
+            page arrives (same as sending 'Accept: application/x-ndjson')
     """
-    kwargs = {k: parse(v) for k, v in request.args.to_dict().items()}
+    kwargs = get_request_args()
     query = kwargs.pop('q', None)
     cid = kwargs.pop('cid', None)
+    spec = request.args.get('pages')
+    kwargs.pop('pages', None)
+    max_results = kwargs.pop('max_results', None)
 
     if query:
         kwargs.setdefault('keywords', query)
@@ -75,29 +225,230 @@ def search():
 
     kwargs.setdefault('sortOrder', kwargs.pop('sort_order', 'EndTimeSoonest'))
     kwargs.setdefault('verb', 'findItemsAdvanced')
-    limit = kwargs.pop('limit', 10)
+    limit = kwargs.pop('limit', 100 if max_results else 10)
     page = kwargs.pop('page', 1)
-    finding = Finding(**kwargs)
+    countries = get_countries(kwargs.get('country', 'US'))
 
-    options = {'paginationInput': {'entriesPerPage': limit, 'pageNumber': page}}
-    options.update(kwargs)
+    if kwargs['verb'] not in Finding.verbs:
+        # unknown verbs would each get their own metrics, timeouts, and breaker
+        return jsonify(400, objects='Invalid verb: {}'.format(kwargs['verb']))
+
+    if not any(c in Finding.global_ids for c in countries):
+        msg = 'Invalid country: {}'.format(','.join(countries))
+        return jsonify(400, objects=msg)
 
     try:
-        response = finding.search(options)
-    except ConnectionError as err:
-        result = str(err)
-        status = 500
+        deadline = get_site_deadline(kwargs.pop('deadline', None))
+        pages = get_pages(spec, page, max_results, limit)
+    except ValueError as err:
+        return jsonify(400, objects=str(err))
+
+    skwargs = {'pages': pages, 'limit': limit, 'max_results': max_results}
+
+    if wants_ndjson():
+        kwargs.pop('country', None)
+        records = gen_search_records(kwargs, countries, deadline, **skwargs)
+        return jsonlines(records)
+
+    if len(countries) > 1:
+        kwargs.pop('country')
+        result, status = search_sites(kwargs, countries, deadline, **skwargs)
     else:
-        result = finding.parse(response)
+        site_kwargs = dict(kwargs, country=countries[0])
+        result, status = search_site(site_kwargs, **skwargs)
+
+    response = jsonify(status, objects=result)
+
+    # don't cache partial results, e.g., when some pages were throttled
+    partial = status == 200 and result.get('message')
+    return uncacheable(response) if partial else response
+
+
+def search_site(kwargs, pages, limit, max_results=None):
+    finding = clients.get(Finding, **kwargs)
+
+    def fetch(page):
+        return search_page(finding, get_page_options(kwargs, limit, page))
+
+    parsed, errors = [], []
+
+    for _, page_result, err in fan_out(fetch, pages, FAN_OUT_MAX_WORKERS):
+        if err:
+            errors.append(err)
+        else:
+            parsed.append(page_result)
+
+    if parsed:
+        result = finding.merge(parsed)
         status = 200
 
-    return jsonify(status, objects=result)
+        if max_results:
+            results = islice(result['results'].items(), max_results)
+            result['results'] = dict(results)
+
+        if errors:
+            messages = [result['message']] if result['message'] else []
+            result['message'] = '; '.join(messages + [str(e) for e in errors])
+    else:
+        result = '; '.join(str(e) for e in errors)
+        unavailable = all(isinstance(e, Unavailable) for e in errors)
+        status = errors[0].status if unavailable else 500
+
+    return result, status
+
+
+def search_sites(kwargs, countries, deadline, **skwargs):
+    def search_country(country):
+        start = monotonic()
+        site_kwargs = dict(kwargs, country=country)
+        result, status = search_site(site_kwargs, **skwargs)
+        return result, status, monotonic() - start
+
+    merged = {'results': {}, 'pages': 0, 'message': None, 'sites': {}}
+    valid = [c for c in countries if c in Finding.global_ids]
+
+    for country in set(countries).difference(valid):
+        site = {'status': 'error', 'message': 'Invalid country'}
+        merged['sites'][country] = site
+
+    for country, res, err in fan_out(search_country, valid, timeout=deadline):
+        if err:
+            timed_out = isinstance(err, futures.TimeoutError)
+            site = {
+                'status': 'timeout' if timed_out else 'error',
+                'message': str(err), 'elapsed': deadline if timed_out else None}
+        else:
+            result, status, elapsed = res
+            site = {'elapsed': round(elapsed, 3)}
+
+            if status == 200:
+                results = result['results']
+                site.update({
+                    'status': 'ok', 'message': result['message'],
+                    'pages': result['pages'], 'results': len(results)})
+
+                merged['results'].update(
+                    ('{}:{}'.format(country, k), v) for k, v in results.items())
+
+                pages = max(int(merged['pages']), int(result['pages']))
+                merged['pages'] = pages
+            else:
+                site.update({'status': 'error', 'message': result})
+
+        merged['sites'][country] = site
+
+    ok = any(s['status'] == 'ok' for s in merged['sites'].values())
+    return merged, 200 if ok else 500
+
+
+def gen_search_records(kwargs, countries, deadline, pages, limit,
+                       max_results=None):
+    """Yields search results one at a time, as soon as their page arrives.
+    Pages that fail are yielded as {'country', 'page', 'message'} records.
+    """
+    valid = [c for c in countries if c in Finding.global_ids]
+    tasks = [(country, page) for country in valid for page in pages]
+    timeout = deadline if len(countries) > 1 else None
+    seen = set()
+
+    for country in set(countries).difference(valid):
+        yield {'country': country, 'message': 'Invalid country'}
+
+    def fetch(task):
+        country, page = task
+        finding = clients.get(Finding, country=country, **kwargs)
+        return search_page(finding, get_page_options(kwargs, limit, page))
+
+    outcomes = fan_out(
+        fetch, tasks, FAN_OUT_MAX_WORKERS, timeout=timeout, ordered=False)
+
+    for (country, page), result, err in outcomes:
+        message = str(err) if err else result['message']
+
+        if message:
+            yield {'country': country, 'page': page, 'message': message}
+
+        for item_id, item in (result['results'].items() if result else []):
+            if (country, item_id) not in seen:
+                seen.add((country, item_id))
+                yield item
+
+            if max_results and len(seen) >= max_results:
+                return
+
+
+def get_page_options(kwargs, limit, page):
+    pagination = {'entriesPerPage': limit, 'pageNumber': page}
+    options = {'paginationInput': pagination}
+    options.update(kwargs)
+    return options
+
+
+def get_countries(country):
+    if country == 'all':
+        countries = sorted(Finding.global_ids)
+    else:
+        countries = [c.strip().upper() for c in str(country).split(',')]
+
+    return countries
+
+
+def get_site_deadline(deadline=None):
+    """Get the number of seconds (at most `SITE_DEADLINE`) to wait for each
+    site in a multiple site search.
+
+    Raises:
+        ValueError: If `deadline` isn't a positive number
+    """
+    try:
+        seconds = SITE_DEADLINE if deadline is None else float(deadline)
+    except (TypeError, ValueError):
+        seconds = 0
+
+    # `not >` also rejects nan
+    if not seconds > 0:
+        raise ValueError("'deadline' must be a positive number")
+
+    return min(seconds, SITE_DEADLINE)
+
+
+def get_pages(spec=None, page=1, max_results=None, limit=10):
+    """Get the (at most `SEARCH_MAX_PAGES`) results pages to fetch.
+
+    Raises:
+        ValueError: If an argument is invalid
+    """
+    numbers = {'page': page, 'limit': limit, 'max_results': max_results}
+
+    for name, value in numbers.items():
+        valid = isinstance(value, int) and value > 0
+
+        if not (valid or (name == 'max_results' and value is None)):
+            msg = "'{}' must be a positive integer"
+            raise ValueError(msg.format(name))
+
+    if spec:
+        pages = parse_range(spec, SEARCH_MAX_PAGES)
+    elif max_results:
+        num_pages = int(ceil(max_results / limit))
+        pages = range(page, page + min(num_pages, SEARCH_MAX_PAGES))
+    else:
+        pages = [page]
+
+    return list(pages)
+
+
+def search_page(finding, options):
+    tags = get_tags('search', dict(options, country=finding.kwargs['country']))
+    key = make_tagged_key(make_data_key('search', **options), tags)
+    fetch = lambda: finding.fetch(options)
+    return cached_result(key, fetch, CACHE_TIMEOUT)[0]
 
 
 @blueprint.route('/ship/<item_id>/')
 @blueprint.route('/api/ship/<item_id>/')
 @blueprint.route('{}/ship/<item_id>/'.format(PREFIX))
-@cache_header(CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(CACHE_TIMEOUT, defaults=SHIP_DEFAULTS)
 def ship(item_id):
     """Calculate an item's shipping cost
 
@@ -114,16 +465,98 @@ def ship(item_id):
         details (bool): include details? (default: False)
         quantity (int): quantity to ship (default: 1)
     """
-    kwargs = {k: parse(v) for k, v in request.args.to_dict().items()}
-    dest = kwargs.pop('dest', 'US')
-    code = kwargs.pop('code', None)
+    kwargs = get_request_args()
+    shopping = clients.get(Shopping, **kwargs)
+
+    try:
+        result = get_shipping(shopping, item_id, **kwargs)[0]
+    except ConnectionError as err:
+        result = str(err)
+        status = 500
+    else:
+        status = 200
+
+    return jsonify(status, objects=result)
+
+
+@blueprint.route('/ship/', methods=['POST'])
+@blueprint.route('/api/ship/', methods=['POST'])
+@blueprint.route('{}/ship/'.format(PREFIX), methods=['POST'])
+def ship_batch():
+    """Calculate the shipping costs of multiple items
+
+    Kwargs:
+        items (str): IDs of the items to ship (either a JSON list or a comma
+            separated string)
+
+        country (str): origin country (one of ['US', 'UK'], default: 'US')
+        dest (str): destination country (see
+            http://www.airlinecodes.co.uk/country.asp for valid codes,
+            default: 'US')
+
+        code (str): destination postal code (required if 'dest' is 'US')
+        details (bool): include details? (default: False)
+        quantity (int): quantity to ship (default: 1)
+    """
+    try:
+        data, item_ids = get_batch()
+    except ValueError as err:
+        return jsonify(400, objects=str(err))
+
+    if not item_ids:
+        return jsonify(400, objects="At least one item ID must be provided")
+    elif len(item_ids) > BATCH_MAX_ITEMS:
+        msg = 'No more than {} items may be shipped at once'
+        return jsonify(400, objects=msg.format(BATCH_MAX_ITEMS))
+
+    shopping = clients.get(Shopping, **data)
+    fetch = lambda item_id: get_shipping(shopping, item_id, **data)
+    results = {}
+
+    for item_id, res, err in fan_out(fetch, item_ids, SHIP_BATCH_MAX_WORKERS):
+        if err:
+            result = {'item_id': item_id, 'message': str(err)}
+            cached = False
+        else:
+            result, cached = res[0]['results'], res[1]
+
+        status = 'error' if result.get('message') else 'ok'
+        results[item_id] = dict(result, status=status, cached=cached)
+
+    return jsonify(objects={'results': results})
+
+
+def get_batch():
+    """Get a batch request's options and item IDs.
+
+    Raises:
+        ValueError: If the JSON body isn't an object
+    """
+    data = request.get_json(silent=True)
+
+    if data is None:
+        data = {k: parse(v) for k, v in request.form.to_dict().items()}
+    elif not isinstance(data, dict):
+        raise ValueError('The request body must be a JSON object')
+
+    items = data.pop('items', None) or []
+
+    # numeric form values, e.g., '1,2', are parsed into tuples
+    if not isinstance(items, (list, tuple)):
+        items = str(items).split(',')
+
+    item_ids = [str(item_id).strip() for item_id in items if item_id]
+    return data, item_ids
+
+
+def get_shipping(shopping, item_id, dest='US', code=None, **kwargs):
     details = kwargs.pop('details', None)
     quantity = kwargs.pop('quantity', None)
     options = {
         'ItemID': item_id, 'MessageID': item_id, 'DestinationCountryCode': dest}
 
     if code:
-        options['DestinationPostalCode'] = code
+        options['DestinationPostalCode'] = str(code)
 
     if details:
         options['IncludeDetails'] = details
@@ -132,39 +565,46 @@ def ship(item_id):
         options['QuantitySold'] = quantity
 
     options.update(kwargs)
-    shopping = Shopping(**kwargs)
+    country = shopping.kwargs['country']
+    section = get_shipping_section(options)
+    cached = item_cache.lookup(country, item_id, [section])
 
-    try:
-        response = shopping.search(options)
-    except ConnectionError as err:
-        result = str(err)
-        status = 500
+    if cached is None:
+        result = shopping.fetch(options)
     else:
-        result = shopping.parse(response)
-        status = 200
+        result = {'results': cached}
 
-    return jsonify(status, objects=result)
+    return result, cached is not None
 
 
-@cache.memoize(CAT_CACHE_TIMEOUT)
 def get_categories(**kwargs):
-    trading = Trading(**kwargs)
-    response = trading.get_categories()
-    return trading.parse(response.CategoryArray.Category)
+    index = category_indexes.get(**kwargs)
+    return index.top_level() if index else fetch_categories(**kwargs)
+
+
+@cache.memoize(CAT_CACHE_TIMEOUT)
+def fetch_categories(**kwargs):
+    return clients.get(Trading, **kwargs).fetch_categories()
 
 
 @blueprint.route('/category/')
 @blueprint.route('/api/category/')
 @blueprint.route('{}/category/'.format(PREFIX))
-@cache_header(CAT_CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(CAT_CACHE_TIMEOUT, defaults=COUNTRY_DEFAULTS)
 def category():
     """Get all eBay categories
 
     Kwargs:
         country (str): eBay country (one of ['US', 'UK'], default: 'US')
+        format (str): Set to 'ndjson' to stream one category per line
     """
-    kwargs = {k: parse(v) for k, v in request.args.to_dict().items()}
-    return jsonify(objects=get_categories(**kwargs))
+    kwargs = get_request_args()
+    categories = get_categories(**kwargs)
+
+    if wants_ndjson():
+        return jsonlines(categories)
+    else:
+        return jsonify(objects=categories)
 
 
 @blueprint.route('/category/<int:cid>/')
@@ -173,7 +613,7 @@ def category():
 @blueprint.route('{}/category/<int:cid>/'.format(PREFIX))
 @blueprint.route('{}/category/<name>/'.format(PREFIX))
 @blueprint.route('{}/category/<name>/subcategories/'.format(PREFIX))
-@cache_header(SUB_CAT_CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(SUB_CAT_CACHE_TIMEOUT, defaults=COUNTRY_DEFAULTS)
 def sub_category(name=None, cid=None):
     """Get all subcategories of a given eBay category
 
@@ -183,44 +623,51 @@ def sub_category(name=None, cid=None):
 
     Kwargs:
         country (str): eBay country (one of ['US', 'UK'], default: 'US')
+        format (str): Set to 'ndjson' to stream one category per line
     """
     if not (name or cid):
         return jsonify(400, objects="Either 'name' or 'id' must be provided")
 
-    kwargs = {k: parse(v) for k, v in request.args.to_dict().items()}
-    trading = Trading(**kwargs)
+    kwargs = get_request_args()
+    index = category_indexes.get(**kwargs)
     url = url_for('blueprint.category', _external=True)
     msg = "Category {} doesn't exist. View {} to see valid categories."
 
+    if index:
+        cid = cid or index.resolve(unquote(name))
+        result = index.subtree(cid) if cid else None
+    else:
+        result = fetch_sub_categories(name, cid, **kwargs)
+
+    if result and wants_ndjson():
+        return jsonlines(result)
+    elif result:
+        status = 200
+    else:
+        result = msg.format(cid or name, url)
+        status = 404
+
+    return jsonify(status, objects=result)
+
+
+def fetch_sub_categories(name=None, cid=None, **kwargs):
+    trading = clients.get(Trading, **kwargs)
+
     if name and not cid:
-        categories = get_categories(**kwargs)
-        lookup = trading.make_lookup(categories)
+        lookup = trading.make_lookup(fetch_categories(**kwargs))
 
         try:
             cid = lookup[unquote(name.lower())]['id']
         except KeyError:
             pass
 
-    response = trading.get_hierarchy(cid) if cid else None
-
-    try:
-        result = trading.parse(response.CategoryArray.Category)
-    except AttributeError:
-        result = msg.format(name, url)
-        status = 404
-    except TypeError:
-        result = msg.format(cid, url)
-        status = 404
-    else:
-        status = 200
-
-    return jsonify(status, objects=result)
+    return trading.fetch_categories(cid) if cid else None
 
 
 @blueprint.route('/item/<item_id>/')
 @blueprint.route('/api/item/<item_id>/')
 @blueprint.route('{}/item/<item_id>/'.format(PREFIX))
-@cache_header(CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(CACHE_TIMEOUT, defaults=COUNTRY_DEFAULTS)
 def item(item_id):
     """Get an item's details
 
@@ -229,11 +676,21 @@ def item(item_id):
 
     Kwargs:
         country (str): eBay country (one of ['US', 'UK'], default: 'US')
+        fields (str): comma separated fields to include, e.g.,
+            'title,price,shipping' (default: all of the item details).
+            Search result fields are answered from the search results
+            when possible.
     """
-    kwargs = {k: parse(v) for k, v in request.args.to_dict().items()}
+    kwargs = get_request_args()
+    fields = get_fields(kwargs.pop('fields', None))
+    country = kwargs.get('country', 'US')
+    result = item_cache.lookup(country, item_id, fields=fields)
+
+    if result is not None:
+        return jsonify(objects=result)
 
     try:
-        trading = Trading(**kwargs)
+        trading = clients.get(Trading, **kwargs)
     except ConnectionError as err:
         result = str(err)
         status = 500
@@ -242,13 +699,92 @@ def item(item_id):
         result = response['Item']
         status = 200
 
+    if fields and status == 200:
+        # search result fields are named differently in the details
+        entity = dict(result, **trading.summarize(result))
+        result = {field: entity.get(field) for field in fields}
+
+    return jsonify(status, objects=result)
+
+
+def get_fields(fields=None):
+    if fields and not hasattr(fields, 'append'):
+        fields = str(fields).split(',')
+
+    return [field.strip() for field in fields or [] if field.strip()]
+
+
+@blueprint.route('/item/', methods=['POST'])
+@blueprint.route('/api/item/', methods=['POST'])
+@blueprint.route('{}/item/'.format(PREFIX), methods=['POST'])
+def item_batch():
+    """Get the details of multiple items
+
+    Kwargs:
+        items (str): IDs of the items to get (either a JSON list or a comma
+            separated string)
+
+        country (str): eBay country (one of ['US', 'UK'], default: 'US')
+        selector (str): The details to include (see the GetMultipleItems
+            IncludeSelector docs, default: 'Details')
+    """
+    try:
+        data, item_ids = get_batch()
+    except ValueError as err:
+        return jsonify(400, objects=str(err))
+    selector = data.pop('selector', 'Details')
+
+    if not item_ids:
+        return jsonify(400, objects="At least one item ID must be provided")
+    elif len(item_ids) > BATCH_MAX_ITEMS:
+        msg = 'No more than {} items may be fetched at once'
+        return jsonify(400, objects=msg.format(BATCH_MAX_ITEMS))
+
+    country = data.get('country', 'US')
+    tags = {
+        item_id: get_tags('item', {'country': country, 'item_id': item_id})
+        for item_id in item_ids}
+
+    generations = get_generations(cache, sum(tags.values(), []))
+    make_key = lambda item_id: tag_key(make_data_key(
+        'item', item_id=item_id, country=country, selector=selector),
+        tags[item_id], generations)
+
+    keys = [make_key(item_id) for item_id in item_ids]
+    cached = zip(item_ids, cache.get_many(*keys))
+    results = {item_id: item for item_id, item in cached if item}
+    missing = [item_id for item_id in item_ids if item_id not in results]
+    cache_stats.count('data:item', 'hits', len(item_ids) - len(missing))
+    cache_stats.count('data:item', 'misses', len(missing))
+    shopping = clients.get(Shopping, **data)
+
+    try:
+        response = shopping.get_items(missing, selector, FAN_OUT_MAX_WORKERS)
+    except ConnectionError as err:
+        response = {'results': {}, 'message': str(err)}
+
+    fetched = response['results']
+    mapping = {make_key(item_id): item for item_id, item in fetched.items()}
+    cache.set_many(mapping, timeout=CACHE_TIMEOUT)
+    results.update(fetched)
+    not_found = [item_id for item_id in item_ids if item_id not in results]
+    message = response['message']
+
+    if not_found and not message:
+        message = 'Items not found: {}'.format(', '.join(not_found))
+
+    if results:
+        status, result = 200, {'results': results, 'message': message}
+    else:
+        status, result = 500 if response['message'] else 404, message
+
     return jsonify(status, objects=result)
 
 
 @blueprint.route('/lorem/')
 @blueprint.route('/api/lorem/')
 @blueprint.route('{}/lorem/'.format(PREFIX))
-@cache_header(CACHE_TIMEOUT, key_prefix=make_cache_key)
+@cache_header(CACHE_TIMEOUT)
 def lorem():
     """Get a random 'bacon ipsum' sentence
 
@@ -258,6 +794,75 @@ def lorem():
     return jsonify(objects=choice(BACON_IPSUM))
 
 
+@blueprint.route('/stats/')
+@blueprint.route('/api/stats/')
+@blueprint.route('{}/stats/'.format(PREFIX))
+def stats():
+    """Get this worker's upstream connection, call coalescing, call
+    scheduling, resilience, timeout, category index, and cache statistics
+
+    Return:
+        dict: Client pool, coalesced call, call quota, retry and circuit
+            breaker, upstream latency, category index, item cache, and cache
+            hit rate statistics
+    """
+    objects = {
+        'clients': clients.stats(), 'flights': flights.stats(),
+        'quotas': scheduler.stats(), 'resilience': resilience.stats(),
+        'timeouts': timeouts.stats(),
+        'categories': category_indexes.stats(), 'items': item_cache.stats(),
+        'cache': cache_stats.stats(),
+        'tiers': getattr(cache.cache, 'stats', {})}
+
+    return jsonify(objects=objects)
+
+
+@blueprint.route('/metrics')
+@blueprint.route('{}/metrics'.format(PREFIX))
+def metrics_text():
+    """Get the upstream latency, parsing, serialization, cache, and response
+    metrics of all workers (in the Prometheus text format)
+
+    Return:
+        str: The metrics
+    """
+    response = make_response(render(metrics.collect()))
+    response.headers['Content-Type'] = CONTENT_TYPE
+    return response
+
+
+@blueprint.route('/profiles/')
+@blueprint.route('/api/profiles/')
+@blueprint.route('{}/profiles/'.format(PREFIX))
+def profiles():
+    """Get this worker's slowest requests (requires the admin token in an
+    `X-Profile-Token` header)
+
+    Return:
+        list: The elapsed time, phase breakdown, url, and status of each of
+            the slowest requests (slowest first)
+    """
+    if profiler.is_authorized(request.headers):
+        response = jsonify(objects=profiler.get_slowest())
+    else:
+        response = jsonify(403, objects='Invalid admin token')
+
+    return response
+
+
+@blueprint.route('/breakers/')
+@blueprint.route('/api/breakers/')
+@blueprint.route('{}/breakers/'.format(PREFIX))
+def breakers():
+    """Get the state of this worker's eBay endpoint circuit breakers
+
+    Return:
+        dict: The state, consecutive failures, seconds until the next probe,
+            and p95 latency of each (API family, country) endpoint
+    """
+    return jsonify(objects=resilience.status())
+
+
 @blueprint.route('/cache/', methods=['DELETE'])
 @blueprint.route('/cache/<base>/', methods=['DELETE'])
 @blueprint.route('/api/cache/', methods=['DELETE'])
@@ -265,20 +870,61 @@ def lorem():
 @blueprint.route('{}/cache/'.format(PREFIX), methods=['DELETE'])
 @blueprint.route('{}/cache/<base>/'.format(PREFIX), methods=['DELETE'])
 def cached(base=None):
-    """Reset all caches or remove a cached url by base
+    """Reset all caches, invalidate a group of cached responses, or remove
+    a cached view response (selected by any other query parameters)
 
     Args:
-        base (str): The base of the cached url to remove, e.g., 'lorem'
+        base (str): The endpoint whose cached responses to invalidate, e.g.,
+            'search' or 'sub_category'
+
+    Kwargs:
+        country (str): Only invalidate cached responses for this country
+        item (str): Invalidate every cached response about this item ID
+        category (str): Invalidate every cached response about this category
+            ID or name
 
     Return:
         str: Response message
     """
-    if base:
-        url = request.url.replace('delete/', '')
-        msg = 'Cached URL "{}" deleted!'.format(url)
-        cache.delete(url)
+    args = request.args.to_dict()
+    names = ['country', 'item', 'category']
+    group = {name: args.pop(name) for name in names if name in args}
+
+    if base and args:
+        key = make_view_key(base, dict(args, **group), tagged=True)
+        msg = 'Cached "{}" response deleted!'.format(base)
+        cache.delete(key)
+    elif base or group:
+        tag = get_group_tag(base, **group)
+        invalidate_tag(cache, tag)
+        msg = 'Cached "{}" responses invalidated!'.format(tag)
     else:
         msg = 'Caches reset!'
         cache.clear()
 
     return jsonify(status=204, objects=msg)
+
+
+def get_group_tag(base=None, country=None, item=None, category=None):
+    if item:
+        tag = 'item:{}'.format(item)
+    elif category:
+        tag = 'category:{}'.format(category)
+    elif base and country:
+        tag = '{}:country:{}'.format(base, country)
+    elif country:
+        tag = 'country:{}'.format(country)
+    else:
+        tag = base
+
+    return tag
+
+
+@blueprint.errorhandler(Unavailable)
+def unavailable(err):
+    response = jsonify(err.status, objects=str(err))
+
+    if err.retry_after:
+        response.headers['Retry-After'] = str(int(ceil(err.retry_after)))
+
+    return response
@@ -11,6 +11,7 @@
 """
 from os import getenv, path as p
 from datetime import timedelta
+from tempfile import gettempdir
 from pkutils import parse_module
 
 PARENT_DIR = p.abspath(p.dirname(__file__))
@@ -45,6 +46,59 @@ class Config(object):
     CACHE_TIMEOUT = get_seconds(minutes=60)
     CAT_CACHE_TIMEOUT = get_seconds(days=7)
     SUB_CAT_CACHE_TIMEOUT = get_seconds(hours=24)
+    CACHE_LOCAL_MAX_ENTRIES = 1024
+    CACHE_LOCAL_TIMEOUT = get_seconds(minutes=1)
+    CACHE_SYNC_INTERVAL = 1
+    CACHE_STALE_TIMEOUT = get_seconds(hours=1)
+    CACHE_STALE_RETRY_INTERVAL = 30
+    CACHE_REFRESH_MAX_WORKERS = 4
+    CLIENT_MAX_IDLE_TIME = get_seconds(minutes=5)
+    CLIENT_REAP_INTERVAL = get_seconds(minutes=1)
+    CLIENT_MAX_IDLE = 16
+    CLIENT_POOL_SIZE = 10
+    CLIENT_MAX_CLIENTS = 64
+    STREAM_RESPONSES = False
+    SINGLE_FLIGHT_SHARED = False
+    SINGLE_FLIGHT_TIMEOUT = 30
+    ITEM_CACHE = True
+    QUOTA_SHARED = False
+    QUOTA_CALLS_PER_SECOND = {'Finding': 20, 'Shopping': 20, 'Trading': 20}
+    QUOTA_CALLS_PER_DAY = {'Finding': 5000, 'Shopping': 5000, 'Trading': 5000}
+    QUOTA_MAX_WAIT = 5
+    UPSTREAM_RETRIES = 2
+    UPSTREAM_BACKOFF = 0.1
+    UPSTREAM_MAX_BACKOFF = 2
+    BREAKER_FAILURES = 5
+    BREAKER_RESET_TIMEOUT = 30
+    HEDGE_REQUESTS = False
+    HEDGE_MIN_SAMPLES = 20
+    UPSTREAM_TIMEOUT_FACTOR = 3
+    UPSTREAM_MIN_TIMEOUT = 2
+    UPSTREAM_MAX_TIMEOUT = 60
+    UPSTREAM_TIMEOUT_SAMPLES = 20
+    REQUEST_DEADLINE = 25
+    # where each worker writes its metrics so /metrics can add them up (see
+    # `app.metrics`, snapshots are grouped by server process)
+    METRICS_DIR = getenv(
+        'METRICS_DIR', p.join(gettempdir(), '{}-metrics'.format(__APP_NAME__)))
+    METRICS_FLUSH_INTERVAL = 5
+    PROFILE_TOKEN = getenv('PROFILE_TOKEN')
+    PROFILE_TOP_FUNCTIONS = 25
+    PROFILE_SLOWEST = 0
+    EBAY_DOMAIN = getenv('EBAY_DOMAIN')
+    EBAY_HTTPS = getenv('EBAY_HTTPS', 'true').lower() not in {'false', '0'}
+    STANDIN_FIXTURES = getenv(
+        'STANDIN_FIXTURES', p.join(PARENT_DIR, 'app', 'tests', 'fixtures'))
+    STANDIN_PORT = 8089
+    ITEM_CACHE_TIMEOUT = get_seconds(minutes=60)
+    CATEGORY_REFRESH_INTERVAL = get_seconds(hours=24)
+    CATEGORY_SNAPSHOT = getenv(
+        'CATEGORY_SNAPSHOT', p.join(PARENT_DIR, 'categories.db'))
+    FAN_OUT_MAX_WORKERS = 8
+    SEARCH_MAX_PAGES = 50
+    SEARCH_SITE_DEADLINE = 10
+    BATCH_MAX_ITEMS = 500
+    SHIP_BATCH_MAX_WORKERS = 16
     APP_NAME = __APP_NAME__
 
     end = '-stage' if getenv('STAGE', False) else ''
@@ -55,7 +109,7 @@ class Config(object):
         SERVER_NAME = '{}.{}'.format(__SUB_DOMAIN__, __DOMAIN__)
         SSLIFY_SUBDOMAINS = True
 
-    API_METHODS = ['GET', 'DELETE']
+    API_METHODS = ['GET', 'POST', 'DELETE']
     API_RESULTS_PER_PAGE = 32
     API_MAX_RESULTS_PER_PAGE = 1024
     API_URL_PREFIX = '/api/v1'
@@ -77,3 +131,5 @@ class Development(Config):
 class Test(Config):
     TESTING = True
     DEBUG_MEMCACHE = False
+    CATEGORY_SNAPSHOT = None
+    METRICS_DIR = None
@@ -130,6 +130,50 @@ def test(where, stop, **kwargs):
         exit(e.returncode)
 
 
+@manager.option(
+    '-n', '--number', help='Number of runs per trial', type=int, default=100)
+def bench(number):
+    """Run the offline micro-benchmarks"""
+    from app.benchmarks import run
+    run(number)
+
+
+@manager.option('-h', '--host', help='The server host', default='127.0.0.1')
+@manager.option('-p', '--port', help='The server port', type=int)
+@manager.option('-d', '--fixtures', help='The fixtures directory')
+@manager.option(
+    '-r', '--record', help='Record fixtures from eBay', action='store_true')
+@manager.option(
+    '-s', '--sandbox', help='Record from the sandbox', action='store_true')
+@manager.option(
+    '-l', '--latency', help='Seconds added to each call', type=float,
+    default=0)
+@manager.option(
+    '-j', '--jitter', help='Max random seconds added to the latency',
+    type=float, default=0)
+@manager.option(
+    '-e', '--error-rate', help='Share of calls that fail', type=float,
+    default=0)
+@manager.option(
+    '-t', '--throttle-rate', help='Share of calls that are throttled',
+    type=float, default=0)
+@manager.option(
+    '-q', '--calls-per-second', help='Calls per second before throttling',
+    type=int)
+@manager.option(
+    '-S', '--strict', help='Only replay exact matches', action='store_true')
+def standin(host, port, fixtures, record, **kwargs):
+    """Run a local eBay stand-in (for offline load tests and benchmarks)"""
+    from app.standin import StandIn, serve, RECORD, REPLAY
+
+    with app.app_context():
+        port = port or app.config['STANDIN_PORT']
+        fixtures = fixtures or app.config['STANDIN_FIXTURES']
+
+    mode = RECORD if record else REPLAY
+    serve(StandIn(fixtures, mode, **kwargs), host, port)
+
+
 @manager.option('-r', '--remote', help='the heroku branch', default='staging')
 def add_keys(remote):
     """Deploy staging app"""